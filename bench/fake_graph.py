@@ -0,0 +1,367 @@
+"""
+本地 Microsoft Graph 替身 (用于离线基准测试)。
+
+模拟安装器用到的接口: /organization、/applications (含 PATCH keyCredentials)、/servicePrincipals (含 appRoleAssignments)、
+/directoryRoles (含 members/$ref)、/roleManagement/directory/roleAssignments 以及 /$batch。
+支持配置网络延迟、限流 (429 + Retry-After) 和目录传播延迟，并统计往返次数和 TCP 连接数。
+"""
+import base64
+import collections
+import hashlib
+import http.server
+import json
+import re
+import threading
+import time
+import uuid
+from urllib.parse import urlparse, parse_qs
+
+EXO_APP_ID = "00000002-0000-0ff1-ce00-000000000000"
+EXCHANGE_ADMIN_TEMPLATE_ID = "29232cdf-9323-42fd-ade2-1d097af3e4de"
+
+
+class FakeGraphState:
+    """租户中的目录对象和调用统计"""
+
+    def __init__(self, tenant_domain="contoso.com"):
+        self.tenant_domain = tenant_domain
+        self.applications = {}
+        self.service_principals = {
+            "exo-sp": {"id": "exo-sp", "appId": EXO_APP_ID,
+                       "appRoles": [{"id": "dc50a0fb-09a3-484d-be87-e023b12c6440", "value": "Exchange.ManageAsApp"}]},
+        }
+        self.directory_roles = {"exo-admin-role": {"id": "exo-admin-role", "roleTemplateId": EXCHANGE_ADMIN_TEMPLATE_ID, "members": set()}}
+        self.app_role_assignments = []
+        self.role_assignments = []
+        self.created_at = {}
+        self.lock = threading.Lock()
+        self.stats = {"http_requests": 0, "batch_requests": 0, "sub_requests": 0, "throttled": 0, "connections": 0}
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+            return self.stats[key]
+
+
+class FakeGraphServer:
+    """
+    latency: 每个 HTTP 往返附加的延迟 (秒)
+    throttle_every: 每 N 个请求 (包括 $batch 中的子请求) 返回一次 429，0 表示不限流
+    retry_after: 429 响应中的 Retry-After (秒)
+    rate_limit: 每秒最多处理的请求数 (包括子请求，按 1 秒滑动窗口计算)，0 表示不限制。
+                超过后与 Graph 一样在 Retry-After 期间拒绝该租户的所有请求，期间继续发送的请求同样返回 429
+    propagation_delay: 新建的应用/服务主体在其他接口中可见前的延迟 (秒)
+    page_size: 集合查询每页最多返回的对象数 ($top 更小时以 $top 为准)，其余通过 @odata.nextLink 分页
+    """
+
+    def __init__(self, latency=0.0, throttle_every=0, retry_after=0.2, propagation_delay=0.0, tenant_domain="contoso.com",
+                 page_size=100, rate_limit=0):
+        self.latency = latency
+        self.page_size = page_size
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.propagation_delay = propagation_delay
+        self.state = FakeGraphState(tenant_domain)
+        self._throttle_counter = 0
+        self.rate_limit = rate_limit
+        self._recent = collections.deque()
+        self._blocked_until = 0.0
+        self._server = None
+
+    @property
+    def endpoint(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def stats(self):
+        with self.state.lock:
+            stats = dict(self.state.stats)
+        # 往返次数 = HTTP 请求数；子请求单独统计 ($batch 把多个子请求合并成一次往返)
+        stats["round_trips"] = stats["http_requests"]
+        return stats
+
+    def start(self):
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="FakeGraph", daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    # ---- 请求处理 ----
+
+    def _should_throttle(self):
+        if self.rate_limit:
+            now = time.monotonic()
+            with self.state.lock:
+                if now < self._blocked_until:
+                    return True
+                while self._recent and now - self._recent[0] >= 1.0:
+                    self._recent.popleft()
+                if len(self._recent) >= self.rate_limit:
+                    self._blocked_until = now + self.retry_after
+                    return True
+                self._recent.append(now)
+        if not self.throttle_every:
+            return False
+        with self.state.lock:
+            self._throttle_counter += 1
+            return self._throttle_counter % self.throttle_every == 0
+
+    def _visible(self, object_id):
+        """对象是否已经传播 (创建时间超过 propagation_delay)"""
+        created = self.state.created_at.get(object_id)
+        return created is None or time.monotonic() - created >= self.propagation_delay
+
+    @staticmethod
+    def _not_found(message):
+        return 404, {"error": {"code": "Request_ResourceNotFound", "message": message}}, {}
+
+    def seed_applications(self, display_names):
+        """预先创建应用 (例如模拟多年重装留下的孤立应用)"""
+        with self.state.lock:
+            for name in display_names:
+                app = {"id": str(uuid.uuid4()), "appId": str(uuid.uuid4()), "displayName": name,
+                       "createdDateTime": "2023-01-01T00:00:00Z"}
+                self.state.applications[app["id"]] = app
+
+    @staticmethod
+    def _store_key_credentials(credentials):
+        """与 Graph 一致: 补充 keyId 和 customKeyIdentifier (证书 SHA-1 指纹的 Base64)"""
+        stored = []
+        for credential in credentials or []:
+            der = base64.b64decode(credential.get("key") or "")
+            stored.append(dict(credential, keyId=credential.get("keyId") or str(uuid.uuid4()),
+                               customKeyIdentifier=base64.b64encode(hashlib.sha1(der).digest()).decode("ascii"),
+                               endDateTime=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 2 * 365 * 86400))))
+        return stored
+
+    @staticmethod
+    def _public_app(app, query):
+        """读取时不返回证书内容，并按 $select 只返回指定字段"""
+        app = dict(app, keyCredentials=[dict(k, key=None) for k in app.get("keyCredentials", [])])
+        select = query.get("$select", [""])[0]
+        return {k: v for k, v in app.items() if k in select.split(",")} if select else app
+
+    def _page(self, raw_path, query, items):
+        """按 $top / $skiptoken 分页，并按 $select 只返回指定字段"""
+        select = query.get("$select", [""])[0]
+        if select:
+            fields = set(select.split(","))
+            items = [{k: v for k, v in item.items() if k in fields} for item in items]
+        top = min(int(query.get("$top", [self.page_size])[0]), self.page_size)
+        skip = int(query.get("$skiptoken", ["0"])[0])
+        body = {"value": items[skip:skip + top]}
+        if "$count" in query:
+            body["@odata.count"] = len(items)
+        if skip + top < len(items):
+            base = re.sub(r"[&?]\$skiptoken=\d+", "", raw_path)
+            body["@odata.nextLink"] = f"{self.endpoint}{base}{'&' if '?' in base else '?'}$skiptoken={skip + top}"
+        return body
+
+    @staticmethod
+    def _filter_value(query, field):
+        match = re.search(rf"{field} eq '([^']*)'", query.get("$filter", [""])[0])
+        return match.group(1) if match else None
+
+    def handle(self, method, raw_path, body):
+        """处理单个 Graph 请求，返回 (状态码, 响应体, 附加响应头)"""
+        if self._should_throttle():
+            self.state.count("throttled")
+            return 429, {"error": {"code": "TooManyRequests", "message": "Too many requests"}}, {"Retry-After": str(self.retry_after)}
+
+        url = urlparse(raw_path)
+        path = re.sub(r"^/(v1\.0|beta)", "", url.path)
+        query = parse_qs(url.query)
+        state = self.state
+
+        if path == "/organization" and method == "GET":
+            return 200, {"value": [{"id": "tenant-id", "verifiedDomains": [
+                {"name": state.tenant_domain.split(".")[0] + ".onmicrosoft.com", "isDefault": False},
+                {"name": state.tenant_domain, "isDefault": True}]}]}, {}
+
+        if path == "/applications":
+            if method == "GET":
+                name, app_id = self._filter_value(query, "displayName"), self._filter_value(query, "appId")
+                suffix = re.search(r"endswith\(displayName,'([^']*)'\)", query.get("$filter", [""])[0])
+                with state.lock:
+                    apps = [a for a in state.applications.values()
+                            if (name is None or a["displayName"] == name) and (app_id is None or a["appId"] == app_id)
+                            and (suffix is None or a["displayName"].endswith(suffix.group(1)))]
+                return 200, self._page(raw_path, query, [self._public_app(a, {}) for a in apps]), {}
+            if method == "POST":
+                app = dict(body, id=str(uuid.uuid4()), appId=str(uuid.uuid4()), createdDateTime=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                           keyCredentials=self._store_key_credentials(body.get("keyCredentials")))
+                with state.lock:
+                    state.applications[app["id"]] = app
+                    state.created_at[app["appId"]] = time.monotonic()
+                return 201, app, {}
+
+        match = re.match(r"^/applications/([^/]+)$", path)
+        if match:
+            with state.lock:
+                app = state.applications.get(match.group(1))
+                if app and method == "DELETE":
+                    del state.applications[app["id"]]
+                    for sp_id in [k for k, sp in state.service_principals.items() if sp["appId"] == app["appId"]]:
+                        del state.service_principals[sp_id]
+                    return 204, None, {}
+                if app and method == "PATCH":
+                    if "keyCredentials" in body:
+                        body = dict(body, keyCredentials=self._store_key_credentials(body["keyCredentials"]))
+                    app.update(body)
+                    return 204, None, {}
+            if app and method == "GET":
+                return 200, self._public_app(app, query), {}
+            return self._not_found(f"Resource '{match.group(1)}' does not exist.")
+
+        if path == "/servicePrincipals":
+            if method == "GET":
+                app_id = self._filter_value(query, "appId")
+                with state.lock:
+                    sps = [sp for sp in state.service_principals.values() if app_id is None or sp["appId"] == app_id]
+                return 200, {"value": sps}, {}
+            if method == "POST":
+                if not self._visible(body.get("appId")):
+                    return 400, {"error": {"code": "Request_BadRequest",
+                                           "message": "The appId of the service principal does not reference a valid application object."}}, {}
+                with state.lock:
+                    if any(sp["appId"] == body["appId"] for sp in state.service_principals.values()):
+                        return 409, {"error": {"code": "Request_MultipleObjectsWithSameKeyValue", "message": "already exists"}}, {}
+                    sp = {"id": str(uuid.uuid4()), "appId": body["appId"], "appRoles": []}
+                    state.service_principals[sp["id"]] = sp
+                    state.created_at[sp["id"]] = time.monotonic()
+                return 201, sp, {}
+
+        match = re.match(r"^/servicePrincipals/([^/]+)$", path)
+        if match and method == "GET":
+            with state.lock:
+                sp = state.service_principals.get(match.group(1))
+            if sp and self._visible(sp["id"]):
+                return 200, sp, {}
+            return self._not_found(f"Resource '{match.group(1)}' does not exist.")
+
+        match = re.match(r"^/servicePrincipals/([^/]+)/appRoleAssignments$", path)
+        if match and method == "GET":
+            with state.lock:
+                assignments = [a for a in state.app_role_assignments if a["principalId"] == match.group(1)]
+            return 200, self._page(raw_path, query, assignments), {}
+        if match and method == "POST":
+            if match.group(1) not in state.service_principals or not self._visible(match.group(1)):
+                return self._not_found(f"Resource '{match.group(1)}' does not exist or one of its queried reference-property objects are not present.")
+            assignment = dict(body, id=str(uuid.uuid4()))
+            with state.lock:
+                state.app_role_assignments.append(assignment)
+            return 201, assignment, {}
+
+        if path == "/directoryRoles":
+            template_id = self._filter_value(query, "roleTemplateId")
+            if method == "GET":
+                with state.lock:
+                    roles = [{"id": r["id"], "roleTemplateId": r["roleTemplateId"]} for r in state.directory_roles.values()
+                             if template_id is None or r["roleTemplateId"] == template_id]
+                return 200, {"value": roles}, {}
+            if method == "POST":
+                # 激活角色模板: 已激活时与 Graph 一样返回冲突
+                with state.lock:
+                    if any(r["roleTemplateId"] == body.get("roleTemplateId") for r in state.directory_roles.values()):
+                        return 400, {"error": {"code": "Request_BadRequest", "message": "A conflicting object with one or more of the specified property values is present in the directory."}}, {}
+                    role = {"id": str(uuid.uuid4()), "roleTemplateId": body.get("roleTemplateId"), "members": set()}
+                    state.directory_roles[role["id"]] = role
+                return 201, {"id": role["id"], "roleTemplateId": role["roleTemplateId"]}, {}
+
+        match = re.match(r"^/directoryRoles/([^/]+)/members/\$ref$", path)
+        if match and method == "POST":
+            member_id = body["@odata.id"].rstrip("/").split("/")[-1]
+            if member_id not in state.service_principals or not self._visible(member_id):
+                return 400, {"error": {"code": "Request_BadRequest", "message": f"Resource '{member_id}' does not exist."}}, {}
+            with state.lock:
+                role = state.directory_roles.get(match.group(1))
+                if role is None:
+                    return self._not_found(f"Resource '{match.group(1)}' does not exist.")
+                if member_id in role["members"]:
+                    return 400, {"error": {"code": "Request_BadRequest", "message": "One or more added object references already exist for the following modified properties: 'members'."}}, {}
+                role["members"].add(member_id)
+            return 204, None, {}
+
+        if path == "/roleManagement/directory/roleAssignments" and method == "GET":
+            # 与 Graph 一致: 通过 directoryRoles 添加的成员也会出现在统一角色分配中
+            principal_id = self._filter_value(query, "principalId")
+            with state.lock:
+                assignments = [a for a in state.role_assignments if principal_id is None or a["principalId"] == principal_id]
+                assignments += [{"id": f"{role['id']}-{member}", "principalId": member, "roleDefinitionId": role["roleTemplateId"],
+                                 "directoryScopeId": "/"}
+                                for role in state.directory_roles.values() for member in role["members"]
+                                if principal_id is None or member == principal_id]
+            return 200, self._page(raw_path, query, assignments), {}
+        if path == "/roleManagement/directory/roleAssignments" and method == "POST":
+            if not self._visible(body.get("principalId")):
+                return 400, {"error": {"code": "Request_BadRequest", "message": "principal does not exist"}}, {}
+            assignment = dict(body, id=str(uuid.uuid4()))
+            with state.lock:
+                state.role_assignments.append(assignment)
+            return 201, assignment, {}
+
+        return self._not_found(f"Fake Graph 未实现: {method} {path}")
+
+    def handle_batch(self, api_version, body):
+        responses = []
+        for item in body.get("requests", []):
+            self.state.count("sub_requests")
+            status, payload, headers = self.handle(item["method"], f"/{api_version}{item['url']}", item.get("body"))
+            response = {"id": item["id"], "status": status, "headers": headers}
+            if payload is not None:
+                response["body"] = payload
+            responses.append(response)
+        return 200, {"responses": responses}, {}
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                server.state.count("connections")
+
+            def _dispatch(self):
+                server.state.count("http_requests")
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                if server.latency:
+                    time.sleep(server.latency)
+
+                match = re.match(r"^/(v1\.0|beta)/\$batch$", self.path)
+                if match and self.command == "POST":
+                    server.state.count("batch_requests")
+                    status, payload, headers = server.handle_batch(match.group(1), body)
+                else:
+                    status, payload, headers = server.handle(self.command, self.path, body)
+
+                data = json.dumps(payload).encode("utf-8") if payload is not None else b""
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PATCH = do_DELETE = _dispatch
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,134 @@
+"""
+PowerShell 替身 (用于离线基准测试)。
+
+由 run_bench.py 生成的 pwsh / powershell 包装脚本调用，模拟安装器用到的两种调用方式:
+1. 模块路径探测: -Command "[Environment]::GetEnvironmentVariable('PSModulePath', 'User')"
+2. 常驻工作进程: -EncodedCommand <worker>，从 stdin 逐行读取 {"id", "script"(base64)}，
+   以 @@CEXO@@{"id", "ok", "output", "error"} 格式返回结果。
+   证书的生成、导入、按指纹读取和删除会记录到模拟的证书存储中。
+
+环境变量:
+    CEXO_BENCH_HOME         模拟的用户目录 (模块路径位于 <HOME>/Documents/PowerShell/Modules)
+    CEXO_BENCH_SPAWN_LOG    每启动一个进程追加一行，用于统计进程启动次数
+    CEXO_BENCH_SPAWN_DELAY  模拟 PowerShell 启动耗时 (秒)
+    CEXO_BENCH_SCRIPT_DELAY 模拟每个脚本的执行耗时 (秒)
+"""
+import base64
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+
+RESPONSE_MARKER = "@@CEXO@@"
+
+
+def record_spawn(kind):
+    log_path = os.environ.get("CEXO_BENCH_SPAWN_LOG")
+    if log_path:
+        with open(log_path, "a", encoding="utf-8") as f:
+            f.write(f"{kind} {os.getpid()}\n")
+
+
+class CertStore:
+    """模拟 Cert:\\CurrentUser\\My: 指纹 -> DER (Base64)，保存在 <HOME>/cert_store.json，供多个工作进程共享"""
+
+    def __init__(self, home):
+        self.path = os.path.join(home, "cert_store.json")
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception:
+            return {}
+
+    def _save(self, certs):
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(certs, f)
+
+    def add(self, der):
+        thumbprint = hashlib.sha1(der).hexdigest().upper()
+        certs = self._load()
+        certs[thumbprint] = base64.b64encode(der).decode("ascii")
+        self._save(certs)
+        return thumbprint
+
+    def get(self, thumbprint):
+        return self._load().get(thumbprint.upper())
+
+    def remove(self, thumbprint):
+        certs = self._load()
+        certs.pop(thumbprint.upper(), None)
+        self._save(certs)
+
+
+def cert_not_after(der_base64):
+    """证书到期时间 (New-SelfSignedCertificate 替身生成的是随机内容，按两年计算)"""
+    try:
+        from cryptography import x509
+        cert = x509.load_der_x509_certificate(base64.b64decode(der_base64))
+        not_after = getattr(cert, "not_valid_after_utc", None) or cert.not_valid_after
+        return not_after.strftime("%Y-%m-%dT%H:%M:%S.0000000Z")
+    except Exception:
+        return time.strftime("%Y-%m-%dT%H:%M:%S.0000000Z", time.gmtime(time.time() + 2 * 365 * 86400))
+
+
+def run_script(script, store):
+    """根据脚本内容返回与真实 PowerShell 相同结构的输出"""
+    if "New-SelfSignedCertificate" in script:
+        thumbprint = store.add(os.urandom(600))
+        not_after = time.strftime("%Y-%m-%dT%H:%M:%S.0000000Z", time.gmtime(time.time() + 2 * 365 * 86400))
+        return json.dumps({"Thumbprint": thumbprint, "Base64": store.get(thumbprint), "NotAfter": not_after})
+    if "X509Store" in script and ".Add($cert)" in script:
+        # 导入进程内生成的 PFX: 只记录证书部分
+        from cryptography.hazmat.primitives.serialization import Encoding, pkcs12
+        pfx = re.search(r"FromBase64String\('([^']+)'\)", script).group(1)
+        password = re.search(r"::new\(\$bytes, '([^']+)'", script).group(1)
+        _, cert, _ = pkcs12.load_key_and_certificates(base64.b64decode(pfx), password.encode("ascii"))
+        store.add(cert.public_bytes(Encoding.DER))
+        return ""
+    match = re.search(r"Get-Item -Path 'Cert:\\CurrentUser\\My\\([0-9A-Fa-f]+)'", script)
+    if match:
+        der = store.get(match.group(1))
+        if der and "HasPrivateKey" in script:
+            return json.dumps({"NotAfter": cert_not_after(der), "HasPrivateKey": True})
+        return der or ""
+    match = re.search(r"Test-Path -Path 'Cert:\\CurrentUser\\My\\([0-9A-Fa-f]+)'", script)
+    if match:
+        return "True" if store.get(match.group(1)) else "False"
+    match = re.search(r"Remove-Item -Path 'Cert:\\CurrentUser\\My\\([0-9A-Fa-f]+)'", script)
+    if match:
+        store.remove(match.group(1))
+    return ""
+
+
+def main():
+    home = os.environ.get("CEXO_BENCH_HOME", os.path.expanduser("~"))
+    time.sleep(float(os.environ.get("CEXO_BENCH_SPAWN_DELAY", "0")))
+
+    if "-Command" in sys.argv:
+        record_spawn("probe")
+        print(os.path.join(home, "Documents", "PowerShell", "Modules"))
+        return 0
+
+    record_spawn("worker")
+    store = CertStore(home)
+    script_delay = float(os.environ.get("CEXO_BENCH_SCRIPT_DELAY", "0"))
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        script = base64.b64decode(request["script"]).decode("utf-8")
+        time.sleep(script_delay)
+        try:
+            response = {"id": request["id"], "ok": True, "output": run_script(script, store), "error": ""}
+        except Exception as e:
+            response = {"id": request["id"], "ok": False, "output": "", "error": str(e)}
+        print(RESPONSE_MARKER + json.dumps(response), flush=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
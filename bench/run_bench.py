@@ -0,0 +1,314 @@
+"""
+离线端到端基准测试。
+
+在 Linux 上无界面运行安装器引擎的完整安装和卸载流程:
+Graph 请求发往本地替身服务器 (fake_graph.py)，PowerShell 由替身脚本 (fake_powershell.py) 代替，
+登录使用不打开浏览器的替身凭据。每个场景使用独立的临时用户目录，互不影响。
+
+每个场景报告墙钟耗时、Graph 往返次数 (以及 $batch 子请求数、TCP 连接数) 和 PowerShell 进程启动次数。
+
+用法:
+    python bench/run_bench.py                               # 运行全部场景
+    python bench/run_bench.py --scenario baseline throttled # 只运行指定场景
+    python bench/run_bench.py --json bench_results.json     # 保存结果
+    python bench/run_bench.py --baseline bench_results.json # 与之前的结果比较，出现回退时返回非 0
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import install_connect_exo as installer  # noqa: E402
+from fake_graph import FakeGraphServer  # noqa: E402
+
+# 场景: Graph 服务器参数 + PowerShell 替身参数 + 租户数量 + 要执行的操作 (默认先安装再卸载)
+DEFAULT_ACTIONS = ("install", "uninstall")
+SCENARIOS = {
+    "baseline": {"graph": {}, "powershell": {}, "tenants": 1},
+    "latency_50ms": {"graph": {"latency": 0.05}, "powershell": {}, "tenants": 1},
+    "throttled": {"graph": {"latency": 0.02, "throttle_every": 4, "retry_after": 0.2}, "powershell": {}, "tenants": 1},
+    "propagation_3s": {"graph": {"latency": 0.02, "propagation_delay": 3.0}, "powershell": {}, "tenants": 1},
+    "slow_spawn": {"graph": {"latency": 0.02}, "powershell": {"spawn_delay": 0.8, "script_delay": 0.05}, "tenants": 1},
+    "bulk_4_tenants": {"graph": {"latency": 0.05, "propagation_delay": 1.0}, "powershell": {"spawn_delay": 0.3}, "tenants": 4},
+    # 一个事件循环通过 AsyncInstallerEngine 驱动 50 个租户，同时最多执行 16 个
+    "async_50_tenants": {"graph": {"latency": 0.05, "propagation_delay": 1.0}, "powershell": {}, "tenants": 50,
+                         "async_concurrency": 16},
+    # 安装后更换证书 (只修改现有应用的 keyCredentials，不重建服务主体和角色)
+    "rotate_cert": {"graph": {"latency": 0.05, "propagation_delay": 1.0}, "powershell": {}, "tenants": 1,
+                    "actions": ("install", "rotate")},
+    # 卸载后重新安装: 租户域名、Exchange Online 服务主体和角色实例使用租户缓存，不再查询
+    "reinstall_cached": {"graph": {"latency": 0.05}, "powershell": {}, "tenants": 1, "actions": ("install", "uninstall", "reinstall")},
+    # 安装后只读检查配置 (本地检查与登录并行，Graph 检查合并为一次 $batch)
+    "verify": {"graph": {"latency": 0.05}, "powershell": {}, "tenants": 1, "actions": ("install", "verify")},
+    # 16 个任务同时操作一个每秒只允许 40 个请求的租户: 由共享的限速器排队，对比关闭限速器时各自重试的情况
+    "rate_limited_16": {"graph": {"latency": 0.05, "rate_limit": 40, "retry_after": 1.0}, "powershell": {}, "tenants": 16},
+    "rate_limited_16_nolimit": {"graph": {"latency": 0.05, "rate_limit": 40, "retry_after": 1.0}, "powershell": {}, "tenants": 16,
+                                "rate_limiter": False},
+    # 租户中残留 500 个孤立应用 (另有 300 个无关应用)，分页查询后批量删除
+    "cleanup_500_orphans": {"graph": {"latency": 0.05}, "powershell": {}, "tenants": 1, "actions": ("cleanup",),
+                            "seed_orphans": 500, "seed_other": 300},
+}
+
+# 与基准结果比较时允许的耗时波动
+DEFAULT_TOLERANCE = 0.25
+
+
+class StubToken:
+    # 与真实访问令牌一样带 tid 声明 (限速器和租户缓存按租户 ID 分组)
+    TOKEN = "e30." + base64.urlsafe_b64encode(json.dumps({"tid": "bench-tenant-id"}).encode()).decode().rstrip("=") + ".sig"
+
+    def __init__(self):
+        self.token = self.TOKEN
+        self.expires_on = int(time.time()) + 3600
+
+
+class StubCredential:
+    """替身凭据: 不打开浏览器，可模拟登录耗时"""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+
+    def get_token(self, *scopes, **kwargs):
+        time.sleep(self.delay)
+        return StubToken()
+
+
+def make_shims(bin_dir):
+    """生成 pwsh / powershell 包装脚本，调用 fake_powershell.py"""
+    shim = os.path.join(BENCH_DIR, "fake_powershell.py")
+    for name in ("pwsh", "powershell"):
+        path = os.path.join(bin_dir, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f'#!/bin/sh\nexec "{sys.executable}" "{shim}" "$@"\n')
+        os.chmod(path, 0o755)
+
+
+class Scenario:
+    """在隔离的临时目录中运行一个场景"""
+
+    def __init__(self, name, spec, login_delay=0.0, verbose=False):
+        self.name = name
+        self.spec = spec
+        self.login_delay = login_delay
+        self.verbose = verbose
+
+    def _on_log(self, tenant):
+        def on_log(message, level):
+            if self.verbose:
+                print(f"    [{tenant}] {message}")
+        return on_log
+
+    def run(self):
+        work_dir = tempfile.mkdtemp(prefix=f"cexo_bench_{self.name}_")
+        saved_env = dict(os.environ)
+        saved_cloud_config = installer.get_cloud_config
+        saved_get_credential = installer.InstallerEngine.get_credential
+        saved_limiter = installer.GraphRateLimiter.enabled
+        spawn_log = os.path.join(work_dir, "spawns.log")
+        try:
+            bin_dir = os.path.join(work_dir, "bin")
+            home = os.path.join(work_dir, "home")
+            os.makedirs(bin_dir)
+            os.makedirs(os.path.join(home, "Documents"))
+            make_shims(bin_dir)
+
+            ps_options = self.spec.get("powershell", {})
+            os.environ.update({
+                "PATH": bin_dir + os.pathsep + saved_env.get("PATH", ""),
+                "HOME": home,
+                "USERPROFILE": home,
+                "LOCALAPPDATA": os.path.join(home, "AppData", "Local"),
+                "CEXO_BENCH_HOME": home,
+                "CEXO_BENCH_SPAWN_LOG": spawn_log,
+                "CEXO_BENCH_SPAWN_DELAY": str(ps_options.get("spawn_delay", 0)),
+                "CEXO_BENCH_SCRIPT_DELAY": str(ps_options.get("script_delay", 0)),
+            })
+
+            with FakeGraphServer(**self.spec.get("graph", {})) as server:
+                server.seed_applications([f"Stale{i}-Automation-App" for i in range(self.spec.get("seed_orphans", 0))] +
+                                         [f"Other App {i}" for i in range(self.spec.get("seed_other", 0))])
+                installer.get_cloud_config = lambda env: dict(saved_cloud_config(env), graph_endpoint=server.endpoint)
+                installer.InstallerEngine.get_credential = lambda engine, ctx: StubCredential(self.login_delay)
+                # 每个场景从默认速率开始
+                installer.GraphRateLimiter.reset()
+                installer.GraphRateLimiter.enabled = self.spec.get("rate_limiter", True)
+                return self._run_tenants(server, spawn_log)
+        finally:
+            installer.get_cloud_config = saved_cloud_config
+            installer.InstallerEngine.get_credential = saved_get_credential
+            installer.GraphRateLimiter.enabled = saved_limiter
+            os.environ.clear()
+            os.environ.update(saved_env)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def _run_tenants(self, server, spawn_log):
+        from concurrent.futures import ThreadPoolExecutor
+
+        tenants = [f"Bench{i + 1}" for i in range(self.spec.get("tenants", 1))]
+        ps_host = installer.PowerShellHost()
+        path_resolver = installer.PowerShellPathResolver(installer.get_documents_dir)
+        result = {"scenario": self.name, "tenants": len(tenants), "actions": {}}
+        try:
+            for action in self.spec.get("actions", DEFAULT_ACTIONS):
+                before = server.stats
+                wait_before = self._limiter_wait()
+                start = time.perf_counter()
+                if "async_concurrency" in self.spec:
+                    asyncio.run(self._run_async(action, tenants, ps_host, path_resolver))
+                else:
+                    with ThreadPoolExecutor(max_workers=len(tenants)) as pool:
+                        futures = [pool.submit(self._run_one, action, tenant, ps_host, path_resolver) for tenant in tenants]
+                        for future in futures:
+                            future.result()
+                after = server.stats
+                result["actions"][action] = {
+                    "wall_s": round(time.perf_counter() - start, 3),
+                    "round_trips": after["round_trips"] - before["round_trips"],
+                    "sub_requests": after["sub_requests"] - before["sub_requests"],
+                    "throttled": after["throttled"] - before["throttled"],
+                    "connections": after["connections"] - before["connections"],
+                    "limiter_wait_s": round(self._limiter_wait() - wait_before, 2),
+                }
+        finally:
+            ps_host.close()
+
+        spawns = []
+        if os.path.exists(spawn_log):
+            with open(spawn_log, "r", encoding="utf-8") as f:
+                spawns = [line.split()[0] for line in f if line.strip()]
+        result["spawns"] = len(spawns)
+        result["worker_spawns"] = spawns.count("worker")
+        result["probe_spawns"] = spawns.count("probe")
+        return result
+
+    @staticmethod
+    def _limiter_wait():
+        """所有请求在限速器中排队的总时间 (秒)"""
+        return sum(limiter.stats["wait_s"] for limiter in installer.GraphRateLimiter.all())
+
+    async def _run_async(self, action, tenants, ps_host, path_resolver):
+        engine = installer.AsyncInstallerEngine(self.spec["async_concurrency"], ps_host, path_resolver)
+
+        async def print_events():
+            async for event in engine.events():
+                if event["type"] == "log":
+                    self._on_log(event["module_name"])(event["message"], event["level"])
+
+        log_task = asyncio.ensure_future(print_events())
+        try:
+            await asyncio.gather(*(getattr(engine, action)("Global", tenant) for tenant in tenants))
+        finally:
+            await engine.aclose()
+            await log_task
+
+    def _run_one(self, action, tenant, ps_host, path_resolver):
+        engine = installer.InstallerEngine(ps_host, path_resolver, on_log=self._on_log(tenant))
+        if action in ("install", "reinstall"):
+            return engine.install("Global", tenant)
+        if action == "cleanup":
+            return engine.cleanup_orphans("Global", dry_run=False)
+        if action == "verify":
+            result = engine.verify("Global", tenant)
+            if not result["ok"]:
+                raise Exception(f"检查未通过: {[c for c in result['checks'] if c['status'] == 'fail']}")
+            return result
+        if action == "rotate":
+            return engine.rotate("Global", tenant)
+        return engine.uninstall("Global", tenant)
+
+
+def merge_runs(runs):
+    """多次运行取耗时中位数，计数取最后一次"""
+    result = dict(runs[-1], actions={})
+    for action, metrics in runs[-1]["actions"].items():
+        result["actions"][action] = dict(metrics, wall_s=round(statistics.median(r["actions"][action]["wall_s"] for r in runs), 3))
+    return result
+
+
+def print_table(results):
+    # 表头使用 ASCII，保证等宽对齐
+    header = (f"{'scenario':<24}{'action':<11}{'tenants':>8}{'wall_s':>9}{'rt':>6}{'sub':>6}{'429':>6}{'conn':>6}{'queue_s':>9}"
+              f"{'spawns':>8}")
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        for action, m in r["actions"].items():
+            print(f"{r['scenario']:<24}{action:<11}{r['tenants']:>8}{m['wall_s']:>9.2f}{m['round_trips']:>6}{m['sub_requests']:>6}"
+                  f"{m['throttled']:>6}{m['connections']:>6}{m.get('limiter_wait_s', 0):>9.2f}{r['spawns']:>8}")
+    print("rt = Graph 往返次数, sub = $batch 子请求数, 429 = 被限流的请求数, conn = 新建 TCP 连接数, "
+          "queue_s = 请求在限速器中排队的总时间, spawns = 整个场景的 PowerShell 进程启动次数")
+
+
+def compare(results, baseline_path, tolerance):
+    """与基准结果比较: 耗时超过容差或往返次数/进程启动次数增加都视为回退"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {r["scenario"]: r for r in json.load(f)["results"]}
+    regressions = []
+    for r in results:
+        base = baseline.get(r["scenario"])
+        if not base:
+            continue
+        for action, now in r["actions"].items():
+            before = base.get("actions", {}).get(action)
+            if not before:
+                continue
+            if now["wall_s"] > before["wall_s"] * (1 + tolerance) + 0.05:
+                regressions.append(f"{r['scenario']} {action}: 耗时 {before['wall_s']:.2f}s -> {now['wall_s']:.2f}s")
+            if now["round_trips"] > before["round_trips"]:
+                regressions.append(f"{r['scenario']} {action}: 往返 {before['round_trips']} -> {now['round_trips']}")
+        if r["spawns"] > base["spawns"]:
+            regressions.append(f"{r['scenario']}: 进程启动 {base['spawns']} -> {r['spawns']}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ConnectEXO 安装器离线基准测试")
+    parser.add_argument("--scenario", nargs="*", choices=sorted(SCENARIOS), help="要运行的场景 (默认全部)")
+    parser.add_argument("--repeat", type=int, default=1, help="每个场景重复次数，耗时取中位数")
+    parser.add_argument("--login-delay", type=float, default=0.0, help="替身凭据的登录耗时 (秒)")
+    parser.add_argument("--json", help="把结果写入 JSON 文件")
+    parser.add_argument("--baseline", help="与之前保存的 JSON 结果比较，出现回退时返回 1")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="比较耗时时允许的相对波动 (默认 0.25)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="输出引擎日志")
+    args = parser.parse_args(argv)
+
+    if sys.platform == "win32":
+        parser.error("基准测试使用 sh 包装的 PowerShell 替身，只能在 Linux / macOS 上运行")
+
+    results = []
+    for name in args.scenario or list(SCENARIOS):
+        print(f">>> {name} ...", flush=True)
+        runs = [Scenario(name, SCENARIOS[name], args.login_delay, args.verbose).run() for _ in range(max(args.repeat, 1))]
+        results.append(merge_runs(runs))
+
+    print()
+    print_table(results)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"created_at": time.strftime('%Y-%m-%d %H:%M:%S'), "python": sys.version.split()[0],
+                       "results": results}, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        if regressions:
+            print("\n性能回退:")
+            for line in regressions:
+                print(f"  X {line}")
+            return 1
+        print("\n√ 未发现性能回退")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,7 @@
+import time
+# 启动计时起点 (--startup-timing)，必须在其他导入之前
+_STARTUP_START = time.perf_counter()
+
 import tkinter as tk
 from tkinter import messagebox, scrolledtext, ttk
 import subprocess
@@ -5,25 +9,3711 @@ import json
 import os
 import sys
 import threading
-import requests
-import time
 import re
+import base64
+import uuid
+import queue
+import atexit
+import collections
+import contextlib
+
+# requests / azure.identity 导入较慢 (打包后尤其明显)，在首次使用 Graph 或登录时才导入，
+# 缺少依赖时的自动安装也推迟到那时，不再阻塞窗口显示
+REQUIRED_PACKAGES = {"requests": "requests", "azure.identity": "azure-identity"}
+_dependencies_checked = False
+_dependencies_lock = threading.Lock()
+
+
+def ensure_dependencies(log=None):
+    """检查 Graph / 登录所需的依赖库，缺少时尝试自动安装 (每个进程只检查一次)"""
+    global _dependencies_checked
+    if _dependencies_checked:
+        return
+    import importlib
+    import importlib.util
+    with _dependencies_lock:
+        if _dependencies_checked:
+            return
+        missing = [package for module, package in REQUIRED_PACKAGES.items() if importlib.util.find_spec(module) is None]
+        if missing:
+            install_hint = f"pip install {' '.join(missing)}"
+            if getattr(sys, "frozen", False):
+                raise RuntimeError(f"程序缺少依赖库 {', '.join(missing)}，请重新打包 ({install_hint})")
+            if log:
+                log(f"! 缺少依赖库 {', '.join(missing)}，正在自动安装...", "WARNING")
+            try:
+                subprocess.check_call([sys.executable, "-m", "pip", "install", *missing], stdin=subprocess.DEVNULL)
+            except Exception as e:
+                raise RuntimeError(f"无法自动安装依赖库，请手动运行：\n{install_hint}\n\n错误: {e}")
+            importlib.invalidate_caches()
+        _dependencies_checked = True
+
+
+def preload_dependencies():
+    """窗口显示后在后台线程预先导入依赖库，用户点击开始时已加载完毕"""
+    try:
+        import requests  # noqa: F401
+        import azure.identity  # noqa: F401
+    except ImportError:
+        pass
+
+
+class StartupTimer:
+    """
+    启动耗时测量 (--startup-timing)。
+    记录从模块开始加载到各阶段 (导入、Tk 初始化、界面构建、首个窗口出现) 的耗时，
+    并测量延迟导入的库各自的导入耗时，用于发现启动性能回退。
+    """
+
+    def __init__(self, start):
+        self.start = start
+        self.marks = []
+        self.imports = {}
+
+    def mark(self, name):
+        self.marks.append((name, time.perf_counter()))
+
+    def measure_import(self, module_name):
+        import importlib
+        if module_name in sys.modules:
+            self.imports[module_name] = None  # 已被其他模块导入，无法单独计时
+            return
+        t0 = time.perf_counter()
+        try:
+            importlib.import_module(module_name)
+            self.imports[module_name] = round((time.perf_counter() - t0) * 1000, 1)
+        except ImportError:
+            self.imports[module_name] = "missing"
+
+    def report(self):
+        phases = []
+        previous = self.start
+        for name, t in self.marks:
+            phases.append({"phase": name, "at_ms": round((t - self.start) * 1000, 1),
+                           "delta_ms": round((t - previous) * 1000, 1)})
+            previous = t
+        first_window = next((p["at_ms"] for p in phases if p["phase"] == "首个窗口"), None)
+        return {"frozen": bool(getattr(sys, "frozen", False)), "python": sys.version.split()[0],
+                "time_to_first_window_ms": first_window, "phases": phases, "deferred_imports_ms": self.imports}
+
+    def write(self, path):
+        report = self.report()
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        return report
+
+
+startup_timer = StartupTimer(_STARTUP_START)
+
+
+class Tracer:
+    """
+    耗时追踪 (Chrome trace / Perfetto 格式)。
+    span() 记录一段操作的开始时间、耗时、所在线程以及附加参数 (状态、数据大小等)，
+    每次安装/卸载结束后导出为 JSON，可直接在 chrome://tracing 或 ui.perfetto.dev 中打开。
+    enabled=False 时不记录任何数据。
+    """
+
+    def __init__(self, name="ConnectEXO", enabled=True):
+        self.name = name
+        self.enabled = enabled
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self._events = []
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        """with tracer.span(...) as args: 代码块中可以向 args 补充结果信息 (例如状态码、响应大小)"""
+        if not self.enabled:
+            yield args
+            return
+        t0 = time.perf_counter()
+        args.setdefault("status", "ok")
+        try:
+            yield args
+        except BaseException as e:
+            args["status"] = "error"
+            args["error"] = str(e)[:300]
+            raise
+        finally:
+            t1 = time.perf_counter()
+            thread = threading.current_thread()
+            event = {"name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": thread.ident,
+                     "ts": round((t0 - self._start) * 1e6), "dur": round((t1 - t0) * 1e6), "args": args}
+            with self._lock:
+                self._events.append(event)
+                self._threads.setdefault(thread.ident, thread.name)
+
+    def summary(self, category):
+        """某一类 span 的次数和总耗时 (秒)"""
+        with self._lock:
+            durations = [e["dur"] for e in self._events if e["cat"] == category]
+        return len(durations), sum(durations) / 1e6
+
+    def write(self, path):
+        with self._lock:
+            events = list(self._events)
+            threads = dict(self._threads)
+        pid = os.getpid()
+        metadata = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": self.name}}]
+        metadata += [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                     for tid, name in threads.items()]
+        trace = {"traceEvents": metadata + sorted(events, key=lambda e: e["ts"]), "displayTimeUnit": "ms",
+                 "otherData": {"name": self.name, "started_at": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started_at))}}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(trace, f, ensure_ascii=False)
+        return path
+
+
+class PowerShellError(Exception):
+    """PowerShell 脚本执行失败"""
+
+
+class PowerShellTimeoutError(PowerShellError):
+    """PowerShell 脚本执行超时"""
+
+
+class PowerShellHost:
+    """
+    常驻 PowerShell 工作进程。
+    只启动一次 PowerShell，之后通过 stdin/stdout 的 JSON 行协议逐个执行脚本，
+    避免每段脚本都付出 1-3 秒的冷启动开销。进程崩溃或超时后会在下一次调用时自动重启。
+    """
+
+    # 响应行前缀，用于区分协议响应与脚本中 Write-Host 等直接写到 stdout 的内容
+    RESPONSE_MARKER = "@@CEXO@@"
+
+    # 工作进程主循环: 每行读取一个 JSON 请求 {id, script(UTF-8 Base64)}，
+    # 在子作用域中执行脚本后返回一行 JSON 响应 {id, ok, output, error}
+    WORKER_SCRIPT = r"""
+$__utf8 = New-Object System.Text.UTF8Encoding $false
+[Console]::OutputEncoding = $__utf8
+$ProgressPreference = 'SilentlyContinue'
+while ($true) {
+    $__line = [Console]::In.ReadLine()
+    if ($null -eq $__line) { break }
+    if (-not $__line.Trim()) { continue }
+    $__req = $__line | ConvertFrom-Json
+    $__resp = [ordered]@{ id = $__req.id; ok = $true; output = ''; error = '' }
+    try {
+        $__block = [ScriptBlock]::Create($__utf8.GetString([Convert]::FromBase64String($__req.script)))
+        $__errors = @()
+        $__resp.output = & $__block 2>&1 | ForEach-Object {
+            if ($_ -is [System.Management.Automation.ErrorRecord]) { $__errors += $_.ToString() } else { $_ }
+        } | Out-String -Width 4096
+        if ($__errors.Count -gt 0) {
+            $__resp.ok = $false
+            $__resp.error = $__errors -join "`n"
+        }
+    } catch {
+        $__resp.ok = $false
+        $__resp.error = $_.ToString()
+    }
+    [Console]::Out.WriteLine('@@CEXO@@' + ($__resp | ConvertTo-Json -Compress))
+    [Console]::Out.Flush()
+}
+"""
+
+    def __init__(self, executables=("powershell", "pwsh")):
+        # 按顺序尝试的 PowerShell 可执行文件 (Windows PowerShell 优先，与原有行为一致)
+        self.executables = list(executables)
+        self.executable = None
+        self.spawn_count = 0
+        self._process = None
+        self._responses = None
+        self._noise = collections.deque(maxlen=50)
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def _is_alive(self):
+        return self._process is not None and self._process.poll() is None
+
+    def _start(self):
+        encoded = base64.b64encode(self.WORKER_SCRIPT.encode("utf-16-le")).decode("ascii")
+        # creationflags=0x08000000 (CREATE_NO_WINDOW)
+        creation_flags = 0x08000000 if sys.platform == 'win32' else 0
+        for ps_cmd in self.executables:
+            try:
+                process = subprocess.Popen(
+                    [ps_cmd, "-NoLogo", "-NoProfile", "-NonInteractive", "-ExecutionPolicy", "Bypass", "-EncodedCommand", encoded],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                    creationflags=creation_flags
+                )
+            except (FileNotFoundError, OSError):
+                continue # 如果没安装该版本，尝试下一个
+
+            self.spawn_count += 1
+            self.executable = ps_cmd
+            self._process = process
+            self._responses = queue.Queue()
+            self._noise.clear()
+            threading.Thread(target=self._read_loop, args=(process, self._responses), daemon=True).start()
+            return
+
+        raise PowerShellError(f"PowerShell Error: 未找到可用的 PowerShell ({' / '.join(self.executables)})")
+
+    def _read_loop(self, process, responses):
+        marker = self.RESPONSE_MARKER
+        for raw in iter(process.stdout.readline, b""):
+            line = raw.decode("utf-8", errors="replace").strip()
+            pos = line.find(marker)
+            if pos >= 0:
+                try:
+                    responses.put(json.loads(line[pos + len(marker):]))
+                    continue
+                except ValueError:
+                    pass
+            if line:
+                self._noise.append(line)
+        # EOF: 工作进程已退出
+        responses.put(None)
+
+    def _kill(self):
+        process, self._process = self._process, None
+        if process is None:
+            return
+        try:
+            process.kill()
+            process.wait(timeout=5)
+        except Exception:
+            pass
+
+    def run(self, script, timeout=120):
+        """执行脚本并返回输出文本；失败抛出 PowerShellError，超时抛出 PowerShellTimeoutError"""
+        payload = {"script": base64.b64encode(script.encode("utf-8")).decode("ascii")}
+
+        with self._lock:
+            # 写入失败说明工作进程已崩溃，重启后重试一次
+            for attempt in range(2):
+                if not self._is_alive():
+                    self._start()
+                self._next_id += 1
+                payload["id"] = self._next_id
+                try:
+                    self._process.stdin.write((json.dumps(payload) + "\n").encode("ascii"))
+                    self._process.stdin.flush()
+                    break
+                except OSError:
+                    self._kill()
+            else:
+                raise PowerShellError("PowerShell Error: 无法向 PowerShell 工作进程发送请求")
+
+            deadline = time.monotonic() + timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    # 超时的脚本可能仍在运行，直接结束进程，下一次调用时重启
+                    self._kill()
+                    raise PowerShellTimeoutError(f"PowerShell Error: 脚本执行超时 ({timeout} 秒)")
+                try:
+                    response = self._responses.get(timeout=remaining)
+                except queue.Empty:
+                    continue
+                if response is None:
+                    self._kill()
+                    detail = "\n".join(self._noise)
+                    raise PowerShellError(f"PowerShell Error: 工作进程意外退出\n{detail}".strip())
+                if response.get("id") == payload["id"]:
+                    break
+
+        if not response.get("ok"):
+            raise PowerShellError(f"PowerShell Error: {response.get('error')}")
+        return (response.get("output") or "").strip()
+
+    def close(self):
+        """关闭工作进程 (关闭 stdin 让主循环自然退出)"""
+        with self._lock:
+            process = self._process
+            if process is None:
+                return
+            try:
+                process.stdin.close()
+                process.wait(timeout=3)
+                self._process = None
+            except Exception:
+                self._kill()
+
+
+def get_app_data_dir():
+    """工具自身的数据目录 (缓存等)，Windows 下为 %LOCALAPPDATA%\\ConnectEXO"""
+    local_app_data = os.environ.get("LOCALAPPDATA")
+    if local_app_data:
+        path = os.path.join(local_app_data, "ConnectEXO")
+    else:
+        path = os.path.join(os.path.expanduser("~"), ".connectexo")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class PowerShellPathResolver:
+    """
+    PowerShell 模块路径解析器。
+    在后台线程中同时探测 pwsh 和 powershell 的用户 PSModulePath，结果保存在内存和磁盘缓存中。
+    当用户 PSModulePath 或 PowerShell 程序文件发生变化时缓存失效，否则解析路径无需启动任何进程。
+    """
+
+    EDITIONS = ("pwsh", "powershell")
+    CACHE_VERSION = 1
+
+    def __init__(self, documents_dir_func, cache_path=None):
+        self.get_documents_dir = documents_dir_func
+        self.cache_path = cache_path or os.path.join(get_app_data_dir(), "ps_module_paths.json")
+        self.probe_count = 0
+        self._lock = threading.Lock()
+        self._result = None
+
+    def warm_up(self):
+        """在后台线程中预先解析 (程序启动时调用)"""
+        threading.Thread(target=self._warm_up, daemon=True).start()
+
+    def _warm_up(self):
+        try:
+            self.resolve()
+        except Exception:
+            pass
+
+    def _read_user_psmodulepath(self):
+        # 直接读取注册表中的用户环境变量，与 PowerShell 中
+        # [Environment]::GetEnvironmentVariable('PSModulePath', 'User') 的结果一致
+        try:
+            import winreg
+            with winreg.OpenKey(winreg.HKEY_CURRENT_USER, "Environment") as key:
+                return str(winreg.QueryValueEx(key, "PSModulePath")[0])
+        except ImportError:
+            return os.environ.get("PSModulePath", "")
+        except OSError:
+            return ""
+
+    def _fingerprint(self):
+        """缓存失效依据: 用户 PSModulePath + 各 PowerShell 程序文件的路径/修改时间/大小"""
+        import shutil
+        binaries = {}
+        for ps_cmd in self.EDITIONS:
+            exe = shutil.which(ps_cmd)
+            if exe:
+                try:
+                    st = os.stat(exe)
+                    binaries[ps_cmd] = [exe, st.st_mtime, st.st_size]
+                except OSError:
+                    binaries[ps_cmd] = [exe, 0, 0]
+            else:
+                binaries[ps_cmd] = None
+        return {"version": self.CACHE_VERSION, "user_psmodulepath": self._read_user_psmodulepath(), "binaries": binaries}
+
+    def _probe_edition(self, ps_cmd):
+        """获取指定 PowerShell 版本的用户 PSModulePath；未安装时返回 None"""
+        try:
+            cmd = [ps_cmd, "-NoProfile", "-Command", "[Environment]::GetEnvironmentVariable('PSModulePath', 'User')"]
+            # creationflags=0x08000000 (CREATE_NO_WINDOW)
+            creation_flags = 0x08000000 if sys.platform == 'win32' else 0
+            process = subprocess.run(cmd, capture_output=True, text=True, stdin=subprocess.DEVNULL, creationflags=creation_flags, timeout=60)
+        except FileNotFoundError:
+            return None # 如果没安装 pwsh，跳过
+        except Exception:
+            return []
+
+        paths = []
+        if process.returncode == 0:
+            for p in process.stdout.strip().split(';'):
+                p = p.strip()
+                # 只要路径不为空，就加入候选 (不再强制检查 startswith(user_home)，因为 OneDrive 路径可能不同)
+                if p:
+                    paths.append(p)
+        return paths
+
+    def _probe(self, fingerprint):
+        from concurrent.futures import ThreadPoolExecutor
+
+        # 同时探测两个版本，耗时取决于较慢的一个而不是两者之和
+        editions = [e for e in self.EDITIONS if fingerprint["binaries"].get(e)]
+        with ThreadPoolExecutor(max_workers=max(len(editions), 1)) as pool:
+            results = list(pool.map(self._probe_edition, editions))
+        self.probe_count += 1
+
+        # 去重并保持顺序 (pwsh 优先)
+        candidates = []
+        installed = []
+        for ps_cmd, paths in zip(editions, results):
+            if paths is None:
+                continue
+            installed.append(ps_cmd)
+            for p in paths:
+                if p not in candidates:
+                    candidates.append(p)
+
+        return {"fingerprint": fingerprint, "candidates": candidates, "installed": installed}
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception:
+            return None
+
+    def _save_cache(self, result):
+        try:
+            tmp_path = self.cache_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(result, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.cache_path)
+        except Exception:
+            pass
+
+    def invalidate(self):
+        with self._lock:
+            self._result = None
+            try:
+                os.remove(self.cache_path)
+            except OSError:
+                pass
+
+    def resolve(self):
+        """返回最佳的模块安装路径 (并发调用时会等待正在进行的探测完成)"""
+        with self._lock:
+            fingerprint = self._fingerprint()
+            if not self._result or self._result.get("fingerprint") != fingerprint:
+                cached = self._load_cache()
+                if cached and cached.get("fingerprint") == fingerprint:
+                    self._result = cached
+                else:
+                    self._result = self._probe(fingerprint)
+                    self._save_cache(self._result)
+            result = self._result
+
+        candidates = result["candidates"]
+
+        # 1. 优先选择已存在的路径
+        for path in candidates:
+            if os.path.exists(path):
+                return path
+
+        # 2. 如果都不存在，选择第一个看起来合理的路径 (优先选 Documents 下的)
+        for path in candidates:
+            if "Documents" in path:
+                return path
+
+        # 3. 如果还是没有，Fallback 到默认路径 (使用真实的 Documents 路径)
+        real_docs = self.get_documents_dir()
+
+        # 如果检测到 pwsh 存在，优先用 PowerShell 7 (Core) 路径
+        if "pwsh" in result["installed"] or fingerprint["binaries"].get("pwsh"):
+            return os.path.join(real_docs, "PowerShell", "Modules")
+        return os.path.join(real_docs, "WindowsPowerShell", "Modules")
+
+
+class GraphRateLimiter:
+    """
+    进程级 Graph 滑动窗口限速器，按 (云环境, 租户) 分组，同一租户的所有 GraphClient (包括批量模式中并发的任务) 共享。
+    在收到第一个 429 之前不限速，只统计最近 WINDOW 秒内被服务器接受 (未被限流) 的请求数；收到 429 时把这个接受速率的
+    DECREASE 倍作为上限，之后任意 WINDOW 秒内发出的请求不超过上限: 窗口内还有余量的请求立即发出，
+    余量用完时等到窗口中最早的请求过期 (下一个空位)，不暂停整个租户；被限流的请求自己等到 Retry-After 之后再排队重发。
+    之后每个被接受的请求线性恢复速率 (AIMD)，恢复到 MAX_RATE 或 RELAX_AFTER 秒内没有再被限流时重新停止限速。
+    与 Graph 的限流规则一致，$batch 按其中的子请求数计。
+    """
+
+    MIN_RATE = 10.0  # 速率下限 (请求/秒)，请求很少时偶发的 429 不会把租户限到每秒几个请求
+    MAX_RATE = 200.0
+    DEFAULT_PAUSE = 1.0  # 429 没有 Retry-After 时被限流的请求等待的时间 (秒)
+    DECREASE = 0.9  # 每轮限流后以接受速率的该倍数为上限
+    WINDOW = 1.0  # 统计接受速率和限速的滑动窗口 (秒)
+    RELAX_AFTER = 5.0  # 距上次限流超过该时间 (秒) 后停止限速
+
+    enabled = True
+    _limiters = {}
+    _limiters_lock = threading.Lock()
+
+    def __init__(self, key):
+        self.key = key
+        self.rate = None  # 请求/秒，未限速时为 None
+        self._sent = collections.deque()  # 最近 WINDOW 秒内发出的请求 (时间, 子请求数)
+        self._sent_count = 0
+        self._admitted = collections.deque()  # 最近 WINDOW 秒内被服务器接受的请求时间
+        self._throttled_at = 0.0
+        self._round_until = 0.0
+        self._waiting = 0
+        self._cond = threading.Condition()
+        self.stats = {"acquired": 0, "waits": 0, "wait_s": 0.0, "max_wait_s": 0.0, "max_queue_depth": 0, "throttled": 0}
+
+    @classmethod
+    def get(cls, graph_endpoint, tenant):
+        """返回 (云环境, 租户) 对应的限速器；限速关闭时返回 None"""
+        if not cls.enabled:
+            return None
+        key = (graph_endpoint.rstrip("/"), (tenant or "common").lower())
+        with cls._limiters_lock:
+            limiter = cls._limiters.get(key)
+            if limiter is None:
+                limiter = cls._limiters[key] = cls(key)
+            return limiter
+
+    @classmethod
+    def all(cls):
+        with cls._limiters_lock:
+            return list(cls._limiters.values())
+
+    @classmethod
+    def reset(cls):
+        with cls._limiters_lock:
+            cls._limiters.clear()
+
+    @property
+    def queue_depth(self):
+        """当前正在限速器中排队的请求数"""
+        with self._cond:
+            return self._waiting
+
+    def _expire(self, now):
+        while self._sent and now - self._sent[0][0] >= self.WINDOW:
+            self._sent_count -= self._sent.popleft()[1]
+        while self._admitted and now - self._admitted[0] >= self.WINDOW:
+            self._admitted.popleft()
+
+    def _unsend(self, count):
+        while count > 0 and self._sent:
+            sent_at, sent = self._sent.pop()
+            removed = min(sent, count)
+            count -= removed
+            self._sent_count -= removed
+            if sent > removed:
+                self._sent.append((sent_at, sent - removed))
+
+    def _next_slot(self, now, cost):
+        """窗口中还能发出 cost 个请求时返回 0，否则返回需要等待的秒数"""
+        limit = self.rate * self.WINDOW
+        # 单个请求超过上限时 (大 $batch)，等窗口清空后发出
+        excess = self._sent_count + min(cost, limit) - limit
+        if excess <= 0 or not self._sent:
+            return 0.0
+        for sent_at, count in self._sent:
+            excess -= count
+            if excess <= 0:
+                return sent_at + self.WINDOW - now
+        return self._sent[-1][0] + self.WINDOW - now
+
+    def acquire(self, sleep=None, cost=1):
+        """
+        发出 cost 个请求 ($batch 的子请求数) 前调用，必要时等待，返回等待的秒数。
+        传入 sleep 时用它等待 (AsyncInstallerEngine 传入等待期间让出并发名额的版本)，否则在条件变量上阻塞。
+        """
+        start = time.monotonic()
+        with self._cond:
+            self._waiting += 1
+            self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], self._waiting)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._expire(now)
+                    if self.rate is not None and now - self._throttled_at >= self.RELAX_AFTER:
+                        self.rate = None
+                    delay = self._next_slot(now, cost) if self.rate is not None else 0.0
+                    if delay <= 0:
+                        break
+                    delay = max(delay, 0.001)
+                    if sleep is None:
+                        self._cond.wait(delay)
+                    else:
+                        self._cond.release()
+                        try:
+                            sleep(delay)
+                        finally:
+                            self._cond.acquire()
+            finally:
+                self._waiting -= 1
+            self._sent.append((time.monotonic(), cost))
+            self._sent_count += cost
+            waited = time.monotonic() - start
+            self.stats["acquired"] += 1
+            if waited >= 0.001:
+                self.stats["waits"] += 1
+                self.stats["wait_s"] += waited
+                self.stats["max_wait_s"] = max(self.stats["max_wait_s"], waited)
+        return waited
+
+    def on_throttled(self, retry_after=None, count=1):
+        """
+        count 个请求收到 429: 按限流前的接受速率降低上限，返回被限流的请求重发前应等待的秒数 (Retry-After)。
+        其他请求不暂停，继续按新的上限发送。
+        """
+        with self._cond:
+            now = time.monotonic()
+            # 被拒绝的请求没有占用服务器的配额，从窗口中移除 (从最近发出的请求中扣除)
+            self._unsend(count)
+            pause = retry_after if retry_after is not None else self.DEFAULT_PAUSE
+            self._throttled_at = now
+            # 同一轮中陆续返回的 429 (Retry-After 之前发出的请求) 只减速一次
+            if now >= self._round_until:
+                self._expire(now)
+                admitted = len(self._admitted) / self.WINDOW
+                if self.rate is not None:
+                    admitted = min(admitted, self.rate)
+                self.rate = min(self.MAX_RATE, max(self.MIN_RATE, admitted * self.DECREASE))
+                self._round_until = now + pause
+            self.stats["throttled"] += 1
+            self._cond.notify_all()
+        return pause
+
+    def on_success(self, count=1):
+        """count 个请求被服务器接受 (非 429、非 5xx): 记录接受速率，限速期间线性恢复速率 (满速发送时每秒约 +1 请求/秒)"""
+        with self._cond:
+            now = time.monotonic()
+            self._admitted.extend([now] * count)
+            if self.rate is None:
+                return
+            self.rate += count / self.rate
+            if self.rate >= self.MAX_RATE:
+                self.rate = None
+                self._cond.notify_all()
+
+    def snapshot(self):
+        with self._cond:
+            stats = dict(self.stats, key=self.key, rate=round(self.rate, 2) if self.rate is not None else None,
+                         queue_depth=self._waiting)
+        stats["wait_s"] = round(stats["wait_s"], 3)
+        stats["max_wait_s"] = round(stats["max_wait_s"], 3)
+        return stats
+
+    def summary(self):
+        s = self.snapshot()
+        rate = "未限速" if s["rate"] is None else f"速率 {s['rate']:.1f} 次/秒"
+        return (f"{rate}, 排队 {s['waits']} 次 (共 {s['wait_s']:.1f} 秒, 最长 {s['max_wait_s']:.2f} 秒, "
+                f"最多 {s['max_queue_depth']} 个同时等待), 限流 {s['throttled']} 次")
+
+
+class GraphClient:
+    """
+    Microsoft Graph 客户端 (安装和卸载流程共用)。
+    每个云环境共享一个连接池化的 requests.Session 以复用 TLS 连接，所有请求带默认超时，
+    遇到 429/503 等限流或临时错误时按 Retry-After 或有限的指数退避重试，并统计本次运行的请求数和流量。
+    所有请求先经过同一租户共享的 GraphRateLimiter，429 后由限速器统一降低速率，避免并发任务各自重试形成限流风暴。
+    """
+
+    # (连接超时, 读取超时) 秒
+    DEFAULT_TIMEOUT = (10, 60)
+    RETRY_STATUS = (429, 502, 503, 504)
+    # 429/503 表示请求未被处理，非幂等请求 (POST/PATCH) 只在这两种情况下重试；
+    # 502/504 时服务器可能已经执行了请求，重试可能重复创建对象，直接返回给调用方
+    NOT_PROCESSED_STATUS = (429, 503)
+    IDEMPOTENT_METHODS = ("GET", "HEAD", "DELETE", "PUT")
+
+    _sessions = {}
+    _sessions_lock = threading.Lock()
+
+    def __init__(self, graph_endpoint, access_token, timeout=None, max_retries=4, backoff_base=1.0, backoff_max=30.0, tracer=None,
+                 tenant=None, sleep=None):
+        self.graph_endpoint = graph_endpoint.rstrip("/")
+        self.session = self.get_session(self.graph_endpoint)
+        self.headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+        self.timeout = timeout or self.DEFAULT_TIMEOUT
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        # 重试退避和限速排队使用的等待函数 (AsyncInstallerEngine 传入等待期间让出并发名额的版本)
+        self.sleep = sleep or time.sleep
+        self._limiter_sleep = sleep
+        self.stats = {"requests": 0, "retries": 0, "throttled": 0, "bytes_sent": 0, "bytes_received": 0, "limiter_wait": 0.0}
+        self._stats_lock = threading.Lock()
+        self.tracer = tracer or Tracer(enabled=False)
+        # 令牌中的租户 ID 优先 (同一租户用域名或 ID 登录都共用一个限速器)
+        self.tenant_id = self._token_tenant(access_token)
+        self.limiter = GraphRateLimiter.get(self.graph_endpoint, self.tenant_id or tenant)
+
+    @staticmethod
+    def _token_tenant(access_token):
+        """读取访问令牌 (JWT) 中的 tid，不校验签名，只用于限速分组"""
+        try:
+            payload = access_token.split(".")[1]
+            return json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))).get("tid")
+        except Exception:
+            return None
+
+    @classmethod
+    def get_session(cls, graph_endpoint):
+        """每个云环境 (graph.microsoft.com / microsoftgraph.chinacloudapi.cn) 一个连接池"""
+        import requests
+        import requests.adapters
+        with cls._sessions_lock:
+            session = cls._sessions.get(graph_endpoint)
+            if session is None:
+                session = requests.Session()
+                # 重试由 GraphClient 自己处理，连接池保留多个 keep-alive 连接供并发请求使用
+                adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                cls._sessions[graph_endpoint] = session
+            return session
+
+    def _count(self, key, value=1):
+        with self._stats_lock:
+            self.stats[key] += value
+
+    def _retry_after(self, resp):
+        """解析限流响应头 (Retry-After 秒数或 HTTP 日期 / x-ms-retry-after-ms)，无法解析时返回 None"""
+        retry_ms = resp.headers.get("x-ms-retry-after-ms")
+        if retry_ms:
+            try:
+                return max(float(retry_ms) / 1000.0, 0.0)
+            except ValueError:
+                pass
+        retry_after = resp.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return max(float(retry_after), 0.0)
+            except ValueError:
+                try:
+                    from email.utils import parsedate_to_datetime
+                    return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0.0)
+                except Exception:
+                    pass
+        return None
+
+    @staticmethod
+    def _throttled_sub_requests(resp):
+        try:
+            return sum(1 for r in resp.json().get("responses", []) if r.get("status") == 429)
+        except Exception:
+            return 0
+
+    def _backoff(self, attempt):
+        import random
+        delay = min(self.backoff_base * (2 ** attempt), self.backoff_max)
+        return delay * random.uniform(0.5, 1.0)
+
+    def request(self, method, path, json_body=None, headers=None, timeout=None):
+        """
+        发送请求并返回 requests.Response。
+        path 可以是以 /v1.0 开头的相对路径，也可以是完整 URL (例如 @odata.nextLink)。
+        """
+        method = method.upper()
+        url = path if path.startswith("http") else f"{self.graph_endpoint}{path}"
+        request_headers = dict(self.headers)
+        if headers:
+            request_headers.update(headers)
+        data = json.dumps(json_body).encode("utf-8") if json_body is not None else None
+        import requests
+
+        span_name = f"{method} {url[len(self.graph_endpoint):] if url.startswith(self.graph_endpoint) else url}".split("?")[0]
+        # 只包含幂等子请求的 $batch 视为幂等请求；限速器按子请求数计
+        is_batch = span_name.endswith("/$batch") and isinstance(json_body, dict)
+        if is_batch:
+            idempotent = all(r.get("method", "GET").upper() in self.IDEMPOTENT_METHODS for r in json_body.get("requests", []))
+            cost = max(len(json_body.get("requests", [])), 1)
+        else:
+            idempotent = method in self.IDEMPOTENT_METHODS
+            cost = 1
+
+        attempt = 0
+        while True:
+            if self.limiter:
+                waited = self.limiter.acquire(sleep=self._limiter_sleep, cost=cost)
+                if waited:
+                    self._count("limiter_wait", waited)
+            try:
+                self._count("requests")
+                self._count("bytes_sent", len(data) if data else 0)
+                with self.tracer.span(span_name, "http", attempt=attempt, bytes_sent=len(data) if data else 0) as span:
+                    resp = self.session.request(method, url, headers=request_headers, data=data, timeout=timeout or self.timeout)
+                    span.update(status_code=resp.status_code, bytes_received=len(resp.content))
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # 非幂等请求只在连接尚未建立时重试，避免重复创建对象
+                retryable = idempotent or isinstance(e, requests.ConnectTimeout)
+                if not retryable or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+            else:
+                self._count("bytes_received", len(resp.content))
+                retry_after = self._retry_after(resp)
+                if resp.status_code == 429:
+                    self._count("throttled")
+                    if self.limiter:
+                        retry_after = self.limiter.on_throttled(min(retry_after, self.backoff_max) if retry_after is not None else None,
+                                                                count=cost)
+                elif self.limiter and resp.status_code < 500:
+                    # 被限流的子请求由 GraphBatch 报告给限速器，不计入接受数
+                    self.limiter.on_success(cost - self._throttled_sub_requests(resp) if is_batch else 1)
+                if resp.status_code not in self.RETRY_STATUS or attempt >= self.max_retries:
+                    return resp
+                if not idempotent and resp.status_code not in self.NOT_PROCESSED_STATUS:
+                    return resp
+                # 被限流的请求等到 Retry-After 之后再到限速器排队
+                delay = retry_after if retry_after is not None else self._backoff(attempt)
+
+            attempt += 1
+            self._count("retries")
+            if delay:
+                self.sleep(min(delay, self.backoff_max))
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def get_all(self, path, **kwargs):
+        """
+        逐页读取集合 (跟随 @odata.nextLink)，以生成器方式逐个返回对象，不会一次性把所有页面读入内存。
+        建议配合 $select / $top 使用以减小每页的数据量。
+        """
+        next_link = path
+        while next_link:
+            resp = self.get(next_link, **kwargs)
+            if resp.status_code != 200:
+                raise Exception(f"查询失败 ({resp.status_code}): {resp.text}")
+            data = resp.json()
+            yield from data.get("value", [])
+            next_link = data.get("@odata.nextLink")
+
+    def post(self, path, json=None, **kwargs):
+        return self.request("POST", path, json_body=json, **kwargs)
+
+    def patch(self, path, json=None, **kwargs):
+        return self.request("PATCH", path, json_body=json, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def summary(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        return (f"{stats['requests']} 次请求 (重试 {stats['retries']} 次, 限流 {stats['throttled']} 次, "
+                f"限速排队 {stats['limiter_wait']:.1f} 秒), "
+                f"发送 {stats['bytes_sent'] / 1024:.1f} KB, 接收 {stats['bytes_received'] / 1024:.1f} KB")
+
+
+class GraphBatchResponse:
+    """$batch 中单个请求的响应，提供与 requests.Response 相同的 status_code / headers / text / json()"""
+
+    def __init__(self, item):
+        self.status_code = item.get("status", 0)
+        from requests.structures import CaseInsensitiveDict
+        self.headers = CaseInsensitiveDict(item.get("headers") or {})
+        self.body = item.get("body")
+
+    @property
+    def text(self):
+        if self.body is None:
+            return ""
+        if isinstance(self.body, str):
+            return self.body
+        return json.dumps(self.body, ensure_ascii=False)
+
+    def json(self):
+        if isinstance(self.body, str):
+            return json.loads(self.body)
+        return self.body if self.body is not None else {}
+
+
+class GraphBatch:
+    """
+    Graph JSON 批处理 ($batch)。
+    将多个互不依赖的请求合并为一次往返 (每批最多 20 个)，需要先后顺序的请求通过 dependsOn 声明；
+    单个请求被限流 (429/503) 时按 Retry-After 单独重发。
+    """
+
+    MAX_BATCH_SIZE = 20
+    RETRY_STATUS = (429, 503)
+
+    def __init__(self, graph, api_version="v1.0"):
+        self.graph = graph
+        self.api_version = api_version
+        self._requests = []
+
+    def add(self, request_id, method, url, json=None, depends_on=None, headers=None):
+        """url 为相对于 API 版本的路径，例如 /servicePrincipals?$filter=..."""
+        from urllib.parse import quote
+        item = {"id": str(request_id), "method": method.upper(), "url": quote(url, safe="/?&=$,'()@:+")}
+        if json is not None:
+            item["body"] = json
+            item["headers"] = {"Content-Type": "application/json"}
+        if headers:
+            item.setdefault("headers", {}).update(headers)
+        if depends_on:
+            item["dependsOn"] = [str(d) for d in depends_on]
+        self._requests.append(item)
+        return self
+
+    def __len__(self):
+        return len(self._requests)
+
+    def _chunks(self, items):
+        chunk = []
+        for item in items:
+            if len(chunk) >= self.MAX_BATCH_SIZE:
+                yield chunk
+                chunk = []
+            chunk_ids = {c["id"] for c in chunk}
+            item = dict(item)
+            # 依赖项已在之前的批次中完成 (批次按顺序执行)，不需要再声明 dependsOn
+            depends_on = [d for d in item.get("dependsOn", []) if d in chunk_ids]
+            if depends_on:
+                item["dependsOn"] = depends_on
+            else:
+                item.pop("dependsOn", None)
+            chunk.append(item)
+        if chunk:
+            yield chunk
+
+    def _post_chunk(self, chunk):
+        resp = self.graph.post(f"/{self.api_version}/$batch", json={"requests": chunk})
+        if resp.status_code != 200:
+            raise Exception(f"批量请求失败: {resp.text}")
+        return {str(item.get("id")): GraphBatchResponse(item) for item in resp.json().get("responses", [])}
+
+    def execute(self, max_retries=3, parallel=1, executor=None):
+        """
+        执行所有已添加的请求，返回 {request_id: GraphBatchResponse}。
+        parallel > 1 时多个批次并发发送 (仅当请求之间没有 dependsOn 依赖时，否则按顺序发送)；
+        传入 executor 时批次提交到这个共享线程池，还没有开始发送的批次由当前线程取回自己发送。
+        """
+        pending, self._requests = self._requests, []
+        results = {}
+        if any(item.get("dependsOn") for item in pending):
+            parallel = 1
+
+        for attempt in range(max_retries + 1):
+            round_results = {}
+            chunks = list(self._chunks(pending))
+            if parallel > 1 and len(chunks) > 1 and executor is not None:
+                # 分成 parallel 组，每组按顺序发送
+                lanes = [chunks[i::parallel] for i in range(min(parallel, len(chunks)))]
+                post_lane = lambda lane: [self._post_chunk(chunk) for chunk in lane]
+                futures = [(executor.submit(post_lane, lane), lane) for lane in lanes[1:]]
+                lane_results = post_lane(lanes[0])
+                for future, lane in futures:
+                    lane_results += post_lane(lane) if future.cancel() else future.result()
+                for chunk_results in lane_results:
+                    round_results.update(chunk_results)
+            elif parallel > 1 and len(chunks) > 1:
+                from concurrent.futures import ThreadPoolExecutor
+                with ThreadPoolExecutor(max_workers=min(parallel, len(chunks))) as pool:
+                    for chunk_results in pool.map(self._post_chunk, chunks):
+                        round_results.update(chunk_results)
+            else:
+                for chunk in chunks:
+                    round_results.update(self._post_chunk(chunk))
+
+            # 被限流的请求，以及因为依赖它们而失败 (424) 的请求，在下一轮重发
+            throttled = {rid for rid, r in round_results.items() if r.status_code in self.RETRY_STATUS}
+            retry = [item for item in pending if item["id"] in throttled or
+                     (round_results.get(item["id"]) is not None and round_results[item["id"]].status_code == 424
+                      and throttled.intersection(item.get("dependsOn", [])))]
+            retry_ids = {item["id"] for item in retry}
+            results.update({rid: r for rid, r in round_results.items() if rid not in retry_ids})
+
+            if not retry or attempt >= max_retries:
+                results.update({rid: round_results[rid] for rid in retry_ids if rid in round_results})
+                break
+
+            delays = [self.graph._retry_after(round_results[rid]) for rid in throttled]
+            delays = [d for d in delays if d is not None]
+            delay = max(delays) if delays else self.graph._backoff(attempt)
+            self.graph._count("retries", len(retry))
+            if self.graph.limiter and any(round_results[rid].status_code == 429 for rid in throttled):
+                # 子请求被限流同样降低租户的速率上限，等到 Retry-After 之后重发时再排队
+                self.graph._count("throttled")
+                self.graph.limiter.on_throttled(min(delay, self.graph.backoff_max),
+                                                count=sum(1 for rid in throttled if round_results[rid].status_code == 429))
+            self.graph.sleep(min(delay, self.graph.backoff_max))
+            pending = retry
+
+        return results
+
+
+class PropagationPending(Exception):
+    """目录对象尚未传播完成 (等待器会继续轮询)"""
+
+
+class PropagationTimeoutError(Exception):
+    """等待目录对象传播超时"""
+
+
+class PropagationWaiter:
+    """
+    目录传播等待器。
+    新创建的应用、服务主体需要一段时间才能在 Azure AD 各副本间可见。
+    按带抖动的指数退避反复调用探测函数，直到成功或超过期限，并记录每次等待实际花费的时间。
+    """
+
+    def __init__(self, timeout=180, initial_delay=0.5, max_delay=8.0, tracer=None, sleep=None):
+        self.timeout = timeout
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.tracer = tracer or Tracer(enabled=False)
+        self.sleep = sleep or time.sleep
+        self.records = []
+
+    @staticmethod
+    def is_pending_response(resp):
+        """判断 Graph 响应是否表示引用的对象尚未传播 (而不是真正的错误)"""
+        if resp.status_code == 404:
+            return True
+        if resp.status_code == 400:
+            text = resp.text.lower()
+            return any(k in text for k in ("does not exist", "not reference a valid", "not found", "invalid value specified for property"))
+        return False
+
+    def wait(self, description, probe, timeout=None):
+        """
+        probe() 返回非 None 的结果表示就绪；返回 None 或抛出 PropagationPending 表示继续等待。
+        其他异常直接向上抛出。
+        """
+        with self.tracer.span(description, "propagation") as span:
+            result = self._wait(description, probe, timeout)
+            span["attempts"] = self.records[-1]["attempts"]
+            return result
+
+    def _wait(self, description, probe, timeout):
+        import random
+        start = time.monotonic()
+        deadline = start + (timeout or self.timeout)
+        delay = self.initial_delay
+        attempts = 0
+        last_reason = None
+
+        while True:
+            attempts += 1
+            try:
+                result = probe()
+            except PropagationPending as e:
+                result = None
+                last_reason = str(e)
+
+            now = time.monotonic()
+            if result is not None:
+                self.records.append({"name": description, "elapsed": now - start, "attempts": attempts, "ok": True})
+                return result
+            if now >= deadline:
+                self.records.append({"name": description, "elapsed": now - start, "attempts": attempts, "ok": False})
+                raise PropagationTimeoutError(f"等待{description}超时 ({now - start:.0f} 秒, {attempts} 次尝试): {last_reason or '对象仍不可见'}")
+
+            self.sleep(min(delay * random.uniform(0.5, 1.5), self.max_delay, deadline - now))
+            delay = min(delay * 2, self.max_delay)
+
+    @property
+    def last_elapsed(self):
+        return self.records[-1]["elapsed"] if self.records else 0.0
+
+    def summary(self):
+        return ", ".join(f"{r['name']} {r['elapsed']:.1f} 秒 ({r['attempts']} 次{'' if r['ok'] else ', 超时'})" for r in self.records)
+
+
+class StepScheduler:
+    """
+    步骤依赖调度器。
+    每个步骤声明它依赖的步骤，调度器在线程池中并发执行所有依赖已满足的步骤，
+    总耗时由关键路径决定而不是所有步骤之和。任一步骤失败后不再启动新的步骤，等待正在执行的步骤结束后抛出第一个错误。
+    传入 executor 时步骤提交到这个共享线程池 (AsyncInstallerEngine 的有界线程池) 而不是自建线程池，
+    调用 run() 的线程不空等，而是取回还在排队的步骤自己执行，因此线程池被占满时也不会互相等待。
+    """
+
+    def __init__(self, max_workers=4, on_start=None, on_finish=None, tracer=None, executor=None):
+        self.max_workers = max_workers
+        self.executor = executor
+        self.on_start = on_start
+        self.on_finish = on_finish
+        self.tracer = tracer or Tracer(enabled=False)
+        self.steps = {}
+        self.completed = []
+
+    def add(self, name, func, depends_on=(), title=None):
+        """func(ctx) 为步骤函数；title 用于进度显示"""
+        self.steps[name] = {"name": name, "index": len(self.steps) + 1, "func": func,
+                            "deps": tuple(depends_on), "title": title or name}
+        return self
+
+    @property
+    def total(self):
+        return len(self.steps)
+
+    def _validate(self):
+        for step in self.steps.values():
+            for dep in step["deps"]:
+                if dep not in self.steps:
+                    raise ValueError(f"步骤 {step['name']} 依赖未知步骤 {dep}")
+        # 检查循环依赖 (拓扑排序)
+        remaining = {name: set(step["deps"]) for name, step in self.steps.items()}
+        while remaining:
+            ready = [name for name, deps in remaining.items() if not deps]
+            if not ready:
+                raise ValueError(f"步骤之间存在循环依赖: {', '.join(remaining)}")
+            for name in ready:
+                del remaining[name]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+
+    def run(self, ctx):
+        from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+        self._validate()
+        self.completed = []
+        if self.executor:
+            return self._run_shared(ctx)
+        done = set()
+        running = {}
+        error = None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while True:
+                if error is None:
+                    for name, step in self.steps.items():
+                        if name in done or name in running.values():
+                            continue
+                        if all(dep in done for dep in step["deps"]):
+                            if self.on_start:
+                                self.on_start(step)
+                            running[pool.submit(self._run_step, step, ctx)] = name
+
+                if not running:
+                    break
+
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = self.steps[running.pop(future)]
+                    try:
+                        future.result()
+                    except Exception as e:
+                        if error is None:
+                            error = e
+                        if self.on_finish:
+                            self.on_finish(step, e)
+                        continue
+                    done.add(step["name"])
+                    self.completed.append(step["name"])
+                    if self.on_finish:
+                        self.on_finish(step, None)
+
+        if error is not None:
+            raise error
+
+    def _run_step(self, step, ctx):
+        with self.tracer.span(step["name"], "step", title=step["title"]):
+            return step["func"](ctx)
+
+    def _run_shared(self, ctx):
+        # 步骤结束时由执行它的线程启动依赖已满足的后续步骤；调用线程执行排队中的步骤，没有可取回的步骤时才等待
+        cond = threading.Condition()
+        started, finished, errors = set(), set(), []
+        queued = {}
+
+        def start_ready():
+            if errors:
+                return
+            for name, step in self.steps.items():
+                if name not in started and all(dep in self.completed for dep in step["deps"]):
+                    started.add(name)
+                    if self.on_start:
+                        self.on_start(step)
+                    queued[name] = self.executor.submit(run_step, step)
+            cond.notify_all()
+
+        def run_step(step):
+            error = None
+            try:
+                self._run_step(step, ctx)
+            except Exception as e:
+                error = e
+            with cond:
+                queued.pop(step["name"], None)
+                finished.add(step["name"])
+                if error is None:
+                    self.completed.append(step["name"])
+                elif not errors:
+                    errors.append(error)
+                if self.on_finish:
+                    self.on_finish(step, error)
+                start_ready()
+
+        with cond:
+            start_ready()
+            while len(finished) < len(started):
+                name = next((name for name, future in queued.items() if future.cancel()), None)
+                if name is None:
+                    cond.wait()
+                    continue
+                del queued[name]
+                cond.release()
+                try:
+                    run_step(self.steps[name])
+                finally:
+                    cond.acquire()
+        if errors:
+            raise errors[0]
+
+
+def get_cloud_config(env):
+    """云环境参数"""
+    if env == "China":
+        return {
+            "authority_host": "https://login.chinacloudapi.cn",
+            "graph_endpoint": "https://microsoftgraph.chinacloudapi.cn",
+            "scope": "https://microsoftgraph.chinacloudapi.cn/.default",
+            # 修正: 21Vianet 环境参数应为 O365China
+            "exo_env_param": "-ExchangeEnvironmentName O365China",
+        }
+    return {
+        "authority_host": "https://login.microsoftonline.com",
+        "graph_endpoint": "https://graph.microsoft.com",
+        "scope": "https://graph.microsoft.com/.default",
+        "exo_env_param": "",
+    }
+
+
+def get_documents_dir():
+    """获取真实的 'My Documents' 路径 (兼容 OneDrive)"""
+    try:
+        import ctypes.wintypes
+        CSIDL_PERSONAL = 5       # My Documents
+        SHGFP_TYPE_CURRENT = 0   # Get current, not default value
+        buf = ctypes.create_unicode_buffer(ctypes.wintypes.MAX_PATH)
+        ctypes.windll.shell32.SHGetFolderPathW(None, CSIDL_PERSONAL, None, SHGFP_TYPE_CURRENT, buf)
+        return buf.value
+    except:
+        return os.path.join(os.path.expanduser("~"), "Documents")
+
+
+class FileLock:
+    """
+    跨进程文件锁 (锁文件为 <path>.lock)。
+    用于保护多个任务共享的本地文件，例如 PowerShell Profile 和模块索引。
+    """
+
+    _thread_locks = {}
+    _thread_locks_guard = threading.Lock()
+
+    def __init__(self, path, timeout=60):
+        self.lock_path = os.path.abspath(path) + ".lock"
+        self.timeout = timeout
+        self._file = None
+        with self._thread_locks_guard:
+            self._thread_lock = self._thread_locks.setdefault(self.lock_path, threading.Lock())
+
+    def acquire(self):
+        # 同一进程内的线程先通过线程锁排队，再获取跨进程的文件锁
+        if not self._thread_lock.acquire(timeout=self.timeout):
+            raise TimeoutError(f"等待文件锁超时: {self.lock_path}")
+        try:
+            os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+            self._file = open(self.lock_path, "a+")
+            deadline = time.monotonic() + self.timeout
+            while True:
+                try:
+                    if sys.platform == 'win32':
+                        import msvcrt
+                        self._file.seek(0)
+                        msvcrt.locking(self._file.fileno(), msvcrt.LK_NBLCK, 1)
+                    else:
+                        import fcntl
+                        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return self
+                except OSError:
+                    if time.monotonic() >= deadline:
+                        raise TimeoutError(f"等待文件锁超时: {self.lock_path}")
+                    time.sleep(0.1)
+        except Exception:
+            self._close()
+            self._thread_lock.release()
+            raise
+
+    def _close(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except Exception:
+                pass
+            self._file = None
+
+    def release(self):
+        if self._file is None:
+            return
+        try:
+            if sys.platform == 'win32':
+                import msvcrt
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        except OSError:
+            pass
+        self._close()
+        self._thread_lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class LogWriter:
+    """
+    异步批量日志写入器。
+    调用方只把日志记录追加到内存队列，由后台线程按固定间隔批量写入文本日志 (以及可选的 JSON Lines 结构化日志)，
+    避免每行日志都打开/追加/关闭一次文件 (每次打开都会触发杀毒软件扫描)。
+    flush() 会阻塞到队列中已有的记录全部落盘，运行结束时调用。
+    日志文件超过 max_bytes 或最早的记录超过 max_age_days 天时轮转，旧分段压缩为 <文件名>.1.gz、.2.gz ...，
+    最多保留 backup_count 个。
+    """
+
+    SEGMENT_START_RE = re.compile(r"(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})")
+
+    def __init__(self, path, json_path=None, flush_interval=0.5, max_bytes=5 * 1024 * 1024, max_age_days=30, backup_count=5):
+        self.path = path
+        self.json_path = json_path
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.backup_count = backup_count
+        self._segment_start = {}
+        self._queue = collections.deque()
+        self._wakeup = threading.Event()
+        self._written = threading.Condition()
+        self._enqueued = 0
+        self._records = 0
+        self._flushed = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="LogWriter", daemon=True)
+        self._thread.start()
+
+    @property
+    def record_count(self):
+        """已入队的结构化记录数 (不含原始文本)"""
+        return self._records
+
+    def write(self, message, level="INFO", **fields):
+        """热路径: 只做一次内存队列追加。返回记录序号，可用于从磁盘分页读取更早的记录"""
+        record = {"ts": time.time(), "level": level, "message": message}
+        if fields:
+            record.update(fields)
+        with self._written:
+            self._enqueued += 1
+            self._records += 1
+            record["seq"] = self._records
+            self._queue.append(record)
+        return record["seq"]
+
+    def write_raw(self, text):
+        """写入不带时间戳的原始文本 (例如启动横幅)，不进入结构化日志"""
+        with self._written:
+            self._enqueued += 1
+            self._queue.append({"raw": text})
+
+    @staticmethod
+    def format_text(record):
+        if "raw" in record:
+            return record["raw"]
+        ts = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record["ts"]))
+        return f"[{ts}] [{record['level']}] {record['message']}\n"
+
+    @staticmethod
+    def format_json(record):
+        ts = time.localtime(record["ts"])
+        data = dict(record)
+        data["ts"] = time.strftime('%Y-%m-%dT%H:%M:%S', ts) + f".{int(record['ts'] * 1000) % 1000:03d}" + time.strftime('%z', ts)
+        return json.dumps(data, ensure_ascii=False) + "\n"
+
+    def _get_segment_start(self, path):
+        """当前分段最早一条记录的时间 (读取文件开头的时间戳，每个分段只读一次)"""
+        if path not in self._segment_start:
+            start = time.time()
+            try:
+                with open(path, "r", encoding="utf-8", errors="replace") as f:
+                    match = self.SEGMENT_START_RE.search(f.read(512))
+                if match:
+                    start = time.mktime(time.strptime(f"{match.group(1)} {match.group(2)}", "%Y-%m-%d %H:%M:%S"))
+            except OSError:
+                pass
+            self._segment_start[path] = start
+        return self._segment_start[path]
+
+    def _rotate_if_needed(self, path):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            self._segment_start.pop(path, None)
+            return
+        too_big = self.max_bytes and size >= self.max_bytes
+        too_old = self.max_age_days and time.time() - self._get_segment_start(path) >= self.max_age_days * 86400
+        if not (too_big or too_old) or size == 0:
+            return
+
+        import gzip
+        import shutil
+        oldest = f"{path}.{self.backup_count}.gz"
+        if os.path.exists(oldest):
+            os.remove(oldest)
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{path}.{i}.gz"):
+                os.replace(f"{path}.{i}.gz", f"{path}.{i + 1}.gz")
+        with open(path, "rb") as src, gzip.open(f"{path}.1.gz", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(path)
+        self._segment_start[path] = time.time()
+
+    def _drain(self):
+        batch = []
+        while self._queue:
+            batch.append(self._queue.popleft())
+        if not batch:
+            return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            for path in (self.path, self.json_path):
+                if path:
+                    try:
+                        self._rotate_if_needed(path)
+                    except OSError:
+                        pass
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("".join(self.format_text(r) for r in batch))
+            if self.json_path:
+                records = [r for r in batch if "raw" not in r]
+                if records:
+                    with open(self.json_path, "a", encoding="utf-8") as f:
+                        f.write("".join(self.format_json(r) for r in records))
+        except Exception:
+            pass
+        finally:
+            with self._written:
+                self._flushed += len(batch)
+                self._written.notify_all()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self._drain()
+            if self._closed and not self._queue:
+                return
+
+    def flush(self, timeout=10):
+        """阻塞直到调用前已入队的记录全部写入文件"""
+        with self._written:
+            target = self._enqueued
+        self._wakeup.set()
+        deadline = time.monotonic() + timeout
+        with self._written:
+            while self._flushed < target and self._thread.is_alive():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._written.wait(remaining)
+        return True
+
+    @staticmethod
+    def _iter_lines_reversed(path, block_size=64 * 1024):
+        """从文件末尾向前逐行读取，只占用一个块大小的内存"""
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            remainder = b""
+            while position > 0:
+                read_size = min(block_size, position)
+                position -= read_size
+                f.seek(position)
+                lines = (f.read(read_size) + remainder).split(b"\n")
+                remainder = lines.pop(0)
+                for line in reversed(lines):
+                    if line.strip():
+                        yield line
+            if remainder.strip():
+                yield remainder
+
+    def read_records(self, skip, count):
+        """
+        从 JSON Lines 日志中分页读取较早的记录 (按时间倒序跳过最新的 skip 条，再取 count 条)，
+        需要时继续读取已轮转的 .gz 分段。返回按时间正序排列的记录列表。
+        """
+        if not self.json_path:
+            return []
+        self.flush()
+
+        import gzip
+
+        def segments():
+            if os.path.exists(self.json_path):
+                yield self._iter_lines_reversed(self.json_path)
+            for i in range(1, self.backup_count + 1):
+                gz_path = f"{self.json_path}.{i}.gz"
+                if not os.path.exists(gz_path):
+                    break
+                with gzip.open(gz_path, "rb") as f:
+                    yield reversed([line for line in f.read().split(b"\n") if line.strip()])
+
+        records = []
+        for lines in segments():
+            for line in lines:
+                if skip > 0:
+                    skip -= 1
+                    continue
+                try:
+                    records.append(json.loads(line.decode("utf-8")))
+                except ValueError:
+                    continue
+                if len(records) >= count:
+                    return list(reversed(records))
+        return list(reversed(records))
+
+    def close(self, timeout=10):
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join(timeout)
+
+
+class AuthRecordStore:
+    """
+    登录记录存储 (%LOCALAPPDATA%\\ConnectEXO\\auth_records.json)。
+    按云环境和账号 (租户提示 / 登录账号提示) 保存 azure-identity 的 AuthenticationRecord，
+    配合持久化的令牌缓存，后续运行可以静默获取令牌而不必再次打开浏览器。
+    记录本身不包含任何令牌，令牌由系统加密存储 (Windows 下为 DPAPI) 中的缓存保存。
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(get_app_data_dir(), "auth_records.json")
+
+    @staticmethod
+    def make_key(env, account=None):
+        return f"{env}|{(account or '').strip().lower()}"
+
+    def _read(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except Exception:
+            return {}
+
+    def load(self, env, account=None):
+        with self._lock:
+            data = self._read().get(self.make_key(env, account))
+        if not data:
+            return None
+        try:
+            from azure.identity import AuthenticationRecord
+            return AuthenticationRecord.deserialize(data)
+        except Exception:
+            return None
+
+    def save(self, env, account, record):
+        with self._lock:
+            records = self._read()
+            records[self.make_key(env, account)] = record.serialize()
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(records, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+
+
+class ModuleRegistry:
+    """
+    本机已安装模块的索引 (%LOCALAPPDATA%\\ConnectEXO\\modules.json)。
+    安装完成时写入，卸载时删除，按模块名称 (不区分大小写) 索引。
+    查询、列出和卸载模块时直接读取索引，不需要解析模块路径 (启动 PowerShell)、读取 .psm1 或遍历证书存储。
+    GUI、命令行和批量任务可能同时读写索引，所有读写都在 FileLock 保护下进行。
+    """
+
+    FIELDS = ("module_name", "env", "tenant_domain", "app_id", "app_object_id", "sp_id",
+              "thumbprint", "cert_expiry", "path", "installed_at")
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(get_app_data_dir(), "modules.json")
+
+    @staticmethod
+    def make_key(module_name):
+        return (module_name or "").strip().lower()
+
+    def _read(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f).get("modules", {})
+        except Exception:
+            return {}
+
+    def _write(self, modules):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": 1, "modules": modules}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def get(self, module_name):
+        with FileLock(self.path):
+            return self._read().get(self.make_key(module_name))
+
+    def list(self, env=None):
+        """按模块名称排序返回所有记录，指定 env 时只返回该云环境的模块"""
+        with FileLock(self.path):
+            records = list(self._read().values())
+        return sorted((r for r in records if env is None or r.get("env") == env), key=lambda r: r["module_name"].lower())
+
+    def upsert(self, module_name, replace=False, **fields):
+        """新增或更新一条记录 (只更新传入的字段，replace=True 时整条替换)，返回更新后的记录"""
+        with FileLock(self.path):
+            modules = self._read()
+            key = self.make_key(module_name)
+            record = dict({} if replace else modules.get(key) or {}, module_name=module_name)
+            record.update({k: v for k, v in fields.items() if k in self.FIELDS and v is not None})
+            modules[key] = record
+            self._write(modules)
+            return record
+
+    def remove(self, module_name):
+        """删除记录，返回被删除的记录 (不存在时返回 None)"""
+        with FileLock(self.path):
+            modules = self._read()
+            record = modules.pop(self.make_key(module_name), None)
+            if record is not None:
+                self._write(modules)
+            return record
+
+
+class TenantCacheStale(Exception):
+    """租户缓存中的 ID 在目录中已不存在"""
+
+
+class TenantCache:
+    """
+    租户元数据缓存 (%LOCALAPPDATA%\\ConnectEXO\\tenant_cache.json)，按 (Graph 终结点, 租户 ID) 索引。
+    保存很少变化的查询结果: 默认域名、Exchange Online 服务主体 ID、Exchange.ManageAsApp 角色 ID 和
+    已激活的 Exchange Administrator 角色实例 ID，重复安装时不再查询 /organization、服务主体和 directoryRoles。
+    每个字段单独记录缓存时间，超过 ttl 视为过期；使用缓存的值失败时由调用方 invalidate 整个租户的记录。
+    与模块索引一样，读写都在 FileLock 保护下进行。
+    """
+
+    FIELDS = ("tenant_domain", "exo_sp_id", "manage_as_app_role_id", "exchange_admin_role_id")
+    DEFAULT_TTL = 7 * 86400
+
+    def __init__(self, path=None, ttl=None):
+        self.path = path or os.path.join(get_app_data_dir(), "tenant_cache.json")
+        self.ttl = self.DEFAULT_TTL if ttl is None else ttl
+
+    @staticmethod
+    def make_key(graph_endpoint, tenant_id):
+        return f"{graph_endpoint.rstrip('/').lower()}|{tenant_id.strip().lower()}"
+
+    def _read(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return data.get("tenants", {}) if data.get("version") == 1 else {}
+        except Exception:
+            return {}
+
+    def _write(self, tenants):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": 1, "tenants": tenants}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def get(self, graph_endpoint, tenant_id, *fields):
+        """返回未过期且格式正确的字段 {字段: 值}；缺少的字段不出现在结果中"""
+        if not tenant_id:
+            return {}
+        with FileLock(self.path):
+            entry = self._read().get(self.make_key(graph_endpoint, tenant_id)) or {}
+        now = time.time()
+        result = {}
+        for field in fields or self.FIELDS:
+            item = entry.get(field)
+            if (isinstance(item, dict) and isinstance(item.get("value"), str) and item["value"]
+                    and isinstance(item.get("cached_at"), (int, float)) and 0 <= now - item["cached_at"] < self.ttl):
+                result[field] = item["value"]
+        return result
+
+    def update(self, graph_endpoint, tenant_id, **fields):
+        """写入查询结果 (只更新传入的非空字段)"""
+        fields = {k: v for k, v in fields.items() if k in self.FIELDS and v}
+        if not tenant_id or not fields:
+            return
+        with FileLock(self.path):
+            tenants = self._read()
+            key = self.make_key(graph_endpoint, tenant_id)
+            entry = tenants.get(key) if isinstance(tenants.get(key), dict) else {}
+            now = time.time()
+            entry.update({k: {"value": v, "cached_at": now} for k, v in fields.items()})
+            tenants[key] = entry
+            self._write(tenants)
+
+    def invalidate(self, graph_endpoint, tenant_id):
+        if not tenant_id:
+            return
+        with FileLock(self.path):
+            tenants = self._read()
+            if tenants.pop(self.make_key(graph_endpoint, tenant_id), None) is not None:
+                self._write(tenants)
+
+
+class InstallJournal:
+    """
+    安装检查点日志 (%LOCALAPPDATA%\\ConnectEXO\\journals\\<模块>_<环境>.json)。
+    每完成一个安装步骤就记录步骤名称和它产生的结果 (租户域名、证书指纹、AppID、服务主体 ID 等)，安装成功后删除。
+    安装中途失败时可以从日志恢复，跳过已完成且资源仍然存在的步骤。日志中不保存令牌和私钥。
+    同一模块可能被多个进程 (GUI、命令行、批量任务) 同时安装，读写日志时持有 FileLock。
+    """
+
+    # 可以从日志恢复到上下文中的步骤结果
+    OUTPUT_KEYS = ("tenant_domain", "thumbprint", "cert_blob", "cert_expiry", "cert_in_store",
+                   "app_id", "app_object_id", "sp_id", "role_template_id")
+
+    def __init__(self, module_name, env, path=None):
+        self.module_name = module_name
+        self.env = env
+        self.path = path or os.path.join(get_app_data_dir(), "journals", f"{module_name}_{env}.json")
+        self.data = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _read(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception:
+            return None
+        if data.get("module_name", "").lower() != self.module_name.lower() or data.get("env") != self.env:
+            return None
+        return data
+
+    def load(self):
+        """读取上次未完成的安装记录，没有记录或记录损坏时返回 None"""
+        with FileLock(self.path):
+            data = self._read()
+        if data is not None:
+            self.data = data
+        return data
+
+    def start(self, tenant=None, login_hint=None):
+        """开始新的安装记录 (覆盖旧记录)"""
+        with FileLock(self.path):
+            self.data = {"module_name": self.module_name, "env": self.env, "tenant": tenant, "login_hint": login_hint,
+                         "started_at": time.strftime('%Y-%m-%d %H:%M:%S'), "steps": {}, "outputs": {}}
+            self._write()
+
+    def is_completed(self, step_name):
+        return bool(self.data) and step_name in self.data["steps"]
+
+    def complete(self, step_name, ctx):
+        with FileLock(self.path):
+            # 同一次安装的记录可能已被其他进程 (例如恢复安装) 更新，先合并磁盘上的步骤和结果再写回
+            on_disk = self._read()
+            if on_disk and on_disk.get("started_at") == self.data.get("started_at"):
+                self.data["steps"] = dict(on_disk.get("steps", {}), **self.data["steps"])
+                self.data["outputs"] = dict(on_disk.get("outputs", {}), **self.data["outputs"])
+            self.data["steps"][step_name] = time.strftime('%Y-%m-%d %H:%M:%S')
+            self.data["outputs"].update({k: ctx[k] for k in self.OUTPUT_KEYS if ctx.get(k) is not None})
+            self._write()
+
+    def restore(self, ctx):
+        ctx.update(self.data.get("outputs", {}))
+
+    def _write(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.data["updated_at"] = time.strftime('%Y-%m-%d %H:%M:%S')
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def discard(self):
+        with FileLock(self.path):
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class PowerShellCertBackend:
+    """
+    证书生成后端: 在 PowerShell 中调用 New-SelfSignedCertificate，证书直接生成到 CurrentUser\\My 证书存储。
+    generate() 返回 {"Thumbprint", "Base64" (DER), "NotAfter"}，in_store 表示证书生成后是否已在存储中。
+    """
+
+    name = "powershell"
+    in_store = True
+
+    def __init__(self, run_powershell_script):
+        self.run_powershell_script = run_powershell_script
+
+    def generate(self, subject, years=2):
+        ps_script = f"""
+        $cert = New-SelfSignedCertificate -DnsName "{subject}" -CertStoreLocation "cert:\\CurrentUser\\My" -KeyExportPolicy Exportable -Provider "Microsoft Enhanced RSA and AES Cryptographic Provider" -NotAfter (Get-Date).AddYears({years})
+        $thumbprint = $cert.Thumbprint
+        $certContent = [System.Convert]::ToBase64String($cert.GetRawCertData())
+        $result = @{{Thumbprint=$thumbprint; Base64=$certContent; NotAfter=$cert.NotAfter.ToUniversalTime().ToString('o')}}
+        $result | ConvertTo-Json -Compress
+        """
+        return json.loads(self.run_powershell_script(ps_script))
+
+    def import_to_store(self, cert_data):
+        pass
+
+
+class CryptographyCertBackend:
+    """
+    证书生成后端: 使用 cryptography 库在进程内生成 RSA 密钥和自签名 X.509 证书，不需要启动 PowerShell，可以在 Linux 上测试。
+    Thumbprint 为 DER 编码的 SHA-1 摘要，Base64 为 DER 编码 (与 GetRawCertData() 相同，即 Graph keyCredentials 需要的格式)。
+    证书连同私钥以 PFX 形式保存在返回结果中，由 import_to_store() 单独导入 CurrentUser\\My (可以推迟到登录等待期间进行)。
+    """
+
+    name = "cryptography"
+    in_store = False
+
+    def __init__(self, run_powershell_script, key_size=2048):
+        self.run_powershell_script = run_powershell_script
+        self.key_size = key_size
+
+    @staticmethod
+    def is_available():
+        import importlib.util
+        return importlib.util.find_spec("cryptography") is not None
+
+    def generate(self, subject, years=2):
+        import datetime
+        import hashlib
+        import secrets
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        from cryptography.hazmat.primitives.serialization import pkcs12
+        from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
+
+        key = rsa.generate_private_key(public_exponent=65537, key_size=self.key_size)
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, subject)])
+        # 与 New-SelfSignedCertificate 一致: 生效时间提前 10 分钟以容忍时钟偏差，包含 DNS 名称和客户端/服务器身份验证用途
+        now = datetime.datetime.now(datetime.timezone.utc)
+        not_after = now.replace(year=now.year + years) if not (now.month == 2 and now.day == 29) else now + datetime.timedelta(days=365 * years)
+        public_key = key.public_key()
+        cert = (x509.CertificateBuilder()
+                .subject_name(name)
+                .issuer_name(name)
+                .public_key(public_key)
+                .serial_number(x509.random_serial_number())
+                .not_valid_before(now - datetime.timedelta(minutes=10))
+                .not_valid_after(not_after)
+                .add_extension(x509.SubjectAlternativeName([x509.DNSName(subject)]), critical=False)
+                .add_extension(x509.KeyUsage(digital_signature=True, key_encipherment=True, content_commitment=False,
+                                             data_encipherment=False, key_agreement=False, key_cert_sign=False,
+                                             crl_sign=False, encipher_only=False, decipher_only=False), critical=True)
+                .add_extension(x509.ExtendedKeyUsage([ExtendedKeyUsageOID.CLIENT_AUTH, ExtendedKeyUsageOID.SERVER_AUTH]), critical=False)
+                .add_extension(x509.SubjectKeyIdentifier.from_public_key(public_key), critical=False)
+                .sign(key, hashes.SHA256()))
+
+        der = cert.public_bytes(serialization.Encoding.DER)
+        # PFX 使用 3DES/SHA1 加密，旧版本 Windows 也能导入；仅在内存中传给 PowerShell，导入后即丢弃
+        password = secrets.token_urlsafe(24)
+        try:
+            encryption = (serialization.PrivateFormat.PKCS12.encryption_builder()
+                          .key_cert_algorithm(pkcs12.PBES.PBESv1SHA1And3KeyTripleDESCBC)
+                          .hmac_hash(hashes.SHA1())
+                          .build(password.encode("ascii")))
+        except AttributeError:
+            encryption = serialization.BestAvailableEncryption(password.encode("ascii"))
+        pfx = pkcs12.serialize_key_and_certificates(subject.encode("utf-8"), key, cert, None, encryption)
+
+        # 指纹与 Windows 的 Thumbprint 格式相同: DER 编码的 SHA-1，大写十六进制
+        return {"Thumbprint": hashlib.sha1(der).hexdigest().upper(), "Base64": base64.b64encode(der).decode("ascii"),
+                "NotAfter": not_after.strftime("%Y-%m-%dT%H:%M:%S.0000000Z"),
+                "Pfx": base64.b64encode(pfx).decode("ascii"), "PfxPassword": password}
+
+    def import_to_store(self, cert_data):
+        """把证书和私钥导入 CurrentUser\\My (私钥持久保存且可导出，与 New-SelfSignedCertificate 的设置相同)"""
+        ps_script = f"""
+        $flags = [System.Security.Cryptography.X509Certificates.X509KeyStorageFlags]'PersistKeySet,UserKeySet,Exportable'
+        $bytes = [System.Convert]::FromBase64String('{cert_data['Pfx']}')
+        $cert = [System.Security.Cryptography.X509Certificates.X509Certificate2]::new($bytes, '{cert_data['PfxPassword']}', $flags)
+        $store = [System.Security.Cryptography.X509Certificates.X509Store]::new('My', 'CurrentUser')
+        $store.Open('ReadWrite')
+        try {{ $store.Add($cert) }} finally {{ $store.Close() }}
+        if ($cert.Thumbprint -ne '{cert_data['Thumbprint']}') {{ throw "证书指纹不一致: $($cert.Thumbprint)" }}
+        """
+        self.run_powershell_script(ps_script)
+
+
+# 证书生成后端: auto 在安装了 cryptography 时使用进程内生成，否则使用 PowerShell
+CERT_BACKENDS = {"powershell": PowerShellCertBackend, "cryptography": CryptographyCertBackend}
+
+
+def create_cert_backend(name, run_powershell_script):
+    if name in (None, "auto"):
+        name = "cryptography" if CryptographyCertBackend.is_available() else "powershell"
+    if name not in CERT_BACKENDS:
+        raise ValueError(f"未知的证书生成方式: {name}")
+    return CERT_BACKENDS[name](run_powershell_script)
+
+
+class InstallerEngine:
+    """
+    安装/卸载引擎 (不依赖 Tk)。
+    图形界面和命令行批量模式共用，日志和进度通过回调输出；
+    PowerShell 工作进程和模块路径解析器可以在多个引擎之间共享。
+    """
+
+    # 生成的连接函数支持的连接配置 (-ConnectProfile)，Full 加载全部 cmdlet，其余只加载对应子集并跳过格式数据
+    CONNECT_PROFILES = {
+        "Full": {"commands": [], "skip_format_data": False},
+        "Mailbox": {
+            "commands": ["Get-Mailbox", "Set-Mailbox", "Get-MailboxStatistics", "Get-Recipient",
+                         "Get-MailboxPermission", "Add-MailboxPermission", "Remove-MailboxPermission",
+                         "Get-RecipientPermission", "Add-RecipientPermission", "Remove-RecipientPermission",
+                         "Get-MailboxFolderPermission", "Add-MailboxFolderPermission",
+                         "Set-MailboxFolderPermission", "Remove-MailboxFolderPermission",
+                         "Get-CASMailbox", "Set-CASMailbox", "Get-MailboxAutoReplyConfiguration",
+                         "Set-MailboxAutoReplyConfiguration"],
+            "skip_format_data": True,
+        },
+        "Transport": {
+            "commands": ["Get-TransportRule", "New-TransportRule", "Set-TransportRule", "Remove-TransportRule",
+                         "Enable-TransportRule", "Disable-TransportRule", "Get-MessageTrace",
+                         "Get-MessageTraceDetail", "Get-InboundConnector", "New-InboundConnector",
+                         "Set-InboundConnector", "Get-OutboundConnector", "New-OutboundConnector",
+                         "Set-OutboundConnector", "Get-AcceptedDomain", "Get-RemoteDomain", "Set-RemoteDomain",
+                         "Get-QuarantineMessage", "Release-QuarantineMessage"],
+            "skip_format_data": True,
+        },
+    }
+
+    # 每个模块/环境保留的耗时追踪文件数量
+    TRACE_KEEP = 20
+
+    def __init__(self, ps_host=None, path_resolver=None, on_log=None, on_progress=None, auth_records=None, trace_dir=None,
+                 registry=None, cert_backend=None, tenant_cache=None, sleep=None, executor=None):
+        self.ps_host = ps_host or PowerShellHost()
+        self.path_resolver = path_resolver or PowerShellPathResolver(get_documents_dir)
+        self.auth_records = auth_records or AuthRecordStore()
+        self.registry = registry or ModuleRegistry()
+        self.tenant_cache = tenant_cache or TenantCache()
+        # 证书生成后端: 后端实例，或 CERT_BACKENDS 中的名称 / "auto" (首次生成证书时再创建，避免启动时导入 cryptography)
+        self.cert_backend = cert_backend
+        # 每次运行的耗时追踪 (步骤、Graph 请求、PowerShell 调用)，设置 trace_dir 时导出为 Chrome trace JSON
+        self.trace_dir = trace_dir
+        self.tracer = Tracer(enabled=False)
+        # on_log(message, level) / on_progress(percent, status_text 或 None)
+        self.on_log = on_log
+        self.on_progress = on_progress
+        # 传播轮询、重试退避和限速排队的等待函数 (传给 GraphClient 和 PropagationWaiter)
+        self.sleep = sleep or time.sleep
+        # 步骤和并发 $batch 使用的共享线程池 (AsyncInstallerEngine 传入)；为 None 时每次运行自建线程池
+        self.executor = executor
+
+    @staticmethod
+    def get_app_display_name(module_name):
+        # 统一命名规则
+        return f"{module_name}-Automation-App"
+
+    @staticmethod
+    def get_cert_subject(module_name):
+        return f"{module_name}-Auto"
+
+    def log(self, message, level="INFO"):
+        if self.on_log:
+            self.on_log(message, level)
+
+    def update_progress(self, step, total_steps, message, completed=None):
+        # 并发执行步骤时，进度条按已完成的步骤数计算
+        progress = ((step if completed is None else completed) / total_steps) * 100
+        if self.on_progress:
+            self.on_progress(progress, f"步骤 {step}/{total_steps}: {message}")
+        self.log(message, level="HEADER" if ">>>" in message else "INFO")
+
+    @staticmethod
+    def _registry_info(record, exists):
+        return {"AppID": record.get("app_id"), "Thumbprint": record.get("thumbprint"), "Path": record.get("path"),
+                "Exists": exists, "ObjectID": record.get("app_object_id"), "Env": record.get("env"),
+                "TenantDomain": record.get("tenant_domain"), "CertExpiry": record.get("cert_expiry")}
+
+    def get_local_module_info(self, module_name):
+        """
+        获取本地已安装模块的 AppID 和 Thumbprint 等信息。
+        优先读取模块索引 (不启动 PowerShell)；索引中没有记录时 (旧版本安装的模块) 解析模块文件，并补录到索引中。
+        """
+        record = self.registry.get(module_name)
+        if record and record.get("path") and os.path.exists(record["path"]):
+            return self._registry_info(record, True)
+
+        base_module_path = self.get_best_module_path()
+        psm1_path = os.path.join(base_module_path, module_name, f"{module_name}.psm1")
+
+        info = {"AppID": None, "Thumbprint": None, "Path": psm1_path, "Exists": False}
+
+        if os.path.exists(psm1_path):
+            info["Exists"] = True
+            try:
+                with open(psm1_path, "r", encoding="utf-8") as f:
+                    content = f.read()
+
+                # 正则提取
+                app_id_match = re.search(r'\$AppID\s*=\s*"([^"]+)"', content, re.IGNORECASE)
+                thumb_match = re.search(r'\$Thumbprint\s*=\s*"([^"]+)"', content, re.IGNORECASE)
+                org_match = re.search(r'\$Organization\s*=\s*"([^"]+)"', content, re.IGNORECASE)
+
+                if app_id_match: info["AppID"] = app_id_match.group(1)
+                if thumb_match: info["Thumbprint"] = thumb_match.group(1)
+                if org_match: info["TenantDomain"] = org_match.group(1)
+                env_match = re.search(r'-ExchangeEnvironmentName\s+O365China', content, re.IGNORECASE)
+                info["Env"] = "China" if env_match else "Global"
+            except Exception as e:
+                self.log(f"! 解析模块文件失败: {e}", "WARNING")
+
+            if info["AppID"]:
+                self.registry.upsert(module_name, env=info.get("Env"), tenant_domain=info.get("TenantDomain"),
+                                     app_id=info["AppID"], thumbprint=info["Thumbprint"], path=psm1_path)
+        elif record:
+            # 模块文件已被手动删除，但 Azure 应用和证书可能仍然存在: 沿用索引中的记录，以便卸载时精确清理
+            return self._registry_info(record, False)
+
+        return info
+
+    @staticmethod
+    def check_module_env(local_info, env, module_name):
+        """
+        模块名称在本机唯一 (对应模块文件夹)，不区分云环境。
+        模块记录的云环境与请求的不一致时拒绝操作，避免向错误的云发送请求后把 404 当作"已删除"。
+        """
+        recorded = local_info.get("Env")
+        if recorded and recorded != env:
+            raise Exception(f"模块 {module_name} 安装在 {recorded} 云环境，与请求的 {env} 不一致，请选择正确的云环境后重试")
+
+    def list_modules(self, env=None):
+        """列出本机已安装的模块 (读取模块索引)"""
+        return self.registry.list(env)
+
+    def get_best_module_path(self):
+        """
+        获取最佳的 PowerShell 模块安装路径。
+        由 PowerShellPathResolver 解析 (启动时已在后台预热，命中缓存时不会启动任何 PowerShell 进程)。
+        """
+        return self.path_resolver.resolve()
+
+    def get_profile_path(self):
+        """
+        根据模块路径推断 Profile 路径。
+        """
+        module_path = self.get_best_module_path()
+        # module_path is usually .../Documents/PowerShell/Modules or .../Documents/WindowsPowerShell/Modules
+        
+        # Go up one level from Modules folder to get the config root
+        # .../Documents/PowerShell/Modules -> .../Documents/PowerShell
+        config_root = os.path.dirname(module_path)
+        
+        return os.path.join(config_root, "Microsoft.PowerShell_profile.ps1")
+
+    def run_powershell_script(self, script, timeout=120):
+        # 所有脚本共用同一个常驻 PowerShell 工作进程
+        # 以脚本中第一条实际命令作为追踪名称
+        lines = [l.strip() for l in script.splitlines() if l.strip() and not l.strip().startswith(("#", "$ErrorActionPreference"))]
+        with self.tracer.span(lines[0][:60] if lines else "powershell", "powershell", script_bytes=len(script.encode("utf-8"))) as span:
+            spawns = self.ps_host.spawn_count
+            output = self.ps_host.run(script, timeout=timeout)
+            span.update(output_bytes=len(output.encode("utf-8")), spawned=self.ps_host.spawn_count > spawns)
+            return output
+
+    def _start_trace(self, action, env, module_name):
+        self.tracer = Tracer(f"ConnectEXO {action} {module_name} ({env})", enabled=bool(self.trace_dir))
+        return self.tracer
+
+    def _finish_trace(self, env, module_name):
+        """导出本次运行的耗时追踪并清理同一模块/环境过旧的追踪文件"""
+        if not self.tracer.enabled:
+            return None
+        prefix = f"{module_name}_{env}_"
+        path = os.path.join(self.trace_dir, f"{prefix}{time.strftime('%Y%m%d-%H%M%S')}.trace.json")
+        try:
+            self.tracer.write(path)
+            old_traces = sorted(f for f in os.listdir(self.trace_dir) if f.startswith(prefix) and f.endswith(".trace.json"))
+            for name in old_traces[:-self.TRACE_KEEP]:
+                os.remove(os.path.join(self.trace_dir, name))
+        except Exception as e:
+            self.log(f"! 保存耗时追踪失败: {e}", "WARNING")
+            return None
+
+        parts = []
+        for category, label in (("step", "步骤"), ("http", "Graph 请求"), ("powershell", "PowerShell 调用"), ("propagation", "传播等待")):
+            count, total = self.tracer.summary(category)
+            if count:
+                parts.append(f"{label} {count} 次/{total:.1f} 秒")
+        self.log(f"耗时追踪已保存: {path} ({', '.join(parts)})")
+        return path
+
+    def _on_step_start(self, scheduler, step):
+        self.update_progress(step["index"], scheduler.total, step["title"], completed=len(scheduler.completed))
+
+    def _on_step_finish(self, scheduler, step, error):
+        if self.on_progress:
+            self.on_progress(len(scheduler.completed) / scheduler.total * 100, None)
+
+    def _run_steps(self, scheduler, ctx):
+        scheduler.on_start = lambda step: self._on_step_start(scheduler, step)
+        scheduler.on_finish = lambda step, error: self._on_step_finish(scheduler, step, error)
+        scheduler.run(ctx)
+
+    def uninstall(self, env, module_name, local_info=None, tenant=None, login_hint=None, force_login=False):
+        """卸载本地配置并删除 Azure 应用；返回结果字典，发生错误时抛出异常"""
+        app_display_name = self.get_app_display_name(module_name)
+        if local_info is None:
+            local_info = self.get_local_module_info(module_name)
+        self.check_module_env(local_info, env, module_name)
+        ctx = dict(get_cloud_config(env), env=env, module_name=module_name, app_display_name=app_display_name,
+                   cert_subject=self.get_cert_subject(module_name), local_info=local_info,
+                   tenant=tenant, login_hint=login_hint, force_login=force_login, graph=None)
+        tracer = self._start_trace("Uninstall", env, module_name)
+
+        # 本地清理步骤不依赖 Azure 登录，与浏览器登录同时进行
+        scheduler = StepScheduler(tracer=tracer, executor=self.executor)
+        scheduler.add("module", self._uninstall_module, title=f">>> 正在清理本地 PowerShell 模块 ({module_name})...")
+        scheduler.add("profile", self._uninstall_profile, title=">>> 正在清理 PowerShell Profile...")
+        scheduler.add("cert", self._uninstall_cert, title=">>> 正在清理本地证书...")
+        scheduler.add("login", self._uninstall_login, title=f">>> 正在登录 Azure ({env}) 以清理应用程序...")
+        scheduler.add("app", self._uninstall_app, depends_on=["login"], title=">>> 正在删除 Azure App...")
+
+        try:
+            with tracer.span("uninstall", "run", module_name=module_name, env=env):
+                self._run_steps(scheduler, ctx)
+            # 只有确认 Azure 应用已删除 (或本来就不存在) 时才移除索引记录，否则保留 Object ID 供下次卸载重试
+            if ctx.get("app_deleted"):
+                self.registry.remove(module_name)
+            else:
+                self.log("! Azure App 未确认删除，保留模块索引记录，可稍后重新卸载", "WARNING")
+            InstallJournal(module_name, env).discard()
+            self.update_progress(scheduler.total, scheduler.total, ">>> 卸载操作完成")
+        finally:
+            if ctx["graph"]:
+                self.log(f"Graph 请求统计: {ctx['graph'].summary()}")
+            self._finish_trace(env, module_name)
+        return {"module_name": module_name, "env": env, "app_id": local_info.get("AppID")}
+
+    def _uninstall_module(self, ctx):
+        base_module_path = self.get_best_module_path()
+        module_path = os.path.join(base_module_path, ctx["module_name"])
+        
+        if os.path.exists(module_path):
+            try:
+                import shutil
+                shutil.rmtree(module_path)
+                self.log(f"√ 已删除本地模块文件夹: {module_path}", "SUCCESS")
+            except Exception as e:
+                self.log(f"X 删除模块文件夹失败: {e}", "ERROR")
+        else:
+            self.log(f"! 本地模块文件夹不存在，跳过: {module_path}", "WARNING")
+
+    def _uninstall_profile(self, ctx):
+        module_name = ctx["module_name"]
+        profile_path = self.get_profile_path()
+        if os.path.exists(profile_path):
+            try:
+                # 批量模式下多个任务可能同时修改 Profile，读写期间持有文件锁
+                with FileLock(profile_path):
+                    # 读取所有行
+                    with open(profile_path, "r", encoding="utf-8-sig") as f:
+                        lines = f.readlines()
+                
+                    # 过滤掉包含模块名称的行 (精确匹配)
+                    new_lines = []
+                    removed_count = 0
+                    for line in lines:
+                        # 使用更严格的正则: 匹配 (行首或空白) + 模块名 + (空白或行尾)
+                        pattern = rf"(?i)(^|\s){re.escape(module_name)}(\s|$)"
+                        if re.search(pattern, line):
+                            removed_count += 1
+                            self.log(f"  - 移除 Profile 行: {line.strip()}")
+                        else:
+                            new_lines.append(line)
+                
+                    if removed_count > 0:
+                        with open(profile_path, "w", encoding="utf-8-sig") as f:
+                            f.writelines(new_lines)
+                        self.log(f"√ 已从 Profile 中移除 {removed_count} 行配置", "SUCCESS")
+                    else:
+                        self.log("Profile 中没有该模块的配置，无需修改")
+            except Exception as e:
+                self.log(f"X 修改 Profile 失败: {e}", "ERROR")
+        else:
+            self.log("! 未找到 PowerShell Profile 文件，跳过", "WARNING")
+
+    def _uninstall_cert(self, ctx):
+        thumbprint_to_delete = ctx["local_info"].get("Thumbprint")
+        cert_subject = ctx["cert_subject"]
+        
+        try:
+            if thumbprint_to_delete:
+                self.log(f"正在根据指纹删除证书: {thumbprint_to_delete}")
+                # 按指纹直接定位证书，不遍历整个证书存储
+                ps_script = f"Remove-Item -Path 'Cert:\\CurrentUser\\My\\{thumbprint_to_delete}' -ErrorAction SilentlyContinue"
+                self.run_powershell_script(ps_script)
+                self.log("√ 已尝试删除指定指纹的证书", "SUCCESS")
+            else:
+                # 如果没有指纹，尝试按 Subject 删除
+                self.log(f"未找到本地指纹记录，尝试按 Subject 删除: {cert_subject}")
+                ps_script = f"Get-ChildItem Cert:\\CurrentUser\\My | Where-Object {{ $_.Subject -like '*{cert_subject}*' }} | Remove-Item"
+                self.run_powershell_script(ps_script)
+                self.log("√ 已尝试删除匹配 Subject 的证书", "SUCCESS")
+        except Exception as e:
+            self.log(f"X 删除证书失败: {e}", "WARNING")
+
+    def _uninstall_login(self, ctx):
+        try:
+            credential = self.get_credential(ctx)
+            token = credential.get_token(ctx["scope"])
+            ctx["graph"] = GraphClient(ctx["graph_endpoint"], token.token, tracer=self.tracer, tenant=ctx.get("tenant"), sleep=self.sleep)
+            self.log("√ Azure 登录成功", "SUCCESS")
+        except Exception as e:
+            self.log(f"X Azure 操作失败 (可能是登录取消或网络问题): {e}", "ERROR")
+
+    def _uninstall_app(self, ctx):
+        graph = ctx["graph"]
+        if graph is None:
+            self.log("! 未登录 Azure，跳过删除 Azure App", "WARNING")
+            return
+
+        app_display_name = ctx["app_display_name"]
+        app_id_to_delete = ctx["local_info"].get("AppID")
+        
+        object_id = ctx["local_info"].get("ObjectID")
+
+        try:
+            if object_id:
+                # 模块索引中记录了应用的 Object ID，直接删除，不需要先查询
+                self.log(f">>> 正在根据 Object ID 删除 Azure App ({object_id})...", "HEADER")
+                del_resp = graph.delete(f"/v1.0/applications/{object_id}")
+                if del_resp.status_code == 204:
+                    ctx["app_deleted"] = True
+                    self.log(f"√ 已删除 Azure App (AppID: {app_id_to_delete})", "SUCCESS")
+                elif del_resp.status_code == 404:
+                    ctx["app_deleted"] = True
+                    self.log(f"! 未找到 Object ID 为 {object_id} 的应用 (可能已被删除)", "WARNING")
+                else:
+                    self.log(f"X 删除 Azure App 失败: {del_resp.text}", "ERROR")
+            elif app_id_to_delete:
+                self.log(f">>> 正在根据 AppID 删除 Azure App ({app_id_to_delete})...", "HEADER")
+                # 直接按 AppID (Client ID) 查询 Object ID
+                resp = graph.get(f"/v1.0/applications?$filter=appId eq '{app_id_to_delete}'")
+                if resp.status_code == 200:
+                    apps = resp.json().get('value', [])
+                    if apps:
+                        obj_id = apps[0]['id']
+                        del_resp = graph.delete(f"/v1.0/applications/{obj_id}")
+                        if del_resp.status_code in (204, 404):
+                            ctx["app_deleted"] = True
+                            self.log(f"√ 已删除 Azure App (AppID: {app_id_to_delete})", "SUCCESS")
+                        else:
+                            self.log(f"X 删除 Azure App 失败: {del_resp.text}", "ERROR")
+                    else:
+                        ctx["app_deleted"] = True
+                        self.log(f"! 未找到 AppID 为 {app_id_to_delete} 的应用", "WARNING")
+                else:
+                    self.log(f"X 查询 App 失败: {resp.text}", "ERROR")
+            else:
+                # Fallback: 按名称删除
+                self.log(f">>> 正在根据名称查找并删除 Azure App ({app_display_name})...", "HEADER")
+                apps = list(graph.get_all(f"/v1.0/applications?$filter=displayName eq '{app_display_name}'&$select=id,appId,displayName"))
+                if apps:
+                    _, failed = self._delete_applications(graph, apps)
+                    ctx["app_deleted"] = not failed
+                else:
+                    ctx["app_deleted"] = True
+                    self.log(f"! 未找到名为 {app_display_name} 的 Azure App", "WARNING")
+
+        except Exception as e:
+            self.log(f"X Azure 操作失败 (可能是登录取消或网络问题): {e}", "ERROR")
+
+    def find_orphan_apps(self, graph):
+        """
+        流式读取租户中所有符合命名规则 (<模块名>-Automation-App) 的应用，并与本机已安装的模块对照:
+        本机模块文件中记录的 AppID 与应用一致时视为在用，其余视为孤立应用。
+        返回 (孤立应用列表, 在用应用列表)。
+        """
+        suffix = self.get_app_display_name("")
+        name_pattern = re.compile(rf"^([A-Za-z0-9]+){re.escape(suffix)}$")
+        select = "$select=id,appId,displayName,createdDateTime&$top=999"
+        # 优先使用高级查询在服务端按后缀过滤；不支持时 (例如部分国家云) 退回读取全部应用后在本地过滤
+        try:
+            apps = list(self._iter_apps(graph, f"/v1.0/applications?$filter=endswith(displayName,'{suffix}')&$count=true&{select}",
+                                        headers={"ConsistencyLevel": "eventual"}))
+        except Exception as e:
+            self.log(f"! 服务端后缀过滤不可用，改为分页读取全部应用: {e}", "WARNING")
+            apps = list(self._iter_apps(graph, f"/v1.0/applications?{select}"))
+
+        orphans, in_use = [], []
+        local_cache = {}
+        for app in apps:
+            match = name_pattern.match(app.get("displayName") or "")
+            if not match:
+                continue
+            module_name = match.group(1)
+            if module_name not in local_cache:
+                local_cache[module_name] = self.get_local_module_info(module_name)
+            local_info = local_cache[module_name]
+            app = dict(app, module_name=module_name)
+            if local_info["Exists"] and (local_info["AppID"] or "").lower() == (app.get("appId") or "").lower():
+                in_use.append(app)
+            else:
+                orphans.append(app)
+        return orphans, in_use
+
+    def _iter_apps(self, graph, path, headers=None):
+        count = 0
+        for app in graph.get_all(path, headers=headers):
+            count += 1
+            if count % 1000 == 0:
+                self.log(f"已读取 {count} 个应用...")
+            yield app
+
+    def cleanup_orphans(self, env, tenant=None, login_hint=None, dry_run=True, orphans=None, force_login=False):
+        """
+        清理孤立的 <模块名>-Automation-App 应用 (本机已没有对应模块，或模块记录的 AppID 不同)。
+        dry_run=True 时只列出将要删除的应用；传入 orphans (预览结果) 时直接删除这些应用而不重新查询。
+        注意: 只能与本机的模块对照，其他电脑上仍在使用的应用也会被视为孤立应用，请先预览确认。
+        """
+        ctx = dict(get_cloud_config(env), env=env, tenant=tenant, login_hint=login_hint, force_login=force_login)
+        tracer = self._start_trace("Cleanup", env, "Fleet")
+        try:
+            with tracer.span("cleanup", "run", env=env, dry_run=dry_run):
+                self.log(f">>> 正在登录 Azure ({env}) 以查找孤立应用...", "HEADER")
+                credential = self.get_credential(ctx)
+                token = credential.get_token(ctx["scope"])
+                graph = GraphClient(ctx["graph_endpoint"], token.token, tracer=tracer, tenant=ctx.get("tenant"), sleep=self.sleep)
+
+                in_use = []
+                if orphans is None:
+                    self.log(">>> 正在查找符合命名规则的应用并与本机模块对照...", "HEADER")
+                    orphans, in_use = self.find_orphan_apps(graph)
+                    self.log(f"找到 {len(orphans) + len(in_use)} 个 *-Automation-App 应用: 在用 {len(in_use)} 个，孤立 {len(orphans)} 个")
+                result = {"env": env, "orphans": orphans, "in_use": in_use, "deleted": 0, "failed": 0, "dry_run": dry_run}
+
+                if dry_run:
+                    for app in orphans:
+                        self.log(f"  [预览] {app['displayName']} (AppID: {app['appId']}, 创建于 {app.get('createdDateTime') or '未知'})")
+                    return result
+                if orphans:
+                    self.log(f">>> 正在批量删除 {len(orphans)} 个孤立应用...", "HEADER")
+                    result["deleted"], result["failed"] = self._delete_applications(graph, orphans)
+                self.log(f"√ 清理完成: 删除 {result['deleted']} 个，失败 {result['failed']} 个 (Graph: {graph.summary()})", "SUCCESS")
+                return result
+        finally:
+            self._finish_trace(env, "Fleet")
+
+    def install(self, env, module_name, tenant=None, login_hint=None, force_login=False, resume=False):
+        """
+        完整安装 (覆盖同名旧配置)；返回结果字典，发生错误时抛出异常。
+        resume=True 时读取上次失败的安装记录，跳过已完成且资源仍然存在的步骤 (登录除外)。
+        """
+        app_display_name = self.get_app_display_name(module_name)
+        ctx = dict(get_cloud_config(env), env=env, module_name=module_name, app_display_name=app_display_name,
+                   cert_subject=self.get_cert_subject(module_name), tenant=tenant, login_hint=login_hint,
+                   force_login=force_login, graph=None, resume_checks={}, resume_redone=set())
+        journal = InstallJournal(module_name, env)
+        if resume and journal.load():
+            self.log(f">>> 继续上次未完成的安装 (开始于 {journal.data['started_at']}，"
+                     f"已完成 {len(journal.data['steps'])} 个步骤)", "HEADER")
+            journal.restore(ctx)
+        else:
+            if resume:
+                self.log("! 没有找到未完成的安装记录，将执行完整安装", "WARNING")
+            journal.start(tenant, login_hint)
+        tracer = self._start_trace("Install", env, module_name)
+        ctx["waiter"] = PropagationWaiter(tracer=tracer, sleep=self.sleep)
+
+        # 步骤依赖关系: 证书生成 (4)、证书导入存储与 ExchangeOnlineManagement 模块安装 (8) 不需要 Azure 令牌，与登录同时进行。
+        # 默认在进程内生成证书 (不启动 PowerShell)，只有导入证书存储需要 PowerShell，且不在创建应用的关键路径上
+        scheduler = StepScheduler(tracer=tracer, executor=self.executor)
+        scheduler.add("login", self._setup_login, title=f">>> 正在启动 Azure ({env}) 浏览器登录...")
+        scheduler.add("tenant", self._setup_tenant, depends_on=["login"], title=">>> 获取租户信息...")
+        scheduler.add("cleanup", self._setup_cleanup, depends_on=["login"], title=f">>> 检查并清理旧配置 ({app_display_name})...")
+        scheduler.add("cert", self._setup_cert, title=">>> 本地生成自签名证书...")
+        scheduler.add("app", self._setup_app, depends_on=["cleanup", "cert"], title=">>> 创建 Azure AD 应用程序...")
+        scheduler.add("sp", self._setup_service_principal, depends_on=["app"], title=">>> 创建服务主体 (Service Principal)...")
+        scheduler.add("permissions", self._setup_permissions, depends_on=["sp"], title=">>> 授予 Exchange.ManageAsApp 权限...")
+        scheduler.add("cert_store", self._setup_cert_store, depends_on=["cert"], title=">>> 导入证书到本地证书存储...")
+        scheduler.add("exo_module", self._setup_exo_module, title=">>> 检查 ExchangeOnlineManagement 模块...")
+        scheduler.add("role", self._setup_role, depends_on=["permissions"], title=">>> 分配 Exchange Administrator 角色...")
+        scheduler.add("local", self._setup_local_module, depends_on=["tenant", "role", "cert_store"], title=f">>> 生成本地连接脚本 ({module_name})...")
+        for step in scheduler.steps.values():
+            step["func"] = self._journaled_step(journal, step)
+
+        try:
+            with tracer.span("install", "run", module_name=module_name, env=env):
+                self._run_steps(scheduler, ctx)
+        except Exception:
+            self._discard_unused_cert(ctx)
+            self.log("! 已完成的步骤已记录，排除问题后可选择继续安装 (命令行: --resume)，跳过已完成的步骤", "WARNING")
+            raise
+        else:
+            journal.discard()
+        finally:
+            if ctx["waiter"].records:
+                self.log(f"传播等待统计: {ctx['waiter'].summary()}")
+            if ctx["graph"]:
+                self.log(f"Graph 请求统计: {ctx['graph'].summary()}")
+            self._finish_trace(env, module_name)
+
+        return {"module_name": module_name, "env": env, "tenant_domain": ctx.get("tenant_domain"),
+                "app_id": ctx.get("app_id"), "sp_id": ctx.get("sp_id"), "thumbprint": ctx.get("thumbprint")}
+
+    # 继续安装时总是重新执行的步骤 (令牌不保存在记录中)，它们重新执行不影响依赖它们的步骤
+    RESUME_ALWAYS_RUN = ("login",)
+
+    def _journaled_step(self, journal, step):
+        """包装安装步骤: 完成后写入检查点；继续安装时跳过已完成、依赖未重新执行且资源仍然存在的步骤"""
+        func, name = step["func"], step["name"]
+        deps = [dep for dep in step["deps"] if dep not in self.RESUME_ALWAYS_RUN]
+
+        def run(ctx):
+            redone = ctx["resume_redone"]
+            if (name not in self.RESUME_ALWAYS_RUN and journal.is_completed(name)
+                    and not any(dep in redone for dep in deps) and self._resume_step_valid(ctx, journal, name)):
+                self.log(f"√ 跳过已完成的步骤: {step['title'].strip('.> ')}", "SUCCESS")
+                return
+            redone.add(name)
+            func(ctx)
+            if name not in self.RESUME_ALWAYS_RUN:
+                journal.complete(name, ctx)
+
+        return run
+
+    def _resume_step_valid(self, ctx, journal, name):
+        """检查已完成步骤创建的资源是否仍然存在"""
+        if name == "tenant":
+            return bool(ctx.get("tenant_domain"))
+        if name in ("cert", "cert_store"):
+            return self._resume_check(ctx, "cert", lambda: self._resume_cert_exists(ctx, journal))
+        if name in ("cleanup", "app"):
+            # 应用需要重新创建时，同名清理也要重新执行 (删除上次创建的应用)
+            return self._resume_check(ctx, "app", lambda: self._resume_step_valid(ctx, journal, "cert") and
+                                      journal.is_completed("app") and self._resume_app_exists(ctx))
+        if name == "sp":
+            return self._resume_check(ctx, "sp", lambda: self._resume_object_exists(ctx, f"/v1.0/servicePrincipals/{ctx.get('sp_id')}?$select=id,appId",
+                                                                                 ctx.get("sp_id")))
+        if name in ("permissions", "role", "exo_module"):
+            # 权限授予、角色成员和模块安装可能在上次运行后被移除，且重复执行是幂等的 (已存在时返回 409/already exists)，总是重新执行
+            return False
+        return True
+
+    @staticmethod
+    def _resume_check(ctx, key, check):
+        # 检查结果在同一次运行中缓存 (例如 cleanup 和 app 共用应用检查)
+        checks = ctx["resume_checks"]
+        if key not in checks:
+            checks[key] = bool(check())
+        return checks[key]
+
+    def _resume_cert_exists(self, ctx, journal):
+        thumbprint = ctx.get("thumbprint")
+        if not thumbprint or not journal.is_completed("cert_store"):
+            return False
+        output = self.run_powershell_script(f"Test-Path -Path 'Cert:\\CurrentUser\\My\\{thumbprint}'")
+        if output.strip().lower() != "true":
+            self.log(f"! 上次生成的证书已不在证书存储中 (指纹: {thumbprint})，将重新生成", "WARNING")
+            return False
+        return True
+
+    def _resume_app_exists(self, ctx):
+        return self._resume_object_exists(ctx, f"/v1.0/applications/{ctx.get('app_object_id')}?$select=id,appId", ctx.get("app_object_id"))
+
+    def _resume_object_exists(self, ctx, path, object_id):
+        if not object_id:
+            return False
+        resp = ctx["graph"].get(path)
+        if resp.status_code == 200 and (resp.json().get("appId") or "").lower() == (ctx.get("app_id") or "").lower():
+            return True
+        self.log(f"! 上次创建的对象已不存在 ({object_id})，将重新创建", "WARNING")
+        return False
+
+    def has_unfinished_install(self, env, module_name):
+        """是否有上次失败后未完成的安装记录"""
+        return InstallJournal(module_name, env).load() is not None
+
+    def rotate(self, env, module_name, tenant=None, login_hint=None, force_login=False):
+        """
+        更换证书: 为本地模块记录的现有应用添加新证书，确认生效后再移除旧证书，只修改 .psm1 中的指纹。
+        不重建应用、服务主体、API 权限和角色，因此没有角色重新传播的等待。返回结果字典，发生错误时抛出异常。
+        """
+        local_info = self.get_local_module_info(module_name)
+        if not local_info["Exists"] or not local_info["AppID"]:
+            raise Exception(f"本地未找到模块 {module_name} 或模块中没有 AppID 记录，无法更换证书，请使用安装")
+        self.check_module_env(local_info, env, module_name)
+        ctx = dict(get_cloud_config(env), env=env, module_name=module_name,
+                   app_display_name=self.get_app_display_name(module_name), cert_subject=self.get_cert_subject(module_name),
+                   local_info=local_info, old_thumbprint=local_info["Thumbprint"], tenant=tenant, login_hint=login_hint,
+                   force_login=force_login, graph=None)
+        tracer = self._start_trace("Rotate", env, module_name)
+        ctx["waiter"] = PropagationWaiter(timeout=60, tracer=tracer, sleep=self.sleep)
+
+        # 先确认本地能读取当前证书 (重新提交 keyCredentials 需要它的公钥)，读取不到时在登录和生成新证书之前失败
+        scheduler = StepScheduler(tracer=tracer, executor=self.executor)
+        scheduler.add("old_cert", self._rotate_read_old_cert, title=">>> 读取当前证书...")
+        scheduler.add("login", self._setup_login, depends_on=["old_cert"], title=f">>> 正在登录 Azure ({env})...")
+        scheduler.add("cert", self._setup_cert, depends_on=["old_cert"], title=">>> 本地生成新的自签名证书...")
+        scheduler.add("cert_store", self._setup_cert_store, depends_on=["cert"], title=">>> 导入证书到本地证书存储...")
+        scheduler.add("find_app", self._rotate_find_app, depends_on=["login"], title=f">>> 查找现有应用 (AppID: {local_info['AppID']})...")
+        scheduler.add("add_key", self._rotate_add_key, depends_on=["find_app", "cert", "old_cert"], title=">>> 为应用添加新证书...")
+        scheduler.add("verify_key", self._rotate_verify_key, depends_on=["add_key"], title=">>> 确认新证书已生效...")
+        scheduler.add("local", self._rotate_local_module, depends_on=["verify_key", "cert_store"], title=f">>> 更新本地连接脚本中的指纹 ({module_name})...")
+        scheduler.add("remove_old_key", self._rotate_remove_old_key, depends_on=["local"], title=">>> 从应用中移除旧证书...")
+        scheduler.add("remove_old_cert", self._rotate_remove_old_cert, depends_on=["remove_old_key"], title=">>> 删除本地旧证书...")
+
+        try:
+            with tracer.span("rotate", "run", module_name=module_name, env=env):
+                self._run_steps(scheduler, ctx)
+            self.update_progress(scheduler.total, scheduler.total, ">>> 证书更换完成")
+        except Exception:
+            self._rotate_rollback(ctx)
+            raise
+        finally:
+            if ctx["graph"]:
+                self.log(f"Graph 请求统计: {ctx['graph'].summary()}")
+            self._finish_trace(env, module_name)
+
+        return {"module_name": module_name, "env": env, "app_id": ctx.get("app_id"),
+                "thumbprint": ctx.get("thumbprint"), "old_thumbprint": ctx.get("old_thumbprint"), "cert_expiry": ctx.get("cert_expiry")}
+
+    @staticmethod
+    def _key_credential(cert_blob, cert_subject, key_id=None):
+        credential = {"type": "AsymmetricX509Cert", "usage": "Verify", "key": cert_blob, "displayName": f"{cert_subject}-Cert"}
+        if key_id:
+            credential["keyId"] = key_id
+        return credential
+
+    @staticmethod
+    def _key_thumbprint(credential):
+        # Graph 把证书指纹 (SHA-1) 以 Base64 形式保存在 customKeyIdentifier 中
+        try:
+            return base64.b64decode(credential.get("customKeyIdentifier") or "").hex().upper() or None
+        except Exception:
+            return None
+
+    def _rotate_read_old_cert(self, ctx):
+        # 修改 keyCredentials 需要提交完整列表 (Graph 读取时不返回证书内容)，因此从本地证书存储按指纹读取当前证书的公钥
+        thumbprint = ctx["old_thumbprint"]
+        ctx["old_cert_blob"] = None
+        if thumbprint:
+            ps_script = f"""
+            $cert = Get-Item -Path 'Cert:\\CurrentUser\\My\\{thumbprint}' -ErrorAction SilentlyContinue
+            if ($cert) {{ [System.Convert]::ToBase64String($cert.RawData) }}
+            """
+            ctx["old_cert_blob"] = self.run_powershell_script(ps_script).strip() or None
+        if not ctx["old_cert_blob"]:
+            # keyCredentials 只能整体替换: 没有当前证书的公钥就无法在新证书生效前保留它，模块会在更换期间无法连接
+            raise Exception(f"本地证书存储中没有当前证书 (指纹: {thumbprint or '未记录'})，无法在保留当前证书的前提下更换。"
+                            "请在安装该模块的电脑上执行更换证书，或重新安装。")
+        self.log(f"√ 已读取当前证书 (指纹: {thumbprint})", "SUCCESS")
+
+    def _rotate_find_app(self, ctx):
+        graph = ctx["graph"]
+        local_info = ctx["local_info"]
+        select = "$select=id,appId,displayName,keyCredentials"
+        app = None
+        if local_info.get("ObjectID"):
+            resp = graph.get(f"/v1.0/applications/{local_info['ObjectID']}?{select}")
+            if resp.status_code == 200 and (resp.json().get("appId") or "").lower() == local_info["AppID"].lower():
+                app = resp.json()
+        if app is None:
+            resp = graph.get(f"/v1.0/applications?$filter=appId eq '{local_info['AppID']}'&{select}")
+            if resp.status_code != 200:
+                raise Exception(f"查询应用失败: {resp.text}")
+            apps = resp.json().get("value", [])
+            if not apps:
+                raise Exception(f"云端未找到 AppID 为 {local_info['AppID']} 的应用，无法更换证书，请使用安装")
+            app = apps[0]
+        ctx["app_id"] = app["appId"]
+        ctx["app_object_id"] = app["id"]
+        ctx["existing_keys"] = app.get("keyCredentials") or []
+        self.log(f"√ 找到应用 {app.get('displayName')} (现有证书 {len(ctx['existing_keys'])} 个)", "SUCCESS")
+
+    def _rotate_add_key(self, ctx):
+        old_thumbprint = (ctx["old_thumbprint"] or "").upper()
+        keys = []
+        missing = []
+        for credential in ctx["existing_keys"]:
+            if old_thumbprint and self._key_thumbprint(credential) == old_thumbprint and ctx["old_cert_blob"]:
+                # 保留旧证书 (沿用原来的 keyId)，确认新证书生效后再移除
+                keys.append(self._key_credential(ctx["old_cert_blob"], ctx["cert_subject"], credential.get("keyId")))
+            else:
+                missing.append(self._key_thumbprint(credential) or credential.get("keyId"))
+        if missing:
+            # keyCredentials 只能整体替换，本地没有公钥的证书无法重新提交: 继续会在新证书生效前删掉它们 (包括当前正在使用的证书)
+            raise Exception(f"应用上有 {len(missing)} 个证书在本地证书存储中找不到 ({', '.join(missing)})，"
+                            "无法在保留现有证书的前提下添加新证书。请先在 Azure 门户中删除不再使用的证书，"
+                            "或在原电脑上执行更换证书，或重新安装。")
+
+        ctx["new_key_id"] = str(uuid.uuid4())
+        ctx["rollback_keys"] = list(keys)
+        keys.append(self._key_credential(ctx["cert_blob"], ctx["cert_subject"], ctx["new_key_id"]))
+        resp = ctx["graph"].patch(f"/v1.0/applications/{ctx['app_object_id']}", json={"keyCredentials": keys})
+        if resp.status_code != 204:
+            raise Exception(f"添加新证书失败: {resp.text}")
+        ctx["key_added"] = True
+        self.log(f"√ 已添加新证书 (指纹: {ctx['thumbprint']}，保留旧证书 {len(keys) - 1} 个)", "SUCCESS")
+
+    def _rotate_verify_key(self, ctx):
+        graph = ctx["graph"]
+
+        def probe():
+            resp = graph.get(f"/v1.0/applications/{ctx['app_object_id']}?$select=keyCredentials")
+            if resp.status_code != 200:
+                if PropagationWaiter.is_pending_response(resp):
+                    raise PropagationPending(resp.text)
+                raise Exception(f"查询应用证书失败: {resp.text}")
+            for credential in resp.json().get("keyCredentials") or []:
+                if credential.get("keyId") == ctx["new_key_id"] or self._key_thumbprint(credential) == ctx["thumbprint"].upper():
+                    return credential
+            raise PropagationPending("新证书尚未出现在应用中")
+
+        credential = ctx["waiter"].wait("证书更新", probe)
+        self.log(f"√ 新证书已生效 (有效期至 {(credential.get('endDateTime') or ctx.get('cert_expiry') or '未知')[:10]})", "SUCCESS")
+
+    def _rotate_local_module(self, ctx):
+        psm1_path = ctx["local_info"]["Path"]
+        with open(psm1_path, "r", encoding="utf-8") as f:
+            content = f.read()
+        new_content, count = re.subn(r'(\[string\]\$Thumbprint\s*=\s*")[^"]*(")', rf'\g<1>{ctx["thumbprint"]}\g<2>', content, count=1)
+        if not count:
+            raise Exception(f"模块文件中没有找到证书指纹: {psm1_path}")
+        with open(psm1_path, "w", encoding="utf-8") as f:
+            f.write(new_content)
+        ctx["local_updated"] = True
+        self.registry.upsert(ctx["module_name"], env=ctx["env"], app_id=ctx["app_id"], app_object_id=ctx["app_object_id"],
+                             thumbprint=ctx["thumbprint"], cert_expiry=ctx.get("cert_expiry"), path=psm1_path)
+        self.log(f"√ 已更新本地连接脚本中的指纹: {psm1_path}", "SUCCESS")
+
+    def _rotate_remove_old_key(self, ctx):
+        key = self._key_credential(ctx["cert_blob"], ctx["cert_subject"], ctx["new_key_id"])
+        resp = ctx["graph"].patch(f"/v1.0/applications/{ctx['app_object_id']}", json={"keyCredentials": [key]})
+        if resp.status_code != 204:
+            # 新证书已经生效，旧证书留在应用上不影响连接，只提示手动清理
+            self.log(f"! 移除旧证书失败，可稍后在 Azure 门户中手动删除: {resp.text}", "WARNING")
+            return
+        self.log("√ 已从应用中移除旧证书", "SUCCESS")
+
+    def _rotate_remove_old_cert(self, ctx):
+        old_thumbprint = ctx["old_thumbprint"]
+        if not old_thumbprint or old_thumbprint.upper() == ctx["thumbprint"].upper():
+            return
+        try:
+            self.run_powershell_script(f"Remove-Item -Path 'Cert:\\CurrentUser\\My\\{old_thumbprint}' -ErrorAction SilentlyContinue")
+            self.log(f"√ 已删除本地旧证书 (指纹: {old_thumbprint})", "SUCCESS")
+        except Exception as e:
+            self.log(f"! 删除本地旧证书失败: {e}", "WARNING")
+
+    def _rotate_rollback(self, ctx):
+        # 本地脚本还没有切换到新证书时出错: 撤销已添加的新证书，模块继续使用旧证书
+        if ctx.get("local_updated"):
+            return
+        if ctx.get("key_added") and "rollback_keys" in ctx:
+            try:
+                resp = ctx["graph"].patch(f"/v1.0/applications/{ctx['app_object_id']}", json={"keyCredentials": ctx["rollback_keys"]})
+                if resp.status_code == 204:
+                    self.log("! 已撤销添加到应用的新证书，模块继续使用原证书", "WARNING")
+            except Exception as e:
+                self.log(f"X 撤销新证书失败: {e}", "WARNING")
+        if ctx.get("cert_in_store") and ctx.get("thumbprint"):
+            try:
+                self.run_powershell_script(f"Remove-Item -Path 'Cert:\\CurrentUser\\My\\{ctx['thumbprint']}' -ErrorAction SilentlyContinue")
+                self.log(f"! 已删除未使用的本地证书 (指纹: {ctx['thumbprint']})", "WARNING")
+            except Exception as e:
+                self.log(f"X 删除未使用的本地证书失败: {e}", "WARNING")
+
+    # Exchange Online 应用 ID (Global 与 China 相同) 和 Exchange Administrator 角色模板 ID
+    EXO_APP_ID = "00000002-0000-0ff1-ce00-000000000000"
+    EXCHANGE_ADMIN_ROLE_TEMPLATE_ID = "29232cdf-9323-42fd-ade2-1d097af3e4de"
+    # 证书剩余有效期少于该天数时给出警告
+    CERT_EXPIRY_WARNING_DAYS = 30
+
+    def verify(self, env, module_name, tenant=None, login_hint=None, force_login=False):
+        """
+        只读检查现有安装是否正常: 本地模块文件和 Profile、本地证书、Azure 应用及其证书、服务主体、API 权限和角色分配。
+        本地检查与登录同时进行，Graph 检查合并为一到两次 $batch 往返。不修改任何配置。
+        返回 {"ok", "checks": [{"name", "status" (pass/warn/fail), "detail", "elapsed"}]}。
+        """
+        local_info = self.get_local_module_info(module_name)
+        self.check_module_env(local_info, env, module_name)
+        ctx = dict(get_cloud_config(env), env=env, module_name=module_name, local_info=local_info,
+                   tenant=tenant, login_hint=login_hint, force_login=force_login, graph=None, checks=[])
+        tracer = self._start_trace("Verify", env, module_name)
+
+        scheduler = StepScheduler(tracer=tracer, executor=self.executor)
+        scheduler.add("local", self._verify_local_module, title=f">>> 检查本地模块 ({module_name})...")
+        scheduler.add("cert", self._verify_local_cert, title=">>> 检查本地证书...")
+        if local_info["AppID"]:
+            scheduler.add("login", self._setup_login, title=f">>> 正在登录 Azure ({env})...")
+            scheduler.add("graph", self._verify_graph, depends_on=["login", "cert"], title=">>> 检查 Azure 应用、权限和角色...")
+
+        try:
+            with tracer.span("verify", "run", module_name=module_name, env=env):
+                self._run_steps(scheduler, ctx)
+        finally:
+            self._finish_trace(env, module_name)
+
+        checks = ctx["checks"]
+        ok = all(c["status"] != "fail" for c in checks)
+        self.log("-" * 30)
+        for c in checks:
+            marker = {"pass": "√", "warn": "!", "fail": "X"}[c["status"]]
+            level = {"pass": "SUCCESS", "warn": "WARNING", "fail": "ERROR"}[c["status"]]
+            self.log(f"{marker} [{c['elapsed'] * 1000:6.0f} ms] {c['name']}: {c['detail']}", level)
+        self.update_progress(scheduler.total, scheduler.total,
+                             ">>> 检查完成: 配置正常" if ok else ">>> 检查完成: 发现问题，请查看上面的检查结果")
+        return {"module_name": module_name, "env": env, "ok": ok, "checks": checks, "app_id": local_info.get("AppID")}
+
+    @staticmethod
+    def _add_check(ctx, name, status, detail, started):
+        ctx["checks"].append({"name": name, "status": status, "detail": detail,
+                              "elapsed": round(time.perf_counter() - started, 3)})
+
+    def _verify_local_module(self, ctx):
+        started = time.perf_counter()
+        info = ctx["local_info"]
+        module_name = ctx["module_name"]
+        if not info["Exists"]:
+            self._add_check(ctx, "本地模块", "fail", f"未找到模块文件 {info['Path']}", started)
+            return
+        if not info["AppID"] or not info["Thumbprint"]:
+            self._add_check(ctx, "本地模块", "fail", f"模块文件中缺少 AppID 或证书指纹: {info['Path']}", started)
+            return
+        module_dir = os.path.dirname(info["Path"])
+        if not os.path.exists(os.path.join(module_dir, f"{module_name}.psd1")):
+            self._add_check(ctx, "本地模块", "warn", "缺少模块清单 (.psd1)，命令不会自动加载 (重新安装或更换证书可修复)", started)
+        else:
+            self._add_check(ctx, "本地模块", "pass", f"AppID {info['AppID']} ({info['Path']})", started)
+
+        started = time.perf_counter()
+        base_module_path = self.get_best_module_path()
+        if os.path.normcase(os.path.dirname(module_dir)) != os.path.normcase(base_module_path):
+            self._add_check(ctx, "模块路径", "warn", f"模块不在当前用户的模块路径 {base_module_path} 中，可能无法自动加载", started)
+        else:
+            self._add_check(ctx, "模块路径", "pass", base_module_path, started)
+
+        started = time.perf_counter()
+        profile_path = self.get_profile_path()
+        pattern = re.compile(rf"^\s*Import-Module\s+{re.escape(module_name)}\s*$", re.IGNORECASE | re.MULTILINE)
+        try:
+            with open(profile_path, "r", encoding="utf-8-sig") as f:
+                legacy_import = bool(pattern.search(f.read()))
+        except FileNotFoundError:
+            legacy_import = False
+        if legacy_import:
+            self._add_check(ctx, "PowerShell Profile", "warn", "Profile 中仍有旧版本的 Import-Module 行 (可以使用，但会拖慢 PowerShell 启动)", started)
+        else:
+            self._add_check(ctx, "PowerShell Profile", "pass", "Profile 中没有该模块的配置 (按需自动加载)", started)
+
+    def _verify_local_cert(self, ctx):
+        import datetime
+        started = time.perf_counter()
+        thumbprint = ctx["local_info"].get("Thumbprint")
+        if not thumbprint:
+            self._add_check(ctx, "本地证书", "fail", "没有证书指纹记录", started)
+            return
+        ps_script = f"""
+        $cert = Get-Item -Path 'Cert:\\CurrentUser\\My\\{thumbprint}' -ErrorAction SilentlyContinue
+        if ($cert) {{ @{{NotAfter=$cert.NotAfter.ToUniversalTime().ToString('o'); HasPrivateKey=$cert.HasPrivateKey}} | ConvertTo-Json -Compress }}
+        """
+        try:
+            output = self.run_powershell_script(ps_script).strip()
+        except Exception as e:
+            self._add_check(ctx, "本地证书", "fail", f"无法读取证书存储: {e}", started)
+            return
+        if not output:
+            self._add_check(ctx, "本地证书", "fail", f"Cert:\\CurrentUser\\My 中没有指纹为 {thumbprint} 的证书", started)
+            return
+        cert = json.loads(output)
+        not_after = datetime.datetime.fromisoformat(cert["NotAfter"][:19]).replace(tzinfo=datetime.timezone.utc)
+        days_left = (not_after - datetime.datetime.now(datetime.timezone.utc)).days
+        if not cert.get("HasPrivateKey"):
+            self._add_check(ctx, "本地证书", "fail", f"证书 {thumbprint} 没有私钥", started)
+        elif days_left < 0:
+            self._add_check(ctx, "本地证书", "fail", f"证书已于 {not_after:%Y-%m-%d} 过期 (可使用更换证书)", started)
+        elif days_left < self.CERT_EXPIRY_WARNING_DAYS:
+            self._add_check(ctx, "本地证书", "warn", f"证书将于 {not_after:%Y-%m-%d} 过期 (剩余 {days_left} 天，建议更换证书)", started)
+        else:
+            self._add_check(ctx, "本地证书", "pass", f"{thumbprint}，有效期至 {not_after:%Y-%m-%d}", started)
+
+    def _verify_graph(self, ctx):
+        graph = ctx["graph"]
+        info = ctx["local_info"]
+        app_id = info["AppID"]
+        sp_id = (self.registry.get(ctx["module_name"]) or {}).get("sp_id")
+        tenant_id = self._tenant_cache_id(ctx)
+        exo_ids = self.tenant_cache.get(ctx["graph_endpoint"], tenant_id, "exo_sp_id", "manage_as_app_role_id")
+
+        # 第一批: 应用、服务主体、Exchange Online 服务主体 (未缓存时；已知服务主体 ID 时同时查询权限和角色分配)
+        started = time.perf_counter()
+        batch = GraphBatch(graph)
+        if info.get("ObjectID"):
+            batch.add("app", "GET", f"/applications/{info['ObjectID']}?$select=id,appId,displayName,keyCredentials")
+        else:
+            batch.add("app", "GET", f"/applications?$filter=appId eq '{app_id}'&$select=id,appId,displayName,keyCredentials")
+        if sp_id:
+            batch.add("sp", "GET", f"/servicePrincipals/{sp_id}?$select=id,appId")
+        else:
+            batch.add("sp", "GET", f"/servicePrincipals?$filter=appId eq '{app_id}'&$select=id,appId")
+        if len(exo_ids) < 2:
+            batch.add("exo_sp", "GET", f"/servicePrincipals?$filter=appId eq '{self.EXO_APP_ID}'&$select=id,appRoles")
+        if sp_id:
+            self._add_assignment_requests(batch, sp_id)
+        results = batch.execute()
+        graph_elapsed = time.perf_counter() - started
+
+        def check(name, status, detail):
+            ctx["checks"].append({"name": name, "status": status, "detail": detail, "elapsed": round(graph_elapsed, 3)})
+
+        resp = results["app"]
+        app = None
+        if resp.status_code == 200:
+            body = resp.json()
+            app = body["value"][0] if "value" in body and body["value"] else (None if "value" in body else body)
+        if not app or (app.get("appId") or "").lower() != app_id.lower():
+            check("Azure 应用", "fail", f"未找到 AppID 为 {app_id} 的应用")
+        else:
+            check("Azure 应用", "pass", f"{app.get('displayName')} ({app['appId']})")
+            thumbprint = (info.get("Thumbprint") or "").upper()
+            key = next((k for k in app.get("keyCredentials") or [] if self._key_thumbprint(k) == thumbprint), None)
+            if key is None:
+                check("应用证书", "fail", f"应用中没有指纹为 {thumbprint} 的证书 (与本地证书不一致，可使用更换证书)")
+            else:
+                check("应用证书", "pass", f"与本地证书一致，有效期至 {(key.get('endDateTime') or '未知')[:10]}")
+
+        resp = results["sp"]
+        sp = None
+        if resp.status_code == 200:
+            body = resp.json()
+            sp = body["value"][0] if "value" in body and body["value"] else (None if "value" in body else body)
+        if not sp:
+            check("服务主体", "fail", "未找到应用的服务主体")
+            return
+        check("服务主体", "pass", sp["id"])
+
+        if not sp_id:
+            # 第二批: 服务主体 ID 未记录在模块索引中时，查到 ID 后再查询权限和角色分配
+            started = time.perf_counter()
+            batch = GraphBatch(graph)
+            self._add_assignment_requests(batch, sp["id"])
+            results.update(batch.execute())
+            graph_elapsed = time.perf_counter() - started
+
+        if "exo_sp" in results:
+            exo_sp = (results["exo_sp"].json().get("value") or [None])[0] if results["exo_sp"].status_code == 200 else None
+            manage_as_app = next((r["id"] for r in (exo_sp or {}).get("appRoles", []) if r.get("value") == "Exchange.ManageAsApp"), None)
+            exo_ids = {"exo_sp_id": (exo_sp or {}).get("id"), "manage_as_app_role_id": manage_as_app}
+            self.tenant_cache.update(ctx["graph_endpoint"], tenant_id, **exo_ids)
+        manage_as_app = exo_ids.get("manage_as_app_role_id")
+        resp = results["grants"]
+        grants = resp.json().get("value", []) if resp.status_code == 200 else []
+        if resp.status_code != 200 or not manage_as_app:
+            check("Exchange.ManageAsApp 权限", "fail", f"无法查询权限: {resp.text if resp.status_code != 200 else '未找到 Exchange Online 服务主体'}")
+        elif any(g.get("appRoleId") == manage_as_app and g.get("resourceId") == exo_ids["exo_sp_id"] for g in grants):
+            check("Exchange.ManageAsApp 权限", "pass", "已授予")
+        else:
+            check("Exchange.ManageAsApp 权限", "fail", "未授予 (重新安装可修复)")
+            if "exo_sp" not in results:
+                # 比较使用的是缓存的 ID，清除缓存以免缓存过时造成误报，下次检查重新查询
+                self.tenant_cache.invalidate(ctx["graph_endpoint"], tenant_id)
+
+        resp = results["roles"]
+        if resp.status_code != 200:
+            check("Exchange Administrator 角色", "fail", f"无法查询角色分配: {resp.text}")
+        elif any(r.get("roleDefinitionId") == self.EXCHANGE_ADMIN_ROLE_TEMPLATE_ID for r in resp.json().get("value", [])):
+            check("Exchange Administrator 角色", "pass", "已分配 (新分配的角色可能需要 5-15 分钟生效)")
+        else:
+            check("Exchange Administrator 角色", "fail", "未分配 (重新安装可修复)")
+
+    def _add_assignment_requests(self, batch, sp_id):
+        batch.add("grants", "GET", f"/servicePrincipals/{sp_id}/appRoleAssignments?$select=appRoleId,resourceId")
+        batch.add("roles", "GET", f"/roleManagement/directory/roleAssignments?$filter=principalId eq '{sp_id}'&$select=roleDefinitionId")
+
+    def _discard_unused_cert(self, ctx):
+        # 证书与登录并行生成: 如果在证书上传到 Azure 之前就失败了 (例如取消登录)，删除这张用不到的本地证书
+        thumbprint = ctx.get("thumbprint")
+        if not thumbprint or ctx.get("app_id") or not ctx.get("cert_in_store"):
+            return
+        try:
+            ps_script = f"Remove-Item -Path 'Cert:\\CurrentUser\\My\\{thumbprint}' -ErrorAction SilentlyContinue"
+            self.run_powershell_script(ps_script)
+            self.log(f"! 已删除未使用的本地证书 (指纹: {thumbprint})", "WARNING")
+        except Exception as e:
+            self.log(f"X 删除未使用的本地证书失败: {e}", "WARNING")
+
+    def get_credential(self, ctx):
+        """
+        交互式浏览器登录凭据 (批量模式下可指定租户和登录账号提示)。
+        令牌缓存持久化到系统加密存储，并按云环境和账号保存登录记录:
+        已登录过的账号会静默从缓存获取令牌，只有首次登录、刷新令牌过期或要求切换账号时才会打开浏览器。
+        """
+        ensure_dependencies(self.log)
+        from azure.identity import InteractiveBrowserCredential, TokenCachePersistenceOptions
+
+        kwargs = {"authority": ctx["authority_host"]}
+        if ctx.get("tenant"):
+            kwargs["tenant_id"] = ctx["tenant"]
+        if ctx.get("login_hint"):
+            kwargs["login_hint"] = ctx["login_hint"]
+
+        account = ctx.get("login_hint") or ctx.get("tenant")
+        record = None if ctx.get("force_login") else self.auth_records.load(ctx["env"], account)
+
+        try:
+            credential = InteractiveBrowserCredential(
+                cache_persistence_options=TokenCachePersistenceOptions(name="ConnectEXO"),
+                authentication_record=record, **kwargs)
+            if record is not None:
+                self.log(f"使用已保存的登录信息 ({record.username})，将优先从令牌缓存静默登录")
+                return credential
+            record = credential.authenticate(scopes=[ctx["scope"]])
+        except ValueError as e:
+            # 当前系统不支持加密的令牌缓存 (例如 Linux 缺少 libsecret)，退回到仅内存缓存
+            self.log(f"! 无法使用持久化令牌缓存，本次登录不会被保存: {e}", "WARNING")
+            return InteractiveBrowserCredential(**kwargs)
+
+        try:
+            self.auth_records.save(ctx["env"], account, record)
+        except Exception as e:
+            self.log(f"! 保存登录记录失败: {e}", "WARNING")
+        return credential
+
+    def _setup_login(self, ctx):
+        credential = self.get_credential(ctx)
+        token = credential.get_token(ctx["scope"])
+        ctx["graph"] = GraphClient(ctx["graph_endpoint"], token.token, tracer=self.tracer, tenant=ctx.get("tenant"), sleep=self.sleep)
+        self.log("√ Azure 登录成功！", "SUCCESS")
+
+    @staticmethod
+    def _tenant_cache_id(ctx):
+        """租户缓存使用令牌中的租户 ID，令牌中没有时使用指定的租户 (域名或 ID)；都没有时不使用缓存"""
+        return ctx["graph"].tenant_id or ctx.get("tenant")
+
+    def _invalidate_tenant_cache(self, ctx):
+        # 使用缓存的 ID 失败时，删除该租户的缓存，下次重新查询
+        if ctx.get("tenant_cache_hit"):
+            self.tenant_cache.invalidate(ctx["graph_endpoint"], self._tenant_cache_id(ctx))
+            self.log("! 已清除该租户的缓存信息，下次运行将重新查询", "WARNING")
+
+    def _setup_tenant(self, ctx):
+        tenant_id = self._tenant_cache_id(ctx)
+        cached = self.tenant_cache.get(ctx["graph_endpoint"], tenant_id, "tenant_domain")
+        if cached:
+            ctx["tenant_domain"] = cached["tenant_domain"]
+            self.log(f"√ 租户域名: {ctx['tenant_domain']} (缓存)", "SUCCESS")
+            return
+
+        resp = ctx["graph"].get("/v1.0/organization?$select=id,verifiedDomains")
+        if resp.status_code != 200: raise Exception(f"无法获取租户信息: {resp.text}")
+        
+        org_info = resp.json()['value'][0]
+        tenant_domain = org_info['verifiedDomains'][0]['name']
+        for d in org_info['verifiedDomains']:
+            if d['isDefault']:
+                tenant_domain = d['name']
+                break
+        ctx["tenant_domain"] = tenant_domain
+        self.tenant_cache.update(ctx["graph_endpoint"], tenant_id, tenant_domain=tenant_domain)
+        self.log(f"√ 检测到租户域名: {tenant_domain}", "SUCCESS")
+
+    def _setup_cleanup(self, ctx):
+        graph = ctx["graph"]
+        try:
+            existing_apps = list(graph.get_all(f"/v1.0/applications?$filter=displayName eq '{ctx['app_display_name']}'&$select=id,appId,displayName"))
+        except Exception as e:
+            self.log(f"! 查询同名旧应用失败，跳过清理: {e}", "WARNING")
+            return
+        if existing_apps:
+            self.log(f"发现 {len(existing_apps)} 个同名旧应用，正在清理...", "WARNING")
+            self._delete_applications(graph, existing_apps)
+
+    def _delete_applications(self, graph, apps, parallel=4):
+        """通过 $batch 删除应用 (每批 20 个，多个批次并发)；返回 (成功数, 失败数)"""
+        batch = GraphBatch(graph)
+        by_id = {}
+        for app in apps:
+            batch.add(app["id"], "DELETE", f"/applications/{app['id']}")
+            by_id[app["id"]] = app
+        deleted = failed = 0
+        for object_id, resp in batch.execute(parallel=parallel, executor=self.executor).items():
+            app = by_id.get(object_id, {})
+            if resp.status_code in (204, 404):
+                deleted += 1
+                self.log(f"√ 已删除 Azure App: {app.get('displayName')} (AppID: {app.get('appId')})", "SUCCESS")
+            else:
+                failed += 1
+                self.log(f"X 删除 Azure App 失败: {app.get('displayName')} (AppID: {app.get('appId')}): {resp.text}", "ERROR")
+        return deleted, failed
+
+    def get_cert_backend(self):
+        if self.cert_backend is None or isinstance(self.cert_backend, str):
+            self.cert_backend = create_cert_backend(self.cert_backend, self.run_powershell_script)
+        return self.cert_backend
+
+    def _setup_cert(self, ctx):
+        backend = self.get_cert_backend()
+        with self.tracer.span("generate_cert", "cert", backend=backend.name):
+            cert_data = backend.generate(ctx['cert_subject'])
+        ctx["cert_data"] = cert_data
+        ctx["cert_in_store"] = backend.in_store
+        ctx["thumbprint"] = cert_data['Thumbprint']
+        ctx["cert_blob"] = cert_data['Base64']
+        ctx["cert_expiry"] = cert_data.get('NotAfter')
+        self.log(f"√ 证书已生成 (指纹: {ctx['thumbprint']}，方式: {backend.name})", "SUCCESS")
+
+    def _setup_cert_store(self, ctx):
+        # 进程内生成的证书需要导入 CurrentUser\My 才能被 Connect-ExchangeOnline 使用；与登录和 Azure 配置同时进行
+        cert_data = ctx.pop("cert_data")
+        if ctx["cert_in_store"]:
+            self.log("√ 证书已在 CurrentUser\\My 证书存储中", "SUCCESS")
+            return
+        self.get_cert_backend().import_to_store(cert_data)
+        ctx["cert_in_store"] = True
+        self.log(f"√ 证书已导入 CurrentUser\\My 证书存储 (指纹: {ctx['thumbprint']})", "SUCCESS")
+
+    def _setup_app(self, ctx):
+        app_body = {
+            "displayName": ctx["app_display_name"],
+            "signInAudience": "AzureADMyOrg",
+            "keyCredentials": [self._key_credential(ctx["cert_blob"], ctx["cert_subject"])]
+        }
+        resp = ctx["graph"].post("/v1.0/applications", json=app_body)
+        if resp.status_code != 201: raise Exception(f"创建应用失败: {resp.text}")
+        
+        app_info = resp.json()
+        ctx["app_id"] = app_info['appId']
+        ctx["app_object_id"] = app_info['id']
+        self.log(f"√ 应用程序创建成功 (App ID: {ctx['app_id']})", "SUCCESS")
+
+    def _setup_service_principal(self, ctx):
+        graph = ctx["graph"]
+        waiter = ctx["waiter"]
+        app_id = ctx["app_id"]
+
+        # 新创建的应用需要一段时间才能被服务主体接口识别: 立即尝试，未就绪时按退避策略轮询 (不再固定等待 5 秒)
+        sp_body = {"appId": app_id}
+
+        def create_service_principal():
+            resp = graph.post("/v1.0/servicePrincipals", json=sp_body)
+            if resp.status_code == 201:
+                return resp.json()
+            # 服务主体可能已经存在 (例如之前的请求实际已成功)
+            existing = graph.get(f"/v1.0/servicePrincipals?$filter=appId eq '{app_id}'")
+            if existing.status_code == 200 and existing.json().get('value'):
+                return existing.json()['value'][0]
+            if resp.status_code == 409 or PropagationWaiter.is_pending_response(resp):
+                raise PropagationPending(resp.text)
+            raise Exception(f"创建服务主体失败: {resp.text}")
+
+        sp_info = waiter.wait("应用传播 (创建服务主体)", create_service_principal)
+        ctx["sp_id"] = sp_info['id']
+        self.log(f"√ 服务主体就绪 (Object ID: {ctx['sp_id']}，传播等待 {waiter.last_elapsed:.1f} 秒)", "SUCCESS")
+
+    def _lookup_exchange_ids(self, ctx):
+        """
+        查询 Exchange Online 服务主体 ID、Exchange.ManageAsApp 角色 ID 和 Exchange Administrator 角色实例 ID。
+        优先使用租户缓存；未命中时一次 $batch 查询服务主体和角色实例，角色尚未激活时才发送激活请求。
+        """
+        graph = ctx["graph"]
+        tenant_id = self._tenant_cache_id(ctx)
+        cached = self.tenant_cache.get(ctx["graph_endpoint"], tenant_id, "exo_sp_id", "manage_as_app_role_id", "exchange_admin_role_id")
+        if len(cached) == 3:
+            ctx["tenant_cache_hit"] = True
+            self.log("√ 使用缓存的 Exchange Online 服务主体和角色信息")
+            return cached
+
+        role_template_id = self.EXCHANGE_ADMIN_ROLE_TEMPLATE_ID
+        role_filter = f"/directoryRoles?$filter=roleTemplateId eq '{role_template_id}'&$select=id"
+        batch = GraphBatch(graph)
+        batch.add("exo_sp", "GET", f"/servicePrincipals?$filter=appId eq '{self.EXO_APP_ID}'&$select=id,appRoles")
+        batch.add("role", "GET", role_filter)
+        lookups = batch.execute()
+
+        resp = lookups["exo_sp"]
+        if resp.status_code != 200 or not resp.json().get('value'): raise Exception(f"无法获取 Exchange Online 服务主体: {resp.text}")
+        exo_sp_info = resp.json()['value'][0]
+        manage_as_app_role_id = next((r['id'] for r in exo_sp_info['appRoles'] if r['value'] == "Exchange.ManageAsApp"), None)
+        if not manage_as_app_role_id: raise Exception("未找到 Exchange.ManageAsApp 角色定义")
+
+        resp = lookups["role"]
+        role_id = resp.json()['value'][0]['id'] if resp.status_code == 200 and resp.json().get('value') else None
+        if role_id is None and resp.status_code == 200:
+            # 租户中从未分配过该角色时需要先激活 (角色已激活时激活请求会失败，例如被其他任务同时激活，此时再查询一次)
+            resp = graph.post("/v1.0/directoryRoles", json={"roleTemplateId": role_template_id})
+            if resp.status_code != 201:
+                resp = graph.get(f"/v1.0{role_filter}")
+            body = resp.json() if resp.status_code in (200, 201) else {}
+            role_id = body.get("id") or ((body.get("value") or [{}])[0].get("id"))
+
+        ids = {"exo_sp_id": exo_sp_info["id"], "manage_as_app_role_id": manage_as_app_role_id, "exchange_admin_role_id": role_id}
+        self.tenant_cache.update(ctx["graph_endpoint"], tenant_id, **ids)
+        return ids
+
+    def _setup_permissions(self, ctx):
+        ctx["role_template_id"] = self.EXCHANGE_ADMIN_ROLE_TEMPLATE_ID
+
+        # 第一批 (缓存未命中时一次往返): Exchange Online 服务主体、Exchange.ManageAsApp 角色和 Exchange Administrator 角色实例
+        ids = self._lookup_exchange_ids(ctx)
+        results = {}
+        try:
+            self._grant_permissions(ctx, ids, results)
+        except TenantCacheStale as e:
+            # 缓存的对象已不存在 (例如服务主体被重建)，清除缓存后重新查询，只重发尚未成功的请求
+            self.log(f"! 缓存的租户信息已失效，重新查询: {e}", "WARNING")
+            self.tenant_cache.invalidate(ctx["graph_endpoint"], self._tenant_cache_id(ctx))
+            ctx["tenant_cache_hit"] = False
+            self._grant_permissions(ctx, self._lookup_exchange_ids(ctx), results)
+        except Exception:
+            self._invalidate_tenant_cache(ctx)
+            raise
+
+        resp = results["grant"]
+        if resp.status_code not in [201, 409]:
+            self._invalidate_tenant_cache(ctx)
+            raise Exception(f"权限授予失败: {resp.text}")
+        self.log("√ 权限授予成功", "SUCCESS")
+        ctx["legacy_role_resp"] = results.get("member")
+
+    def _grant_permissions(self, ctx, ids, results):
+        graph = ctx["graph"]
+        sp_id = ctx["sp_id"]
+        role_id = ids.get("exchange_admin_role_id")
+
+        # 第二批 (一次往返): 授予 API 权限，并通过 Legacy API (directoryRoles) 添加角色成员
+        # 新服务主体尚未传播时会返回 400/404，只重发尚未成功的请求
+        assignment_body = {"principalId": sp_id, "resourceId": ids["exo_sp_id"], "appRoleId": ids["manage_as_app_role_id"]}
+        member_body = {"@odata.id": f"{ctx['graph_endpoint']}/v1.0/directoryObjects/{sp_id}"}
+        # 使用缓存时，错误信息中出现缓存的 ID 说明该对象已不存在，而不是新服务主体尚未传播
+        cached_ids = [i for i in (ids["exo_sp_id"], role_id) if i] if ctx.get("tenant_cache_hit") else []
+
+        def grant_permissions():
+            batch = GraphBatch(graph)
+            if "grant" not in results:
+                batch.add("grant", "POST", f"/servicePrincipals/{sp_id}/appRoleAssignments", json=assignment_body)
+            if role_id and "member" not in results:
+                batch.add("member", "POST", f"/directoryRoles/{role_id}/members/$ref", json=member_body)
+            pending = None
+            for rid, resp in batch.execute().items():
+                if cached_ids and resp.status_code in (400, 404) and (
+                        any(i in resp.text for i in cached_ids) or "Permission being assigned was not found" in resp.text):
+                    raise TenantCacheStale(resp.text)
+                if PropagationWaiter.is_pending_response(resp):
+                    pending = resp
+                else:
+                    results[rid] = resp
+            if pending is not None:
+                raise PropagationPending(pending.text)
+            return results
+
+        return ctx["waiter"].wait("服务主体传播 (授予权限)", grant_permissions)
+
+    def _setup_exo_module(self, ctx):
+        install_module_script = """
+        $ErrorActionPreference = 'Stop'
+        [Net.ServicePointManager]::SecurityProtocol = [Net.SecurityProtocolType]::Tls12
+        $nuget = Get-PackageProvider -Name NuGet -ListAvailable -ErrorAction SilentlyContinue
+        if (-not $nuget) { Install-PackageProvider -Name NuGet -MinimumVersion 2.8.5.201 -Force -Scope CurrentUser -Confirm:$false }
+        if (-not (Get-Module -ListAvailable -Name ExchangeOnlineManagement)) {
+            try { Set-PSRepository -Name PSGallery -InstallationPolicy Trusted -ErrorAction SilentlyContinue } catch {}
+            Install-Module -Name ExchangeOnlineManagement -Force -AllowClobber -Scope CurrentUser -Repository PSGallery -Confirm:$false
+        }
+        """
+        try:
+            self.run_powershell_script(install_module_script, timeout=900)
+            self.log("√ 模块检查/安装完成", "SUCCESS")
+        except Exception as e:
+            self.log(f"X 模块安装遇到问题: {str(e)}", "WARNING")
+
+    def _setup_role(self, ctx):
+        graph = ctx["graph"]
+        sp_id = ctx["sp_id"]
+        legacy_role_resp = ctx.get("legacy_role_resp")
+
+        # 优先使用 Legacy API (directoryRoles) 以确保 Exchange Online 兼容性 (已在步骤 7 的批处理中提交)
+        role_assigned = False
+        if legacy_role_resp is not None:
+            if legacy_role_resp.status_code == 204 or "already exist" in legacy_role_resp.text:
+                self.log("√ 角色分配成功 (Legacy API)", "SUCCESS")
+                role_assigned = True
+            else:
+                self.log(f"! Legacy API 分配失败: {legacy_role_resp.text}，尝试 Unified API...", "WARNING")
+                self._invalidate_tenant_cache(ctx)
+        
+        # 如果 Legacy API 失败，尝试 Unified API (roleManagement)
+        if not role_assigned:
+            role_assignment_body = {"principalId": sp_id, "roleDefinitionId": ctx["role_template_id"], "directoryScopeId": "/"}
+
+            def assign_role():
+                resp = graph.post("/v1.0/roleManagement/directory/roleAssignments", json=role_assignment_body)
+                if PropagationWaiter.is_pending_response(resp) and "already exist" not in resp.text:
+                    raise PropagationPending(resp.text)
+                return resp
+
+            try:
+                resp = ctx["waiter"].wait("服务主体传播 (分配角色)", assign_role)
+            except PropagationTimeoutError as e:
+                self.log(f"X 角色分配失败: {e}", "ERROR")
+            else:
+                if resp.status_code == 201 or "already exists" in resp.text:
+                    self.log("√ 角色分配成功 (Unified API)", "SUCCESS")
+                else:
+                    self.log(f"X 角色分配失败: {resp.text}", "ERROR")
+
+        # 提示用户等待生效
+        self.log("! 注意: 角色分配可能需要 5-15 分钟生效，如果连接报错请稍后重试。", "WARNING")
+
+    def _setup_local_module(self, ctx):
+        module_name = ctx["module_name"]
+        function_name = module_name
+
+        base_module_path = self.get_best_module_path()
+        module_dir = os.path.join(base_module_path, module_name)
+        if not os.path.exists(module_dir): os.makedirs(module_dir)
+        
+        profile_table = "\n".join(
+            f"        '{name}' = @{{ Commands = @({', '.join(repr(c) for c in spec['commands'])}); "
+            f"SkipFormatData = ${str(spec['skip_format_data']).lower()} }}"
+            for name, spec in self.CONNECT_PROFILES.items())
+        psm1_content = f"""
+function {function_name} {{
+    param(
+        [string]$Thumbprint = "{ctx['thumbprint']}",
+        [string]$AppID = "{ctx['app_id']}",
+        [string]$Organization = "{ctx['tenant_domain']}",
+        [ValidateSet({', '.join(repr(name) for name in self.CONNECT_PROFILES)})]
+        [string]$ConnectProfile = "Full",
+        [string[]]$CommandName,
+        [switch]$Force
+    )
+    # 连接配置: 只加载需要的 cmdlet 并跳过格式数据，可显著缩短连接时间
+    $profiles = @{{
+{profile_table}
+    }}
+    $selected = $profiles[$ConnectProfile]
+    $commands = @($selected.Commands) + @($CommandName) | Where-Object {{ $_ }} | Select-Object -Unique
+
+    # 复用当前会话中仍然有效的连接 (同一应用和组织，且已加载的 cmdlet 覆盖本次需要的 cmdlet)
+    if (-not $Force -and (Get-Command Get-ConnectionInformation -ErrorAction SilentlyContinue)) {{
+        $existing = Get-ConnectionInformation -ErrorAction SilentlyContinue |
+            Where-Object {{ $_.State -eq 'Connected' -and $_.TokenStatus -eq 'Active' -and $_.AppId -eq $AppID -and $_.Organization -eq $Organization }} |
+            Select-Object -First 1
+        if ($existing) {{
+            $covered = ($script:LoadedCommands -eq '*') -or ($commands -and -not ($commands | Where-Object {{ $script:LoadedCommands -notcontains $_ }}))
+            if ($covered) {{
+                Write-Host "Reusing existing Exchange Online connection for $Organization." -ForegroundColor Green
+                return
+            }}
+            try {{ Disconnect-ExchangeOnline -ConnectionId $existing.ConnectionId -Confirm:$false -ErrorAction Stop }} catch {{ }}
+        }}
+    }}
+
+    $connectParams = @{{
+        CertificateThumbprint = $Thumbprint
+        AppID = $AppID
+        Organization = $Organization
+        ShowBanner = $false
+    }}
+    if ($commands) {{ $connectParams['CommandName'] = $commands }}
+    if ($selected.SkipFormatData) {{ $connectParams['SkipLoadingFormatData'] = $true }}
+
+    Write-Host "Connecting to Exchange Online ({ctx['env']}, $ConnectProfile) for $Organization..." -ForegroundColor Cyan
+    Connect-ExchangeOnline @connectParams {ctx['exo_env_param']}
+    $script:LoadedCommands = if ($commands) {{ @($commands) }} else {{ '*' }}
+}}
+Export-ModuleMember -Function {function_name}
+"""
+        with open(os.path.join(module_dir, f"{module_name}.psm1"), "w", encoding="utf-8") as f:
+            f.write(psm1_content)
+        self.write_module_manifest(module_dir, module_name)
+        self.registry.upsert(module_name, replace=True, env=ctx["env"], tenant_domain=ctx["tenant_domain"], app_id=ctx["app_id"],
+                             app_object_id=ctx["app_object_id"], sp_id=ctx.get("sp_id"), thumbprint=ctx["thumbprint"],
+                             cert_expiry=ctx.get("cert_expiry"), path=os.path.join(module_dir, f"{module_name}.psm1"),
+                             installed_at=time.strftime('%Y-%m-%d %H:%M:%S'))
+
+        # 不再向 Profile 写入 Import-Module: 模块清单声明了导出的函数，PowerShell 在首次调用时自动加载模块，
+        # 配置再多的连接也不会增加 Profile 的加载时间。同时移除旧版本写入的 Import-Module 行
+        self.migrate_profile()
+        
+        self.log("√ 本地模块配置完成", "SUCCESS")
+
+    def write_module_manifest(self, module_dir, module_name):
+        """生成模块清单 (.psd1)，显式列出导出的函数，供 PowerShell 命令自动加载使用"""
+        psd1_path = os.path.join(module_dir, f"{module_name}.psd1")
+        # 重新安装时沿用原有清单的 GUID
+        guid = None
+        if os.path.exists(psd1_path):
+            try:
+                with open(psd1_path, "r", encoding="utf-8-sig") as f:
+                    match = re.search(r"GUID\s*=\s*'([0-9a-fA-F-]{36})'", f.read())
+                guid = match.group(1) if match else None
+            except Exception:
+                pass
+        psd1_content = f"""@{{
+    RootModule = '{module_name}.psm1'
+    ModuleVersion = '1.0.0'
+    GUID = '{guid or uuid.uuid4()}'
+    Description = 'Exchange Online certificate-based connection ({module_name})'
+    PowerShellVersion = '5.1'
+    FunctionsToExport = @('{module_name}')
+    CmdletsToExport = @()
+    VariablesToExport = @()
+    AliasesToExport = @()
+}}
+"""
+        with open(psd1_path, "w", encoding="utf-8") as f:
+            f.write(psd1_content)
+
+    def migrate_profile(self):
+        """
+        迁移旧版本的配置: 旧版本为每个模块在 Profile 中写入一行 Import-Module，导致每个 PowerShell 窗口启动时都要加载所有模块。
+        移除指向本工具生成的模块的 Import-Module 行，并为缺少清单的旧模块补充 .psd1。返回移除的行数。
+        """
+        profile_path = self.get_profile_path()
+        if not os.path.exists(profile_path):
+            return 0
+        import_pattern = re.compile(r"^\s*Import-Module\s+([A-Za-z0-9]+)\s*$", re.IGNORECASE)
+        removed = []
+        try:
+            # 批量模式下多个任务可能同时修改 Profile，读写期间持有文件锁
+            with FileLock(profile_path):
+                with open(profile_path, "r", encoding="utf-8-sig") as f:
+                    lines = f.readlines()
+
+                new_lines = []
+                for line in lines:
+                    match = import_pattern.match(line)
+                    info = self.get_local_module_info(match.group(1)) if match else None
+                    # 只处理本工具生成的模块 (模块文件中记录了 AppID)
+                    if info and info["Exists"] and info["AppID"]:
+                        module_dir = os.path.dirname(info["Path"])
+                        if not os.path.exists(os.path.join(module_dir, f"{match.group(1)}.psd1")):
+                            self.write_module_manifest(module_dir, match.group(1))
+                        removed.append(line.strip())
+                    else:
+                        new_lines.append(line)
+
+                if removed:
+                    with open(profile_path, "w", encoding="utf-8-sig") as f:
+                        f.writelines(new_lines)
+        except Exception as e:
+            self.log(f"! 迁移 PowerShell Profile 失败: {e}", "WARNING")
+            return 0
+
+        for line in removed:
+            self.log(f"  - 移除 Profile 行: {line}")
+        if removed:
+            self.log(f"√ 已从 Profile 中移除 {len(removed)} 行旧版本的 Import-Module (模块改为按需自动加载)", "SUCCESS")
+        return len(removed)
+
+
+class AsyncInstallerEngine:
+    """
+    InstallerEngine 的 asyncio 接口，供自动化脚本调用，也是界面、命令行和批量模式共用的执行入口。
+
+        async with AsyncInstallerEngine(max_concurrency=20) as engine:
+            results = await asyncio.gather(*(engine.install("Global", name, tenant=t) for name, t in tenants),
+                                           return_exceptions=True)
+
+    每个操作由同步的 InstallerEngine 在线程池中执行 (Graph 请求使用 requests，PowerShell 使用共享的工作进程)，
+    同时执行的操作不超过 max_concurrency 个。传播轮询、重试退避和限速排队的等待交给事件循环: 等待期间操作让出并发名额，
+    排队的操作可以先开始，醒来后再取回名额，因此几秒的目录传播或租户限流不会让整个并发槽位空等。
+    线程总数不超过 max_threads (默认 max_concurrency 的 8 倍): 一半执行操作本身 (等待中的操作仍占用它的线程，
+    因此也是同时进行中的操作数上限)，另一半由所有操作的并发步骤和并发 $batch 批次共享；
+    共享线程池被占满时，步骤由所属操作的线程自己执行。
+    日志和进度通过 events() 以事件字典的形式输出:
+        {"id", "action", "module_name", "env", "time", "type": "started" | "log" | "progress" | "finished" | "failed", ...}
+    log 事件包含 message / level，progress 事件包含 percent / status，finished 包含 result，failed 包含 error。
+    有 events() 消费者时，操作在它的所有事件被消费者处理完之后才返回，调用方随后输出的内容不会排到操作日志之前。
+    """
+
+    def __init__(self, max_concurrency=8, ps_host=None, path_resolver=None, max_threads=None, **engine_kwargs):
+        self.max_concurrency = max(int(max_concurrency), 1)
+        max_threads = int(max_threads or self.max_concurrency * 8)
+        self.max_operations = max(max_threads // 2, self.max_concurrency)
+        self.max_step_threads = max(max_threads - self.max_operations, 1)
+        self.max_threads = self.max_operations + self.max_step_threads
+        self._owns_ps_host = ps_host is None
+        self.ps_host = ps_host or PowerShellHost()
+        self.path_resolver = path_resolver or PowerShellPathResolver(get_documents_dir)
+        # 传给每个 InstallerEngine 的其他参数 (trace_dir、cert_backend 等)
+        self.engine_kwargs = engine_kwargs
+        self._loop = None
+        self._queue = None
+        self._semaphore = None
+        self._threads = None
+        self._executor = None
+        self._step_executor = None
+        self._next_id = 0
+        self._consumers = 0
+        self._delivered = {}
+
+    def _bind(self):
+        # 队列和信号量绑定到当前运行的事件循环 (首次调用时创建)
+        import asyncio
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._threads = asyncio.Semaphore(self.max_operations)
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            # 操作和步骤使用不同的线程池: 持有并发名额的操作总有自己的线程，不会排在等待名额的步骤后面
+            self._executor = ThreadPoolExecutor(max_workers=self.max_operations, thread_name_prefix="ConnectEXO")
+            self._step_executor = ThreadPoolExecutor(max_workers=self.max_step_threads, thread_name_prefix="ConnectEXO-Step")
+
+    def _emit(self, event):
+        # 可以在任意线程中调用: 事件总是在事件循环线程中放入队列
+        event["time"] = time.time()
+        try:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, event)
+        except RuntimeError:
+            pass  # 事件循环已关闭
+
+    def _idle_sleep(self, state, seconds):
+        # 在工作线程中调用 (传播轮询、重试退避): 由事件循环计时，等待期间让出并发名额
+        import asyncio
+        try:
+            future = asyncio.run_coroutine_threadsafe(self._idle(state, seconds), self._loop)
+        except RuntimeError:
+            time.sleep(seconds)  # 事件循环已关闭
+            return
+        future.result()
+
+    async def _idle(self, state, seconds):
+        import asyncio
+        # 一个操作可能有多个步骤同时等待: 第一个开始等待时让出名额，最后一个醒来时取回
+        async with state["lock"]:
+            state["waiting"] += 1
+            if state["waiting"] == 1:
+                self._semaphore.release()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            async with state["lock"]:
+                state["waiting"] -= 1
+                if state["waiting"] == 0:
+                    await self._semaphore.acquire()
+
+    async def _deliver(self, event):
+        # 操作的最后一个事件: 有消费者时等它处理完 (它之前的事件也都已处理) 再返回
+        import asyncio
+        event["time"] = time.time()
+        if self._consumers:
+            delivered = self._delivered[event["id"]] = asyncio.Event()
+            self._queue.put_nowait(event)
+            await delivered.wait()
+        else:
+            self._queue.put_nowait(event)
+
+    async def _run(self, action, env, module_name, call):
+        import asyncio
+        self._bind()
+        self._next_id += 1
+        op = {"id": self._next_id, "action": action, "module_name": module_name, "env": env}
+        state = {"waiting": 0, "lock": asyncio.Lock()}
+        error = result = None
+        # 先取线程名额再取并发名额: 取得并发名额的操作一定有空闲线程可用，等待中的操作醒来后总能取回名额
+        async with self._threads:
+            await self._semaphore.acquire()
+            try:
+                engine = InstallerEngine(
+                    self.ps_host, self.path_resolver,
+                    on_log=lambda message, level: self._emit(dict(op, type="log", message=message, level=level)),
+                    on_progress=lambda percent, status: self._emit(dict(op, type="progress", percent=percent, status=status)),
+                    sleep=lambda seconds: self._idle_sleep(state, seconds),
+                    executor=self._step_executor, **self.engine_kwargs)
+                self._emit(dict(op, type="started"))
+                result = await self._loop.run_in_executor(self._executor, call, engine)
+            except Exception as e:
+                error = e
+            finally:
+                self._semaphore.release()
+        if error is not None:
+            await self._deliver(dict(op, type="failed", error=str(error)))
+            raise error
+        await self._deliver(dict(op, type="finished", result=result))
+        return result
+
+    async def install(self, env, module_name, **kwargs):
+        return await self._run("install", env, module_name, lambda engine: engine.install(env, module_name, **kwargs))
+
+    async def uninstall(self, env, module_name, **kwargs):
+        return await self._run("uninstall", env, module_name, lambda engine: engine.uninstall(env, module_name, **kwargs))
+
+    async def rotate(self, env, module_name, **kwargs):
+        return await self._run("rotate", env, module_name, lambda engine: engine.rotate(env, module_name, **kwargs))
+
+    async def verify(self, env, module_name, **kwargs):
+        return await self._run("verify", env, module_name, lambda engine: engine.verify(env, module_name, **kwargs))
+
+    async def cleanup_orphans(self, env, **kwargs):
+        return await self._run("cleanup", env, None, lambda engine: engine.cleanup_orphans(env, **kwargs))
+
+    async def events(self):
+        """异步迭代事件，aclose() 后结束"""
+        self._bind()
+        self._consumers += 1
+        try:
+            while True:
+                event = await self._queue.get()
+                if event is None:
+                    return
+                yield event
+                # 回到这里时消费者已处理完这个事件
+                delivered = self._delivered.pop(event["id"], None) if event["type"] in ("finished", "failed") else None
+                if delivered is not None:
+                    delivered.set()
+        finally:
+            self._consumers -= 1
+            # 消费者提前退出时不能让正在返回的操作一直等待
+            if not self._consumers:
+                for delivered in self._delivered.values():
+                    delivered.set()
+                self._delivered.clear()
+
+    async def aclose(self):
+        if self._queue is not None:
+            # 排在所有已发出的事件之后，events() 读到它时结束
+            self._loop.call_soon(self._queue.put_nowait, None)
+        if self._executor is not None:
+            await self._loop.run_in_executor(None, self._executor.shutdown)
+            await self._loop.run_in_executor(None, self._step_executor.shutdown)
+            self._executor = self._step_executor = None
+        if self._owns_ps_host:
+            self.ps_host.close()
+
+    async def __aenter__(self):
+        self._bind()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+
+class UIEventBus:
+    """
+    工作线程 → 界面线程的事件总线 (Tk 不是线程安全的，工作线程不能直接操作控件)。
+    任意线程通过 post() 投递事件、通过 call() / call_soon() 请求在主线程执行函数，全部进入同一个线程安全队列，
+    由主线程的 root.after 泵每帧 (约 16 ms) 按顺序取出: 同一帧内的 batch 事件合并为一次处理，
+    latest 事件 (进度、状态) 只处理最后一个值，因此每帧最多刷新一次界面。
+    call() 用于对话框等需要返回值的操作: 工作线程阻塞等待主线程的执行结果；事件循环中使用 submit() 返回的 Future。
+    对话框打开期间泵继续刷新日志和进度，但其后的函数调用会等对话框关闭后再按顺序执行。
+    """
+
+    FRAME_MS = 16
+
+    def __init__(self, root, frame_ms=None, on_error=None):
+        self.root = root
+        self.frame_ms = frame_ms or self.FRAME_MS
+        # on_error(exception): 处理函数出错时调用 (不能让异常中断泵)
+        self.on_error = on_error
+        self._queue = queue.SimpleQueue()
+        self._backlog = collections.deque()
+        self._handlers = {}
+        self._main_thread = threading.get_ident()
+        self._in_call = False
+        self._after_id = self.root.after(self.frame_ms, self._pump)
+
+    def subscribe(self, kind, handler, mode="batch"):
+        """mode="batch": handler(本帧所有数据的列表)；mode="latest": handler(本帧最后一个数据)"""
+        self._handlers[kind] = (handler, mode)
+
+    def post(self, kind, payload=None):
+        self._queue.put(("event", kind, payload))
+
+    def call_soon(self, func, *args, **kwargs):
+        """在主线程按顺序执行 func，不等待结果"""
+        self._queue.put(("call", func, args, kwargs, None))
+
+    def submit(self, func, *args, **kwargs):
+        """在主线程按顺序执行 func，返回 concurrent.futures.Future (事件循环中可以用 asyncio.wrap_future 等待)"""
+        from concurrent.futures import Future
+        future = Future()
+        self._queue.put(("call", func, args, kwargs, future))
+        return future
+
+    def call(self, func, *args, **kwargs):
+        """在主线程执行 func 并返回结果 (在主线程中调用时直接执行)"""
+        if threading.get_ident() == self._main_thread:
+            return func(*args, **kwargs)
+        return self.submit(func, *args, **kwargs).result()
+
+    def take(self, kind):
+        """主线程: 取出 (并不再处理) 尚未处理的 kind 事件的数据"""
+        self._collect()
+        taken = [e[2] for e in self._backlog if e[0] == "event" and e[1] == kind]
+        if taken:
+            self._backlog = collections.deque(e for e in self._backlog if not (e[0] == "event" and e[1] == kind))
+        return taken
+
+    def close(self):
+        if self._after_id is not None:
+            self.root.after_cancel(self._after_id)
+            self._after_id = None
+        # 让仍在等待对话框结果的工作线程退出
+        self._collect()
+        for event in self._backlog:
+            if event[0] == "call" and event[4] is not None:
+                event[4].cancel()
+        self._backlog.clear()
+
+    def _collect(self):
+        while True:
+            try:
+                self._backlog.append(self._queue.get_nowait())
+            except queue.Empty:
+                return
+
+    def _dispatch(self, batches):
+        for kind, payloads in batches.items():
+            handler, mode = self._handlers.get(kind, (None, None))
+            if handler is None:
+                continue
+            try:
+                handler(payloads[-1] if mode == "latest" else payloads)
+            except Exception as e:
+                self._report(e)
+        batches.clear()
+
+    def _run_call(self, func, args, kwargs, future):
+        self._in_call = True
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if future is None:
+                self._report(e)
+            elif future.set_running_or_notify_cancel():
+                future.set_exception(e)
+        else:
+            if future is not None and future.set_running_or_notify_cancel():
+                future.set_result(result)
+        finally:
+            self._in_call = False
+
+    def _report(self, error):
+        if self.on_error:
+            try:
+                self.on_error(error)
+            except Exception:
+                pass
+
+    def _pump(self):
+        # 先安排下一帧: 对话框的嵌套事件循环中泵仍然运行
+        self._after_id = self.root.after(self.frame_ms, self._pump)
+        self._collect()
+        batches = {}
+        while self._backlog:
+            event = self._backlog[0]
+            if event[0] == "call":
+                if self._in_call:
+                    # 对话框打开中: 之后的调用保持顺序，等对话框关闭
+                    break
+                self._backlog.popleft()
+                # 调用之前投递的日志和进度先显示出来
+                self._dispatch(batches)
+                self._run_call(*event[1:])
+                continue
+            self._backlog.popleft()
+            batches.setdefault(event[1], []).append(event[2])
+        self._dispatch(batches)
 
-# 检查依赖库
-try:
-    from azure.identity import InteractiveBrowserCredential
-except ImportError:
-    # 如果缺少依赖，尝试自动安装
-    try:
-        subprocess.check_call([sys.executable, "-m", "pip", "install", "azure-identity", "requests"])
-        from azure.identity import InteractiveBrowserCredential
-    except Exception as e:
-        root = tk.Tk()
-        root.withdraw()
-        messagebox.showerror("缺少依赖", f"无法自动安装依赖库，请手动运行：\npip install azure-identity requests\n\n错误: {e}")
-        sys.exit(1)
 
 class ConnectEXOInstallerApp:
+    # 日志框中最多保留的记录条数 (环形缓冲)，以及每次从磁盘分页加载的条数
+    LOG_VIEW_MAX_RECORDS = 2000
+    LOG_PAGE_SIZE = 500
+
     def __init__(self, root):
         # 启用 DPI 感知 (Windows)
         try:
@@ -44,16 +3734,16 @@ class ConnectEXOInstallerApp:
             else:
                 base_path = os.path.dirname(os.path.abspath(__file__))
             
+            # 使用预先缩小的图标 (16-64 像素)，避免启动时解码 1024x1024 的 exchange.png
             icon_ico = os.path.join(base_path, "exchange.ico")
-            icon_png = os.path.join(base_path, "exchange.png")
+            icon_png = os.path.join(base_path, "exchange_small.png")
 
-            # 优先尝试加载 .ico (用于窗口图标)
-            if os.path.exists(icon_ico):
+            # Windows 优先加载 .ico (用于窗口图标)，其他平台使用 .png
+            if sys.platform == "win32" and os.path.exists(icon_ico):
                 self.root.iconbitmap(icon_ico)
-            # 如果没有 .ico，尝试加载 .png
             elif os.path.exists(icon_png):
-                icon_img = tk.PhotoImage(file=icon_png)
-                self.root.iconphoto(True, icon_img)
+                self._icon_img = tk.PhotoImage(file=icon_png)
+                self.root.iconphoto(True, self._icon_img)
         except Exception:
             pass
 
@@ -74,10 +3764,31 @@ class ConnectEXOInstallerApp:
         # 自定义进度条样式
         self.style.configure("Thick.Horizontal.TProgressbar", thickness=25)
 
+        # 工作线程与界面之间的事件总线: 日志、进度、状态和对话框都在主线程按帧处理
+        self.bus = UIEventBus(root, on_error=lambda e: self.log_writer.write(f"界面更新失败: {e}", "ERROR"))
+        # 工作线程不读取 Tk 变量，开始操作时在主线程记录选项
+        self._force_login = False
+
         # 初始化日志文件路径
         self.log_file_path = os.path.join(os.path.expanduser("~"), "Documents", "ConnectEXO_Install.log")
         self._init_log_file()
 
+        # 常驻 PowerShell 工作进程 (首次调用时启动，退出程序时关闭)
+        self.ps_host = PowerShellHost()
+        atexit.register(self.ps_host.close)
+
+        # PowerShell 模块路径解析器 (在后台预热，避免安装时阻塞界面)
+        self.path_resolver = PowerShellPathResolver(get_documents_dir)
+        self.path_resolver.warm_up()
+
+        # 安装/卸载引擎: 操作在后台线程的事件循环中执行，日志和进度通过 events() 送到事件总线
+        self.engine = AsyncInstallerEngine(1, self.ps_host, self.path_resolver,
+                                           trace_dir=os.path.join(os.path.dirname(self.log_file_path), "ConnectEXO_Traces"))
+        # 本机模块查询 (模块索引、未完成的安装记录) 直接在主线程调用同步引擎
+        self.modules = InstallerEngine(self.ps_host, self.path_resolver)
+        # 事件循环在第一次执行操作时创建 (启动时不导入 asyncio)
+        self._loop = None
+
         # 主容器 (增加内边距)
         main_frame = ttk.Frame(root, padding="40 30 40 30")
         main_frame.pack(fill="both", expand=True)
@@ -124,7 +3835,8 @@ class ConnectEXOInstallerApp:
         ttk.Label(self.name_frame, text="2. 模块名称:", style="Header.TLabel").pack(side="left", padx=(0, 32))
         
         self.module_name_var = tk.StringVar()
-        self.entry_module_name = ttk.Entry(self.name_frame, textvariable=self.module_name_var, width=30, font=("Microsoft YaHei UI", 12))
+        # 下拉列表列出本机已安装的模块 (读取模块索引)，也可以直接输入新的模块名称
+        self.entry_module_name = ttk.Combobox(self.name_frame, textvariable=self.module_name_var, width=28, font=("Microsoft YaHei UI", 12))
         self.entry_module_name.pack(side="left", padx=15)
         ttk.Label(self.name_frame, text="(字母数字组合, 例: MyConnectEXO)", foreground="gray").pack(side="left")
 
@@ -137,6 +3849,13 @@ class ConnectEXOInstallerApp:
         self.action_var = tk.StringVar(value="") # 默认不选中
         ttk.Radiobutton(self.action_frame, text="安装 / 更新 (Install)", variable=self.action_var, value="Install").pack(side="left", padx=15)
         ttk.Radiobutton(self.action_frame, text="彻底卸载 (Uninstall)", variable=self.action_var, value="Uninstall").pack(side="left", padx=15)
+        ttk.Radiobutton(self.action_frame, text="更换证书 (Rotate)", variable=self.action_var, value="Rotate").pack(side="left", padx=15)
+        ttk.Radiobutton(self.action_frame, text="检查配置 (Verify)", variable=self.action_var, value="Verify").pack(side="left", padx=15)
+        ttk.Radiobutton(self.action_frame, text="清理残留应用 (Cleanup)", variable=self.action_var, value="Cleanup").pack(side="left", padx=15)
+
+        # 登录信息会被缓存，勾选后忽略缓存重新打开浏览器登录 (用于切换账号)
+        self.force_login_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(self.action_frame, text="切换账号 (重新登录)", variable=self.force_login_var).pack(side="left", padx=15)
 
         # 4. 进度条区域
         progress_frame = ttk.LabelFrame(main_frame, text="执行进度", padding="20")
@@ -149,6 +3868,8 @@ class ConnectEXOInstallerApp:
         self.progress_val = tk.DoubleVar(value=0)
         self.progressbar = ttk.Progressbar(progress_frame, variable=self.progress_val, maximum=100, style="Thick.Horizontal.TProgressbar")
         self.progressbar.pack(fill="x", ipady=2)
+        self.bus.subscribe("progress", self.progress_val.set, mode="latest")
+        self.bus.subscribe("status", self.status_var.set, mode="latest")
 
         # 5. 日志区域 (可折叠) - 调整顺序
         self.show_log = tk.BooleanVar(value=False)
@@ -171,12 +3892,17 @@ class ConnectEXOInstallerApp:
         self.log_frame = ttk.LabelFrame(main_frame, text="详细日志", padding="10")
         # 初始不显示 log_frame.pack(...)
 
+        # 日志框只保留最近的记录，更早的记录按需从磁盘日志分页加载
+        self.btn_log_older = ttk.Button(self.log_frame, text=f"加载更早的 {self.LOG_PAGE_SIZE} 条日志 ▲", command=self.load_older_log)
+        self.btn_log_older.pack(anchor="w", pady=(0, 5))
+
         # 增加高度到 20 行，并添加垂直滚动条 (ScrolledText 自带)
         self.log_area = scrolledtext.ScrolledText(self.log_frame, height=20, state='disabled', font=("Consolas", 10))
         self.log_area.pack(fill="both", expand=True)
         
         self.log_area.tag_config("ERROR", foreground="red")
         self.log_area.tag_config("HEADER", foreground="blue", font=("Consolas", 10, "bold"))
+        self.log_area.tag_config("HISTORY", foreground="gray")
 
     def open_log_file(self):
         try:
@@ -196,6 +3922,7 @@ class ConnectEXOInstallerApp:
         current_val = self.module_name_var.get()
         if not current_val or current_val in ["ConnectEXO", "ConnectEXO21V"]:
             self.module_name_var.set(default_name)
+        self.refresh_module_choices()
 
         if not self.name_frame.winfo_ismapped():
             self.name_frame.pack(fill="x", pady=(0, 10))
@@ -203,6 +3930,12 @@ class ConnectEXOInstallerApp:
         if not self.action_frame.winfo_ismapped():
             self.action_frame.pack(fill="x", pady=(0, 20))
 
+    def refresh_module_choices(self):
+        # 模块名称下拉列表: 当前云环境下已安装的模块
+        env = self.env_var.get()
+        if env:
+            self.entry_module_name["values"] = [r["module_name"] for r in self.modules.list_modules(env)]
+
     def toggle_log(self):
         if self.show_log.get():
             self.log_frame.pack_forget()
@@ -217,67 +3950,105 @@ class ConnectEXOInstallerApp:
             self.root.geometry("1000x1100") # 增大窗口高度以显示更多日志
 
     def _init_log_file(self):
-        try:
-            with open(self.log_file_path, "a", encoding="utf-8") as f:
-                f.write(f"\n{'='*50}\n[{time.strftime('%Y-%m-%d %H:%M:%S')}] 应用程序启动\n{'='*50}\n")
-        except:
-            pass
+        # 文本日志旁边同时写一份 JSON Lines 结构化日志，便于脚本分析
+        json_path = os.path.splitext(self.log_file_path)[0] + ".jsonl"
+        self.log_writer = LogWriter(self.log_file_path, json_path=json_path)
+        atexit.register(self.log_writer.close)
+        self.log_writer.write_raw(f"\n{'='*50}\n[{time.strftime('%Y-%m-%d %H:%M:%S')}] 应用程序启动\n{'='*50}\n")
+
+        # 工作线程只把日志投递到事件总线，由主线程每帧批量插入到日志框
+        self.bus.subscribe("log", self._insert_log_lines)
+        # 日志框中每条记录的 (序号, 行数)，用于环形裁剪和分页定位
+        self._log_view_records = collections.deque()
+        self._log_view_lines = 0
+
+    @staticmethod
+    def _log_tag(message, level):
+        # 简单的关键词自动着色逻辑
+        tag = level
+        if level == "INFO":
+            if ">>>" in message: tag = "HEADER"
+            elif "√" in message: tag = "SUCCESS"
+            elif "!" in message: tag = "WARNING"
+            elif "X" in message: tag = "ERROR"
+        return tag
+
+    def _clear_log_view(self):
+        self.bus.take("log")
+        self._log_view_records.clear()
+        self._log_view_lines = 0
+        self.btn_log_older.config(text=f"加载更早的 {self.LOG_PAGE_SIZE} 条日志 ▲")
+        self.log_area.config(state='normal')
+        self.log_area.delete('1.0', tk.END)
+        self.log_area.config(state='disabled')
+
+    def _insert_log_lines(self, records):
+        # 一帧内的新日志合并为一次插入；超过日志框上限的部分只保留最新的 (完整记录在磁盘日志中)
+        records = records[-self.LOG_VIEW_MAX_RECORDS:]
+        chunks = []
+        for seq, display_msg, tag in records:
+            chunks += [display_msg, tag]
+            line_count = display_msg.count("\n")
+            self._log_view_records.append((seq, line_count))
+            self._log_view_lines += line_count
+        self.log_area.config(state='normal')
+        self.log_area.insert(tk.END, *chunks)
+
+        # 超出上限时从顶部裁掉最旧的记录，保持内存和重绘开销恒定
+        trim_lines = 0
+        while len(self._log_view_records) > self.LOG_VIEW_MAX_RECORDS:
+            trim_lines += self._log_view_records.popleft()[1]
+        if trim_lines:
+            self.log_area.delete('1.0', f'{trim_lines + 1}.0')
+            self._log_view_lines -= trim_lines
+
+        self.log_area.see(tk.END)
+        self.log_area.config(state='disabled')
+
+    def load_older_log(self):
+        """从磁盘日志中加载日志框顶部之前的一页记录 (包括之前运行和已轮转的日志)"""
+        # 先插入尚未显示的日志；日志框顶部之后的记录都在磁盘日志的末尾，跳过它们
+        pending = self.bus.take("log")
+        if pending:
+            self._insert_log_lines(pending)
+        if self._log_view_records:
+            top_seq = self._log_view_records[0][0]
+        else:
+            top_seq = self.log_writer.record_count + 1
+        skip = self.log_writer.record_count - top_seq + 1
+        records = self.log_writer.read_records(skip, self.LOG_PAGE_SIZE)
+        if not records:
+            self.btn_log_older.config(text="没有更早的日志了")
+            return
+
+        self.log_area.config(state='normal')
+        text = "".join(
+            f"[{time.strftime('%m-%d %H:%M:%S', time.localtime(r.get('ts', 0)))}] {r.get('message', '')}\n"
+            for r in records)
+        self.log_area.insert('1.0', text, "HISTORY")
+        self.log_area.config(state='disabled')
+        self.log_area.see('1.0')
+
+        # 分页加载的记录按磁盘序号倒推，使下一次分页从更早的位置继续
+        for offset, r in enumerate(reversed(records), start=1):
+            line_count = 1 + r.get('message', '').count("\n")
+            self._log_view_records.appendleft((top_seq - offset, line_count))
+            self._log_view_lines += line_count
 
     def log(self, message, level="INFO"):
-        self.log_area.config(state='normal')
-        
         timestamp = time.strftime("%H:%M:%S")
         display_msg = f"[{timestamp}] {message}\n"
-        
-        # 简单的关键词自动着色逻辑
-        tag = level
-        if level == "INFO":
-            if ">>>" in message: tag = "HEADER"
-            elif "√" in message: tag = "SUCCESS"
-            elif "!" in message: tag = "WARNING"
-            elif "X" in message: tag = "ERROR"
-        
-        self.log_area.insert(tk.END, display_msg, tag)
-        self.log_area.see(tk.END)
-        self.log_area.config(state='disabled')
-        self.root.update()
-
-        # 写入文件
-        try:
-            with open(self.log_file_path, "a", encoding="utf-8") as f:
-                f.write(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] [{level}] {message}\n")
-        except:
-            pass
+        seq = self.log_writer.write(message, level)
+        self.bus.post("log", (seq, display_msg, self._log_tag(message, level)))
 
-    def update_progress(self, step, total_steps, message):
-        progress = (step / total_steps) * 100
-        self.progress_val.set(progress)
-        self.status_var.set(f"步骤 {step}/{total_steps}: {message}")
-        self.log(message, level="HEADER" if ">>>" in message else "INFO")
+    def set_progress(self, progress, status=None):
+        # 可在任意线程调用: 同一帧内的多次更新只显示最后一次
+        self.bus.post("progress", progress)
+        if status:
+            self.bus.post("status", status)
 
-    def get_local_module_info(self, module_name):
-        """尝试从本地已安装的模块文件中解析 AppID 和 Thumbprint"""
-        base_module_path = self.get_best_module_path()
-        psm1_path = os.path.join(base_module_path, module_name, f"{module_name}.psm1")
-        
-        info = {"AppID": None, "Thumbprint": None, "Path": psm1_path, "Exists": False}
-        
-        if os.path.exists(psm1_path):
-            info["Exists"] = True
-            try:
-                with open(psm1_path, "r", encoding="utf-8") as f:
-                    content = f.read()
-                    
-                # 正则提取
-                app_id_match = re.search(r'\$AppID\s*=\s*"([^"]+)"', content, re.IGNORECASE)
-                thumb_match = re.search(r'\$Thumbprint\s*=\s*"([^"]+)"', content, re.IGNORECASE)
-                
-                if app_id_match: info["AppID"] = app_id_match.group(1)
-                if thumb_match: info["Thumbprint"] = thumb_match.group(1)
-            except Exception as e:
-                print(f"Error parsing module file: {e}")
-                
-        return info
+    def set_status(self, status):
+        self.bus.post("status", status)
 
     def start_process(self):
         # 获取当前选择的环境和操作
@@ -288,6 +4059,15 @@ class ConnectEXOInstallerApp:
         if not env:
             messagebox.showwarning("提示", "请先选择云环境 (Global 或 21Vianet)")
             return
+        self._force_login = self.force_login_var.get()
+
+        if action == "Cleanup":
+            # 清理残留应用不针对单个模块，先预览再确认删除
+            self._clear_log_view()
+            self.btn_start.config(state='disabled', text="正在查找...")
+            self.progress_val.set(0)
+            self._submit(self.run_cleanup(env))
+            return
         
         if not module_name:
             messagebox.showwarning("提示", "请输入模块名称")
@@ -308,16 +4088,19 @@ class ConnectEXOInstallerApp:
             env_display = "Global (国际版)"
             
         # 统一命名规则
-        app_display_name = f"{module_name}-Automation-App"
-        cert_subject = f"{module_name}-Auto"
+        app_display_name = InstallerEngine.get_app_display_name(module_name)
 
         # 清空日志区域
-        self.log_area.config(state='normal')
-        self.log_area.delete('1.0', tk.END)
-        self.log_area.config(state='disabled')
+        self._clear_log_view()
 
         # 获取本地模块信息 (用于卸载或更新检查)
-        local_info = self.get_local_module_info(module_name)
+        local_info = self.modules.get_local_module_info(module_name)
+        if action != "Install":
+            try:
+                InstallerEngine.check_module_env(local_info, env, module_name)
+            except Exception as e:
+                messagebox.showwarning("提示", str(e))
+                return
 
         if action == "Uninstall":
             msg = f"确定要彻底卸载 [{env_display}] 环境的配置吗？\n\n模块名称: {module_name}\nApp名称: {app_display_name}\n\n这将执行以下操作：\n1. 删除本地 PowerShell 模块\n2. 清理 PowerShell Profile\n3. 删除本地证书\n4. 登录 Azure 并删除应用程序\n\n此操作不可撤销。"
@@ -330,10 +4113,46 @@ class ConnectEXOInstallerApp:
             
             self.btn_start.config(state='disabled', text="正在卸载...")
             self.progress_val.set(0)
-            threading.Thread(target=self.run_uninstall, args=(env, module_name, app_display_name, cert_subject, local_info), daemon=True).start()
+            self._submit(self.run_uninstall(env, module_name, local_info))
+            return
+
+        if action == "Verify":
+            # 只读检查，不需要确认
+            self.btn_start.config(state='disabled', text="正在检查...")
+            self.progress_val.set(0)
+            self._submit(self.run_verify(env, module_name))
+            return
+
+        if action == "Rotate":
+            if not local_info["Exists"] or not local_info["AppID"]:
+                messagebox.showwarning("提示", f"本地未找到模块 ({module_name})，无法更换证书。\n\n请使用 '安装 / 更新' 重新配置。")
+                return
+            if not messagebox.askyesno("确认更换证书", f"将为模块 ({module_name}) 生成新证书并替换应用中的旧证书。\n\n"
+                                       "应用、服务主体和角色保持不变，连接不会中断。是否继续？"):
+                return
+            self.btn_start.config(state='disabled', text="正在更换...")
+            self.progress_val.set(0)
+            self._submit(self.run_rotate(env, module_name))
             return
 
         # Install 逻辑
+        if self.modules.has_unfinished_install(env, module_name):
+            # 上次安装中途失败: 可以从检查点继续，跳过已完成的步骤
+            choice = messagebox.askyesnocancel(
+                "继续上次的安装",
+                f"检测到模块 ({module_name}) 上次的安装没有完成。\n\n"
+                "点击 '是 (Yes)' : 继续安装 (跳过已完成且仍然有效的步骤)。\n"
+                "点击 '否 (No)' : 重新完整安装。\n"
+                "点击 '取消' : 取消操作。"
+            )
+            if choice is None:
+                return
+            if choice:
+                self.btn_start.config(state='disabled', text="正在运行...")
+                self.progress_val.set(0)
+                self._submit(self.run_setup(env, module_name, True))
+                return
+
         if local_info["Exists"]:
             # 询问用户是更新还是重装
             choice = messagebox.askyesno(
@@ -348,496 +4167,405 @@ class ConnectEXOInstallerApp:
         self.btn_start.config(state='disabled', text="正在运行...")
         self.progress_val.set(0)
         # 将环境参数传递给 run_setup
-        threading.Thread(target=self.run_setup, args=(env, module_name, app_display_name, cert_subject), daemon=True).start()
+        self._submit(self.run_setup(env, module_name))
 
-    def get_documents_dir(self):
-        """获取真实的 'My Documents' 路径 (兼容 OneDrive)"""
-        try:
-            import ctypes.wintypes
-            CSIDL_PERSONAL = 5       # My Documents
-            SHGFP_TYPE_CURRENT = 0   # Get current, not default value
-            buf = ctypes.create_unicode_buffer(ctypes.wintypes.MAX_PATH)
-            ctypes.windll.shell32.SHGetFolderPathW(None, CSIDL_PERSONAL, None, SHGFP_TYPE_CURRENT, buf)
-            return buf.value
-        except:
-            return os.path.join(os.path.expanduser("~"), "Documents")
+    def _submit(self, coro):
+        import asyncio
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            threading.Thread(target=self._loop.run_forever, name="ConnectEXO-Loop", daemon=True).start()
+            asyncio.run_coroutine_threadsafe(self._consume_events(), self._loop)
+        asyncio.run_coroutine_threadsafe(coro, self._loop)
 
-    def get_best_module_path(self):
-        """
-        获取最佳的 PowerShell 模块安装路径。
-        通过执行 PowerShell 命令来获取真实的 PSModulePath，而不是依赖 Python 进程的环境变量。
-        """
-        user_home = os.path.expanduser("~")
-        
-        # 尝试获取 PowerShell Core (pwsh) 和 Windows PowerShell (powershell) 的路径
-        candidates = []
-        
-        for ps_cmd in ["pwsh", "powershell"]:
+    async def _consume_events(self):
+        # 引擎事件 → 事件总线 (写日志文件、按帧刷新日志框和进度条)
+        async for event in self.engine.events():
             try:
-                # 获取当前用户的 PSModulePath
-                cmd = [ps_cmd, "-NoProfile", "-Command", "[Environment]::GetEnvironmentVariable('PSModulePath', 'User')"]
-                # creationflags=0x08000000 (CREATE_NO_WINDOW)
-                creation_flags = 0x08000000 if sys.platform == 'win32' else 0
-                process = subprocess.run(cmd, capture_output=True, text=True, creationflags=creation_flags)
-                
-                if process.returncode == 0:
-                    paths = process.stdout.strip().split(';')
-                    for p in paths:
-                        p = p.strip()
-                        # 只要路径不为空，就加入候选 (不再强制检查 startswith(user_home)，因为 OneDrive 路径可能不同)
-                        if p:
-                            candidates.append(p)
-            except FileNotFoundError:
-                continue # 如果没安装 pwsh，跳过
-            except Exception:
-                continue
+                if event["type"] == "log":
+                    self.log(event["message"], event["level"])
+                elif event["type"] == "progress":
+                    self.set_progress(event["percent"], event["status"])
+            except Exception as e:
+                self.log_writer.write(f"界面更新失败: {e}", "ERROR")
 
-        # 去重并保持顺序
-        unique_candidates = []
-        for p in candidates:
-            if p not in unique_candidates:
-                unique_candidates.append(p)
+    async def _ui_call(self, func, *args, **kwargs):
+        """在主线程执行 func (对话框等) 并等待结果，不阻塞事件循环"""
+        import asyncio
+        return await asyncio.wrap_future(self.bus.submit(func, *args, **kwargs))
 
-        # 1. 优先选择已存在的路径
-        for path in unique_candidates:
-            if os.path.exists(path):
-                return path
-                
-        # 2. 如果都不存在，选择第一个看起来合理的路径 (优先选 Documents 下的)
-        for path in unique_candidates:
-            if "Documents" in path:
-                return path
-        
-        # 3. 如果还是没有，Fallback 到默认路径 (使用真实的 Documents 路径)
-        real_docs = self.get_documents_dir()
-        
-        # 优先尝试 PowerShell 7 (Core) 路径，如果用户装了的话
-        ps7_path = os.path.join(real_docs, "PowerShell", "Modules")
-        ps5_path = os.path.join(real_docs, "WindowsPowerShell", "Modules")
-        
-        # 如果检测到 pwsh 存在，优先用 ps7_path
-        try:
-            subprocess.run(["pwsh", "-v"], capture_output=True, creationflags=0x08000000 if sys.platform == 'win32' else 0)
-            return ps7_path
-        except:
-            return ps5_path
+    async def _finish_action(self, refresh_modules=True):
+        # 写日志文件是阻塞操作，放到线程池中执行，不阻塞事件循环
+        import asyncio
+        await asyncio.get_running_loop().run_in_executor(None, self.log_writer.flush)
+        if refresh_modules:
+            self.bus.call_soon(self.refresh_module_choices)
+        self.bus.call_soon(self.btn_start.config, state='normal', text="开始自动化配置")
 
-    def get_profile_path(self):
-        """
-        根据模块路径推断 Profile 路径。
-        """
-        module_path = self.get_best_module_path()
-        # module_path is usually .../Documents/PowerShell/Modules or .../Documents/WindowsPowerShell/Modules
-        
-        # Go up one level from Modules folder to get the config root
-        # .../Documents/PowerShell/Modules -> .../Documents/PowerShell
-        config_root = os.path.dirname(module_path)
-        
-        return os.path.join(config_root, "Microsoft.PowerShell_profile.ps1")
+    async def run_uninstall(self, env, module_name, local_info):
+        try:
+            await self.engine.uninstall(env, module_name, local_info=local_info, force_login=self._force_login)
+            await self._ui_call(messagebox.showinfo, "完成", f"[{env}] 环境的卸载清理已完成！")
+        except Exception as e:
+            self.log(f"发生未知错误: {e}", "ERROR")
+            await self._ui_call(messagebox.showerror, "错误", f"卸载过程中发生错误: {e}")
+        finally:
+            await self._finish_action()
 
-    def run_powershell_script(self, script):
-        command = ["powershell", "-NoProfile", "-ExecutionPolicy", "Bypass", "-Command", script]
-        process = subprocess.run(command, capture_output=True, text=True)
-        if process.returncode != 0:
-            raise Exception(f"PowerShell Error: {process.stderr}")
-        return process.stdout.strip()
+    async def run_rotate(self, env, module_name):
+        try:
+            result = await self.engine.rotate(env, module_name, force_login=self._force_login)
+            self.set_status("证书更换完成")
+            await self._ui_call(messagebox.showinfo, "完成", f"证书更换完成！\n\n新证书指纹: {result['thumbprint']}\n"
+                                                            f"有效期至: {(result.get('cert_expiry') or '未知')[:10]}")
+        except Exception as e:
+            self.log(f"X 发生错误: {e}", "ERROR")
+            self.set_status("执行出错")
+            await self._ui_call(messagebox.showerror, "错误", f"更换证书过程中发生错误:\n{e}")
+        finally:
+            await self._finish_action()
 
-    def run_uninstall(self, env, module_name, app_display_name, cert_subject, local_info):
-        total_steps = 5
-        current_step = 0
-        
+    async def run_verify(self, env, module_name):
         try:
-            # 配置环境参数
-            if env == "China":
-                authority_host = "https://login.chinacloudapi.cn"
-                graph_endpoint = "https://microsoftgraph.chinacloudapi.cn"
-                scope = "https://microsoftgraph.chinacloudapi.cn/.default"
+            result = await self.engine.verify(env, module_name, force_login=self._force_login)
+            failed = [c for c in result["checks"] if c["status"] == "fail"]
+            warned = [c for c in result["checks"] if c["status"] == "warn"]
+            summary = "\n".join(f"{'X' if c['status'] == 'fail' else '!'} {c['name']}: {c['detail']}" for c in failed + warned)
+            if failed:
+                self.set_status("检查未通过")
+                await self._ui_call(messagebox.showwarning, "检查结果", f"发现 {len(failed)} 个问题:\n\n{summary}")
             else:
-                authority_host = "https://login.microsoftonline.com"
-                graph_endpoint = "https://graph.microsoft.com"
-                scope = "https://graph.microsoft.com/.default"
+                self.set_status("配置正常")
+                await self._ui_call(messagebox.showinfo, "检查结果", f"[{module_name}] 配置正常。" + (f"\n\n{summary}" if warned else ""))
+        except Exception as e:
+            self.log(f"X 发生错误: {e}", "ERROR")
+            self.set_status("执行出错")
+            await self._ui_call(messagebox.showerror, "错误", f"检查过程中发生错误:\n{e}")
+        finally:
+            await self._finish_action(refresh_modules=False)
 
-            # --- Step 1: 清理本地模块 ---
-            current_step += 1
-            self.update_progress(current_step, total_steps, f">>> 正在清理本地 PowerShell 模块 ({module_name})...")
-            
-            base_module_path = self.get_best_module_path()
-            module_path = os.path.join(base_module_path, module_name)
-            
-            if os.path.exists(module_path):
-                try:
-                    import shutil
-                    shutil.rmtree(module_path)
-                    self.log(f"√ 已删除本地模块文件夹: {module_path}", "SUCCESS")
-                except Exception as e:
-                    self.log(f"X 删除模块文件夹失败: {e}", "ERROR")
-            else:
-                self.log(f"! 本地模块文件夹不存在，跳过: {module_path}", "WARNING")
+    async def run_cleanup(self, env):
+        try:
+            force_login = self._force_login
+            preview = await self.engine.cleanup_orphans(env, dry_run=True, force_login=force_login)
+            orphans = preview["orphans"]
+            if not orphans:
+                await self._ui_call(messagebox.showinfo, "完成", f"没有发现孤立的 *-Automation-App 应用 (在用 {len(preview['in_use'])} 个)。")
+                return
 
-            # --- Step 2: 清理 Profile ---
-            current_step += 1
-            self.update_progress(current_step, total_steps, ">>> 正在清理 PowerShell Profile...")
-            
-            profile_path = self.get_profile_path()
-            if os.path.exists(profile_path):
+            names = "\n".join(f"{app['displayName']} ({app['appId']})" for app in orphans[:15])
+            if len(orphans) > 15:
+                names += f"\n... 以及另外 {len(orphans) - 15} 个"
+            msg = (f"发现 {len(orphans)} 个孤立应用 (本机没有对应模块，或模块记录的 AppID 不同):\n\n{names}\n\n"
+                   "注意: 只与本机的模块对照，其他电脑上仍在使用的应用也会被列出。\n\n确定要删除这些应用吗？此操作不可撤销。")
+            if not await self._ui_call(messagebox.askyesno, "确认清理", msg):
+                self.log("已取消清理")
+                return
+
+            self.bus.call_soon(self.btn_start.config, text="正在清理...")
+            result = await self.engine.cleanup_orphans(env, dry_run=False, orphans=orphans)
+            self.set_progress(100)
+            await self._ui_call(messagebox.showinfo, "完成", f"清理完成: 删除 {result['deleted']} 个，失败 {result['failed']} 个。")
+        except Exception as e:
+            self.log(f"X 发生错误: {e}", "ERROR")
+            await self._ui_call(messagebox.showerror, "错误", f"清理过程中发生错误: {e}")
+        finally:
+            await self._finish_action(refresh_modules=False)
+
+    async def run_setup(self, env, module_name, resume=False):
+        try:
+            await self.engine.install(env, module_name, force_login=self._force_login, resume=resume)
+
+            # 完成
+            self.set_progress(100)
+            self.set_status("配置全部完成！")
+            self.log("-" * 30)
+            self.log(f"全部完成！请重启 PowerShell 并运行 '{module_name}'。", "SUCCESS")
+            await self._ui_call(messagebox.showinfo, "成功", f"配置全部完成！\n\n请重启 PowerShell 并运行 '{module_name}' 进行测试。")
+
+        except Exception as e:
+            self.log(f"X 发生错误: {str(e)}", "ERROR")
+            self.set_status("执行出错")
+            await self._ui_call(messagebox.showerror, "错误", f"执行过程中发生错误:\n{str(e)}")
+        finally:
+            await self._finish_action()
+
+class BulkProvisioner:
+    """
+    无界面批量配置。
+    从清单文件 (CSV / JSON / YAML) 读取每个租户的云环境、模块名称和租户提示，
+    通过 AsyncInstallerEngine 并发执行安装、卸载、更换证书或检查 (并发数 workers)，并写出每个租户的结果报告。
+    """
+
+    # 清单中允许的列名别名
+    FIELD_ALIASES = {
+        "environment": "env", "cloud": "env",
+        "module": "module_name", "name": "module_name",
+        "tenant_hint": "tenant", "tenant_id": "tenant", "domain": "tenant",
+        "account": "login_hint", "user": "login_hint",
+    }
+    ENV_ALIASES = {"global": "Global", "china": "China", "21vianet": "China"}
+
+    def __init__(self, manifest_path, action="Install", workers=4, report_path=None, log_dir=None, force_login=False,
+                 resume=False):
+        self.manifest_path = manifest_path
+        self.force_login = force_login
+        self.resume = resume
+        self.action = action
+        self.workers = max(int(workers), 1)
+        base = os.path.splitext(os.path.abspath(manifest_path))[0]
+        self.report_path = report_path or f"{base}_report.json"
+        self.log_dir = log_dir or f"{base}_logs"
+        self._print_lock = threading.Lock()
+
+    @classmethod
+    def load_manifest(cls, path):
+        """读取清单，返回规范化后的行列表 (env / module_name / tenant / login_hint / action)"""
+        ext = os.path.splitext(path)[1].lower()
+        with open(path, "r", encoding="utf-8-sig") as f:
+            if ext == ".json":
+                data = json.load(f)
+            elif ext in (".yaml", ".yml"):
                 try:
-                    # 读取所有行
-                    with open(profile_path, "r", encoding="utf-8-sig") as f:
-                        lines = f.readlines()
-                    
-                    # 过滤掉包含模块名称的行 (精确匹配)
-                    new_lines = []
-                    removed_count = 0
-                    for line in lines:
-                        # 使用更严格的正则: 匹配 (行首或空白) + 模块名 + (空白或行尾)
-                        pattern = rf"(?i)(^|\s){re.escape(module_name)}(\s|$)"
-                        if re.search(pattern, line):
-                            removed_count += 1
-                            self.log(f"  - 移除 Profile 行: {line.strip()}")
-                        else:
-                            new_lines.append(line)
-                    
-                    if removed_count > 0:
-                        with open(profile_path, "w", encoding="utf-8-sig") as f:
-                            f.writelines(new_lines)
-                        self.log(f"√ 已从 Profile 中移除 {removed_count} 行配置", "SUCCESS")
-                    else:
-                        self.log("! Profile 中未找到相关配置，无需修改", "WARNING")
-                except Exception as e:
-                    self.log(f"X 修改 Profile 失败: {e}", "ERROR")
+                    import yaml
+                except ImportError:
+                    raise Exception("读取 YAML 清单需要 PyYAML，请运行: pip install pyyaml")
+                data = yaml.safe_load(f)
             else:
-                self.log("! 未找到 PowerShell Profile 文件，跳过", "WARNING")
+                import csv
+                data = list(csv.DictReader(f))
 
-            # --- Step 3: 清理本地证书 ---
-            current_step += 1
-            self.update_progress(current_step, total_steps, ">>> 正在清理本地证书...")
-            
-            thumbprint_to_delete = local_info.get("Thumbprint")
-            
-            try:
-                if thumbprint_to_delete:
-                    self.log(f"正在根据指纹删除证书: {thumbprint_to_delete}")
-                    ps_script = f"Get-ChildItem Cert:\\CurrentUser\\My | Where-Object {{ $_.Thumbprint -eq '{thumbprint_to_delete}' }} | Remove-Item"
-                    self.run_powershell_script(ps_script)
-                    self.log("√ 已尝试删除指定指纹的证书", "SUCCESS")
-                else:
-                    # 如果没有指纹，尝试按 Subject 删除
-                    self.log(f"未找到本地指纹记录，尝试按 Subject 删除: {cert_subject}")
-                    ps_script = f"Get-ChildItem Cert:\\CurrentUser\\My | Where-Object {{ $_.Subject -like '*{cert_subject}*' }} | Remove-Item"
-                    self.run_powershell_script(ps_script)
-                    self.log("√ 已尝试删除匹配 Subject 的证书", "SUCCESS")
-            except Exception as e:
-                self.log(f"X 删除证书失败: {e}", "WARNING")
+        if isinstance(data, dict):
+            data = data.get("tenants", [])
+        if not isinstance(data, list):
+            raise Exception("清单格式错误: 应为租户列表")
 
-            # --- Step 4: Azure 登录 ---
-            current_step += 1
-            self.update_progress(current_step, total_steps, f">>> 正在登录 Azure ({env}) 以清理应用程序...")
-            
-            try:
-                credential = InteractiveBrowserCredential(authority=authority_host)
-                token = credential.get_token(scope)
-                access_token = token.token
-                self.log("√ Azure 登录成功", "SUCCESS")
-                
-                # --- Step 5: 删除 Azure App ---
-                current_step += 1
-                
-                headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-                app_id_to_delete = local_info.get("AppID")
-                
-                if app_id_to_delete:
-                    self.update_progress(current_step, total_steps, f">>> 正在根据 AppID 删除 Azure App ({app_id_to_delete})...")
-                    # 直接按 AppID (Client ID) 查询 Object ID
-                    resp = requests.get(f"{graph_endpoint}/v1.0/applications?$filter=appId eq '{app_id_to_delete}'", headers=headers)
-                    if resp.status_code == 200:
-                        apps = resp.json().get('value', [])
-                        if apps:
-                            obj_id = apps[0]['id']
-                            del_resp = requests.delete(f"{graph_endpoint}/v1.0/applications/{obj_id}", headers=headers)
-                            if del_resp.status_code == 204:
-                                self.log(f"√ 已删除 Azure App (AppID: {app_id_to_delete})", "SUCCESS")
-                            else:
-                                self.log(f"X 删除 Azure App 失败: {del_resp.text}", "ERROR")
-                        else:
-                            self.log(f"! 未找到 AppID 为 {app_id_to_delete} 的应用", "WARNING")
-                    else:
-                        self.log(f"X 查询 App 失败: {resp.text}", "ERROR")
-                else:
-                    # Fallback: 按名称删除
-                    self.update_progress(current_step, total_steps, f">>> 正在根据名称查找并删除 Azure App ({app_display_name})...")
-                    resp = requests.get(f"{graph_endpoint}/v1.0/applications?$filter=displayName eq '{app_display_name}'", headers=headers)
-                    
-                    if resp.status_code == 200:
-                        apps = resp.json().get('value', [])
-                        if apps:
-                            for app in apps:
-                                del_resp = requests.delete(f"{graph_endpoint}/v1.0/applications/{app['id']}", headers=headers)
-                                if del_resp.status_code == 204:
-                                    self.log(f"√ 已删除 Azure App: {app_display_name} (ID: {app['appId']})", "SUCCESS")
-                                else:
-                                    self.log(f"X 删除 Azure App 失败: {del_resp.text}", "ERROR")
-                        else:
-                            self.log(f"! 未找到名为 {app_display_name} 的 Azure App", "WARNING")
-                    else:
-                        self.log(f"X 查询 Azure App 失败: {resp.text}", "ERROR")
+        rows = []
+        seen = set()
+        for number, raw in enumerate(data, 1):
+            row = {}
+            for key, value in (raw or {}).items():
+                if key is None:
+                    continue
+                key = str(key).strip().lower().replace(" ", "_")
+                row[cls.FIELD_ALIASES.get(key, key)] = str(value).strip() if value is not None else ""
 
-            except Exception as e:
-                self.log(f"X Azure 操作失败 (可能是登录取消或网络问题): {e}", "ERROR")
+            env = cls.ENV_ALIASES.get(row.get("env", "").lower())
+            module_name = row.get("module_name") or ""
+            if not env:
+                raise Exception(f"清单第 {number} 行: 云环境必须是 Global 或 China (21Vianet)")
+            if not module_name:
+                module_name = "ConnectEXO21V" if env == "China" else "ConnectEXO"
+            if not re.match(r'^[a-zA-Z0-9]+$', module_name):
+                raise Exception(f"清单第 {number} 行: 模块名称只能包含字母和数字 ({module_name})")
+            # 同一台机器上模块名称就是文件夹名称，不能重复
+            if module_name.lower() in seen:
+                raise Exception(f"清单第 {number} 行: 模块名称重复 ({module_name})")
+            seen.add(module_name.lower())
+
+            action = row.get("action", "").capitalize()
+            if action and action not in ("Install", "Uninstall", "Rotate", "Verify"):
+                raise Exception(f"清单第 {number} 行: 操作必须是 Install、Uninstall、Rotate 或 Verify")
 
-            self.update_progress(total_steps, total_steps, ">>> 卸载操作完成")
-            messagebox.showinfo("完成", f"[{env}] 环境的卸载清理已完成！")
+            rows.append({"env": env, "module_name": module_name, "tenant": row.get("tenant") or None,
+                         "login_hint": row.get("login_hint") or None, "action": action or None})
+        return rows
 
+    def _print(self, text):
+        # PyInstaller --noconsole 打包后没有标准输出
+        if sys.stdout is None:
+            return
+        with self._print_lock:
+            print(text, flush=True)
+
+    async def _run_row(self, engine, row):
+        action = row["action"] or self.action
+        module_name = row["module_name"]
+        result = {"module_name": module_name, "env": row["env"], "tenant": row["tenant"], "action": action,
+                  "status": "Success", "error": None, "log": self._log_path(row)}
+        start = time.monotonic()
+        try:
+            kwargs = {"tenant": row["tenant"], "login_hint": row["login_hint"], "force_login": self.force_login}
+            if action == "Uninstall":
+                result.update(await engine.uninstall(row["env"], module_name, **kwargs))
+            elif action == "Rotate":
+                result.update(await engine.rotate(row["env"], module_name, **kwargs))
+            elif action == "Verify":
+                verify_result = await engine.verify(row["env"], module_name, **kwargs)
+                result["checks"] = verify_result["checks"]
+                failed = [c["name"] for c in verify_result["checks"] if c["status"] == "fail"]
+                if failed:
+                    raise Exception(f"检查未通过: {', '.join(failed)}")
+            else:
+                result.update(await engine.install(row["env"], module_name, resume=self.resume, **kwargs))
         except Exception as e:
-            self.log(f"发生未知错误: {e}", "ERROR")
-            messagebox.showerror("错误", f"卸载过程中发生错误: {e}")
+            result["status"] = "Failed"
+            result["error"] = str(e)
         finally:
-            self.btn_start.config(state='normal', text="开始自动化配置")
+            result["elapsed"] = round(time.monotonic() - start, 1)
+        return result
 
-    def run_setup(self, env, module_name, app_display_name, cert_subject):
-        total_steps = 10
-        current_step = 0
-        
+    def _log_path(self, row):
+        return os.path.join(self.log_dir, f"{row['module_name']}_{row['env']}.log")
+
+    async def _write_logs(self, engine):
+        """消费引擎事件: 每个租户写入单独的日志文件，并输出到控制台"""
+        writers = {}
         try:
-            # 配置环境参数
-            if env == "China":
-                authority_host = "https://login.chinacloudapi.cn"
-                graph_endpoint = "https://microsoftgraph.chinacloudapi.cn"
-                scope = "https://microsoftgraph.chinacloudapi.cn/.default"
-                # 修正: 21Vianet 环境参数应为 O365China
-                exo_env_param = "-ExchangeEnvironmentName O365China"
-            else:
-                authority_host = "https://login.microsoftonline.com"
-                graph_endpoint = "https://graph.microsoft.com"
-                scope = "https://graph.microsoft.com/.default"
-                exo_env_param = "" 
-            
-            # 使用传入的参数
-            function_name = module_name
-            cert_dns_name = cert_subject
+            async for event in engine.events():
+                module_name = event["module_name"]
+                if event["type"] == "log":
+                    message, level = event["message"], event["level"]
+                elif event["type"] == "failed":
+                    message, level = f"X 发生错误: {event['error']}", "ERROR"
+                else:
+                    continue
+                if module_name not in writers:
+                    log_path = self._log_path({"module_name": module_name, "env": event["env"]})
+                    writers[module_name] = LogWriter(log_path, json_path=os.path.splitext(log_path)[0] + ".jsonl")
+                writers[module_name].write(message, level, module=module_name, env=event["env"])
+                self._print(f"[{module_name}] {message}")
+        finally:
+            for writer in writers.values():
+                writer.close()
 
-            # --- Step 1: Azure 登录 ---
-            current_step += 1
-            self.update_progress(current_step, total_steps, f">>> 正在启动 Azure ({env}) 浏览器登录...")
-            
-            credential = InteractiveBrowserCredential(authority=authority_host)
-            token = credential.get_token(scope)
-            access_token = token.token
-            self.log("√ Azure 登录成功！", "SUCCESS")
-
-            # --- Step 2: 获取租户信息 ---
-            current_step += 1
-            self.update_progress(current_step, total_steps, ">>> 获取租户信息...")
-            
-            headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-            resp = requests.get(f"{graph_endpoint}/v1.0/organization", headers=headers)
-            if resp.status_code != 200: raise Exception(f"无法获取租户信息: {resp.text}")
-            
-            org_info = resp.json()['value'][0]
-            tenant_domain = org_info['verifiedDomains'][0]['name']
-            for d in org_info['verifiedDomains']:
-                if d['isDefault']:
-                    tenant_domain = d['name']
-                    break
-            self.log(f"√ 检测到租户域名: {tenant_domain}", "SUCCESS")
+    async def _run_all(self, rows, ps_host, path_resolver):
+        import asyncio
+        engine = AsyncInstallerEngine(self.workers, ps_host, path_resolver, trace_dir=self.log_dir)
+        log_task = asyncio.ensure_future(self._write_logs(engine))
+        try:
+            results = await asyncio.gather(*(self._run_row(engine, row) for row in rows))
+        finally:
+            # 关闭后事件流结束，等待所有日志写完
+            await engine.aclose()
+            await log_task
+        return list(results)
 
-            # --- Step 3: 清理旧应用 ---
-            current_step += 1
-            self.update_progress(current_step, total_steps, f">>> 检查并清理旧配置 ({app_display_name})...")
-            
-            resp = requests.get(f"{graph_endpoint}/v1.0/applications?$filter=displayName eq '{app_display_name}'", headers=headers)
-            if resp.status_code == 200:
-                existing_apps = resp.json().get('value', [])
-                if existing_apps:
-                    self.log(f"发现 {len(existing_apps)} 个同名旧应用，正在清理...", "WARNING")
-                    for old_app in existing_apps:
-                        del_resp = requests.delete(f"{graph_endpoint}/v1.0/applications/{old_app['id']}", headers=headers)
-                        if del_resp.status_code == 204: self.log(f"√ 已删除旧应用: {old_app['appId']}", "SUCCESS")
-
-            # --- Step 4: 本地生成证书 ---
-            current_step += 1
-            self.update_progress(current_step, total_steps, ">>> 本地生成自签名证书...")
-            
-            ps_script = f"""
-            $cert = New-SelfSignedCertificate -DnsName "{cert_dns_name}" -CertStoreLocation "cert:\\CurrentUser\\My" -KeyExportPolicy Exportable -Provider "Microsoft Enhanced RSA and AES Cryptographic Provider" -NotAfter (Get-Date).AddYears(2)
-            $thumbprint = $cert.Thumbprint
-            $certContent = [System.Convert]::ToBase64String($cert.GetRawCertData())
-            $result = @{{Thumbprint=$thumbprint; Base64=$certContent}}
-            $result | ConvertTo-Json -Compress
-            """
-            cert_json = self.run_powershell_script(ps_script)
-            cert_data = json.loads(cert_json)
-            thumbprint = cert_data['Thumbprint']
-            cert_blob = cert_data['Base64']
-            self.log(f"√ 证书已生成 (指纹: {thumbprint})", "SUCCESS")
-
-            # --- Step 5: 创建 Azure AD 应用 ---
-            current_step += 1
-            self.update_progress(current_step, total_steps, ">>> 创建 Azure AD 应用程序...")
-            
-            app_body = {
-                "displayName": app_display_name,
-                "signInAudience": "AzureADMyOrg",
-                "keyCredentials": [{
-                    "type": "AsymmetricX509Cert",
-                    "usage": "Verify",
-                    "key": cert_blob,
-                    "displayName": f"{cert_dns_name}-Cert"
-                }]
+    def write_report(self, results):
+        report_dir = os.path.dirname(os.path.abspath(self.report_path))
+        os.makedirs(report_dir, exist_ok=True)
+        if self.report_path.lower().endswith(".csv"):
+            import csv
+            columns = ["module_name", "env", "tenant", "action", "status", "error", "elapsed",
+                       "tenant_domain", "app_id", "sp_id", "thumbprint", "log"]
+            with open(self.report_path, "w", encoding="utf-8-sig", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
+                writer.writeheader()
+                writer.writerows(results)
+        else:
+            summary = {
+                "manifest": os.path.abspath(self.manifest_path),
+                "finished_at": time.strftime('%Y-%m-%d %H:%M:%S'),
+                "succeeded": sum(1 for r in results if r["status"] == "Success"),
+                "failed": sum(1 for r in results if r["status"] != "Success"),
+                "results": results,
             }
-            resp = requests.post(f"{graph_endpoint}/v1.0/applications", headers=headers, json=app_body)
-            if resp.status_code != 201: raise Exception(f"创建应用失败: {resp.text}")
-            
-            app_info = resp.json()
-            app_id = app_info['appId']
-            self.log(f"√ 应用程序创建成功 (App ID: {app_id})", "SUCCESS")
+            with open(self.report_path, "w", encoding="utf-8") as f:
+                json.dump(summary, f, ensure_ascii=False, indent=2)
 
-            # --- Step 6: 创建服务主体 ---
-            current_step += 1
-            self.update_progress(current_step, total_steps, ">>> 创建服务主体 (Service Principal)...")
-            
-            time.sleep(5) # 等待 App 传播
-            sp_body = {"appId": app_id}
-            resp = requests.post(f"{graph_endpoint}/v1.0/servicePrincipals", headers=headers, json=sp_body)
-            if resp.status_code != 201:
-                resp = requests.get(f"{graph_endpoint}/v1.0/servicePrincipals?$filter=appId eq '{app_id}'", headers=headers)
-                sp_info = resp.json()['value'][0]
-            else:
-                sp_info = resp.json()
-            sp_id = sp_info['id']
-            self.log(f"√ 服务主体就绪 (Object ID: {sp_id})", "SUCCESS")
+    def run(self):
+        import asyncio
 
-            # --- Step 7: 授予 API 权限 ---
-            current_step += 1
-            self.update_progress(current_step, total_steps, ">>> 授予 Exchange.ManageAsApp 权限...")
-            
-            # Exchange Online AppId (Global & China 相同)
-            exo_app_id = "00000002-0000-0ff1-ce00-000000000000"
-            resp = requests.get(f"{graph_endpoint}/v1.0/servicePrincipals?$filter=appId eq '{exo_app_id}'", headers=headers)
-            exo_sp_info = resp.json()['value'][0]
-            exo_sp_id = exo_sp_info['id']
-            
-            manage_as_app_role_id = next((r['id'] for r in exo_sp_info['appRoles'] if r['value'] == "Exchange.ManageAsApp"), None)
-            if not manage_as_app_role_id: raise Exception("未找到 Exchange.ManageAsApp 角色定义")
+        rows = self.load_manifest(self.manifest_path)
+        os.makedirs(self.log_dir, exist_ok=True)
+        self._print(f">>> 共 {len(rows)} 个租户，并发数 {self.workers}")
 
-            assignment_body = {"principalId": sp_id, "resourceId": exo_sp_id, "appRoleId": manage_as_app_role_id}
-            resp = requests.post(f"{graph_endpoint}/v1.0/servicePrincipals/{sp_id}/appRoleAssignments", headers=headers, json=assignment_body)
-            if resp.status_code not in [201, 409]: raise Exception(f"权限授予失败: {resp.text}")
-            self.log("√ 权限授予成功", "SUCCESS")
+        # 所有任务共享同一个 PowerShell 工作进程和模块路径解析结果
+        ps_host = PowerShellHost()
+        path_resolver = PowerShellPathResolver(get_documents_dir)
+        path_resolver.warm_up()
+        start = time.monotonic()
+        try:
+            results = asyncio.run(self._run_all(rows, ps_host, path_resolver))
+        finally:
+            ps_host.close()
 
-            # --- Step 8: 安装 PowerShell 模块 ---
-            current_step += 1
-            self.update_progress(current_step, total_steps, ">>> 检查 ExchangeOnlineManagement 模块...")
-            
-            install_module_script = """
-            $ErrorActionPreference = 'Stop'
-            [Net.ServicePointManager]::SecurityProtocol = [Net.SecurityProtocolType]::Tls12
-            $nuget = Get-PackageProvider -Name NuGet -ListAvailable -ErrorAction SilentlyContinue
-            if (-not $nuget) { Install-PackageProvider -Name NuGet -MinimumVersion 2.8.5.201 -Force -Scope CurrentUser -Confirm:$false }
-            if (-not (Get-Module -ListAvailable -Name ExchangeOnlineManagement)) {
-                try { Set-PSRepository -Name PSGallery -InstallationPolicy Trusted -ErrorAction SilentlyContinue } catch {}
-                Install-Module -Name ExchangeOnlineManagement -Force -AllowClobber -Scope CurrentUser -Repository PSGallery -Confirm:$false
-            }
-            """
-            try:
-                self.run_powershell_script(install_module_script)
-                self.log("√ 模块检查/安装完成", "SUCCESS")
-            except Exception as e:
-                self.log(f"X 模块安装遇到问题: {str(e)}", "WARNING")
+        self.write_report(results)
+        for limiter in GraphRateLimiter.all():
+            if limiter.stats["acquired"]:
+                self._print(f"Graph 限速 ({limiter.key[1]}): {limiter.summary()}")
+        failed = [r for r in results if r["status"] != "Success"]
+        self._print(f">>> 完成: 成功 {len(results) - len(failed)} 个, 失败 {len(failed)} 个, "
+                    f"总耗时 {time.monotonic() - start:.0f} 秒。报告: {self.report_path}")
+        return results
 
-            # --- Step 9: 分配管理员角色 ---
-            current_step += 1
-            self.update_progress(current_step, total_steps, ">>> 分配 Exchange Administrator 角色...")
-            
-            role_template_id = "29232cdf-9323-42fd-ade2-1d097af3e4de"
-            
-            # 优先使用 Legacy API (directoryRoles) 以确保 Exchange Online 兼容性
-            # 1. 激活角色 (如果尚未激活)
-            requests.post(f"{graph_endpoint}/v1.0/directoryRoles", headers=headers, json={"roleTemplateId": role_template_id})
-            
-            # 2. 获取角色实例 ID
-            resp = requests.get(f"{graph_endpoint}/v1.0/directoryRoles?$filter=roleTemplateId eq '{role_template_id}'", headers=headers)
-            
-            role_assigned = False
-            if resp.status_code == 200 and resp.json().get('value'):
-                role_id = resp.json()['value'][0]['id']
-                member_body = {"@odata.id": f"{graph_endpoint}/v1.0/directoryObjects/{sp_id}"}
-                
-                # 3. 添加成员
-                resp = requests.post(f"{graph_endpoint}/v1.0/directoryRoles/{role_id}/members/$ref", headers=headers, json=member_body)
-                
-                if resp.status_code == 204 or "already exist" in resp.text:
-                    self.log("√ 角色分配成功 (Legacy API)", "SUCCESS")
-                    role_assigned = True
-                else:
-                    self.log(f"! Legacy API 分配失败: {resp.text}，尝试 Unified API...", "WARNING")
-            
-            # 如果 Legacy API 失败，尝试 Unified API (roleManagement)
-            if not role_assigned:
-                role_assignment_body = {"principalId": sp_id, "roleDefinitionId": role_template_id, "directoryScopeId": "/"}
-                resp = requests.post(f"{graph_endpoint}/v1.0/roleManagement/directory/roleAssignments", headers=headers, json=role_assignment_body)
-                
-                if resp.status_code == 201 or "already exists" in resp.text:
-                    self.log("√ 角色分配成功 (Unified API)", "SUCCESS")
-                else:
-                    self.log(f"X 角色分配失败: {resp.text}", "ERROR")
 
-            # 提示用户等待生效
-            self.log("! 注意: 角色分配可能需要 5-15 分钟生效，如果连接报错请稍后重试。", "WARNING")
+def run_console(operation):
+    """命令行单个操作: 通过 AsyncInstallerEngine 执行 operation(engine)，日志事件输出到控制台，返回操作结果"""
+    import asyncio
 
-            # --- Step 10: 本地配置 ---
-            current_step += 1
-            self.update_progress(current_step, total_steps, f">>> 生成本地连接脚本 ({module_name})...")
-            
-            base_module_path = self.get_best_module_path()
-            module_dir = os.path.join(base_module_path, module_name)
-            if not os.path.exists(module_dir): os.makedirs(module_dir)
-            
-            psm1_content = f"""
-function {function_name} {{
-    param(
-        [string]$Thumbprint = "{thumbprint}",
-        [string]$AppID = "{app_id}",
-        [string]$Organization = "{tenant_domain}"
-    )
-    Write-Host "Connecting to Exchange Online ({env}) for $Organization..." -ForegroundColor Cyan
-    Connect-ExchangeOnline -CertificateThumbprint $Thumbprint -AppID $AppID -Organization $Organization {exo_env_param}
-}}
-Export-ModuleMember -Function {function_name}
-"""
-            with open(os.path.join(module_dir, f"{module_name}.psm1"), "w", encoding="utf-8") as f:
-                f.write(psm1_content)
-            
-            # Update Profile
-            profile_path = self.get_profile_path()
-            if not os.path.exists(os.path.dirname(profile_path)): os.makedirs(os.path.dirname(profile_path))
-            
-            current_content = ""
-            if os.path.exists(profile_path):
-                with open(profile_path, "r", encoding="utf-8") as f: current_content = f.read()
-            
-            import_cmd = f"Import-Module {module_name}"
-            if import_cmd not in current_content:
-                with open(profile_path, "a", encoding="utf-8") as f:
-                    if current_content and not current_content.endswith("\n"): f.write("\n")
-                    f.write(f"{import_cmd}\n")
-            
-            self.log("√ 本地模块配置完成", "SUCCESS")
-            
-            # 完成
-            self.progress_val.set(100)
-            self.status_var.set("配置全部完成！")
-            self.log("-" * 30)
-            self.log(f"全部完成！请重启 PowerShell 并运行 '{function_name}'。", "SUCCESS")
-            messagebox.showinfo("成功", f"配置全部完成！\n\n请重启 PowerShell 并运行 '{function_name}' 进行测试。")
+    async def print_events(engine):
+        async for event in engine.events():
+            # PyInstaller --noconsole 打包后没有标准输出
+            if event["type"] == "log" and sys.stdout is not None:
+                print(event["message"], flush=True)
 
-        except Exception as e:
-            self.log(f"X 发生错误: {str(e)}", "ERROR")
-            self.status_var.set("执行出错")
-            messagebox.showerror("错误", f"执行过程中发生错误:\n{str(e)}")
+    async def run():
+        engine = AsyncInstallerEngine(1)
+        printer = asyncio.ensure_future(print_events(engine))
+        try:
+            return await operation(engine)
         finally:
-            self.btn_start.config(state='normal', text="开始自动化配置")
+            await engine.aclose()
+            await printer
 
-if __name__ == "__main__":
+    return asyncio.run(run())
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Exchange Online PowerShell 自动连接 Module 配置工具")
+    parser.add_argument("--manifest", help="无界面批量模式: 租户清单文件 (CSV / JSON / YAML)，列: env, module_name, tenant, login_hint, action")
+    parser.add_argument("--action", choices=["install", "uninstall", "rotate", "verify"], default="install",
+                        help="清单中未指定操作时的默认操作 (rotate: 只更换证书，保留现有应用和角色；verify: 只读检查)")
+    parser.add_argument("--workers", type=int, default=4, help="同时处理的租户数量 (默认 4)")
+    parser.add_argument("--report", help="结果报告路径 (.json 或 .csv，默认与清单文件同目录)")
+    parser.add_argument("--resume", action="store_true", help="继续上次失败的安装，跳过已完成且资源仍然存在的步骤")
+    parser.add_argument("--relogin", action="store_true", help="忽略已保存的登录信息，重新打开浏览器登录")
+    parser.add_argument("--cleanup-orphans", action="store_true",
+                        help="清理租户中孤立的 *-Automation-App 应用 (默认只预览，加 --confirm 才会删除)")
+    parser.add_argument("--env", choices=["Global", "China"],
+                        help="--cleanup-orphans / --verify 使用的云环境 (默认 Global，--verify 默认使用模块记录的环境)；"
+                             "与 --list-modules 一起使用时只列出该环境的模块")
+    parser.add_argument("--tenant", help="--cleanup-orphans / --verify 使用的租户 (域名或 ID)")
+    parser.add_argument("--login-hint", help="--cleanup-orphans / --verify 使用的登录账号提示")
+    parser.add_argument("--confirm", action="store_true", help="与 --cleanup-orphans 一起使用: 实际删除孤立应用")
+    parser.add_argument("--verify", metavar="MODULE", help="只读检查已安装模块的本地文件、证书、Azure 应用、权限和角色")
+    parser.add_argument("--list-modules", action="store_true", help="列出本机已安装的连接模块 (可与 --env 一起使用)")
+    parser.add_argument("--startup-timing", nargs="?", const=True, metavar="REPORT",
+                        help="测量启动耗时 (首个窗口出现时间、导入耗时)，写出 JSON 报告后退出 (默认写到数据目录 startup_timing.json)")
+    args = parser.parse_args(argv)
+
+    if args.list_modules:
+        modules = ModuleRegistry().list(args.env)
+        if sys.stdout is not None:
+            for r in modules:
+                print(f"{r['module_name']:<20}{r.get('env') or '':<8}{r.get('tenant_domain') or '':<32}"
+                      f"AppID: {r.get('app_id')}  证书到期: {(r.get('cert_expiry') or '未知')[:10]}  {r.get('path')}")
+            if not modules:
+                print("本机没有已安装的模块")
+        return 0
+
+    if args.verify:
+        # 未指定 --env 时使用模块索引中记录的云环境
+        env = args.env or (ModuleRegistry().get(args.verify) or {}).get("env") or "Global"
+        result = run_console(lambda engine: engine.verify(env, args.verify, tenant=args.tenant, login_hint=args.login_hint,
+                                                          force_login=args.relogin))
+        return 0 if result["ok"] else 1
+
+    if args.cleanup_orphans:
+        result = run_console(lambda engine: engine.cleanup_orphans(args.env or "Global", tenant=args.tenant, login_hint=args.login_hint,
+                                                                   dry_run=not args.confirm, force_login=args.relogin))
+        if result["dry_run"] and result["orphans"] and sys.stdout is not None:
+            print(f"以上 {len(result['orphans'])} 个应用为预览结果，确认后加 --confirm 重新运行以删除。", flush=True)
+        return 0 if not result["failed"] else 1
+
+    if args.manifest:
+        provisioner = BulkProvisioner(args.manifest, action=args.action.capitalize(), workers=args.workers,
+                                      report_path=args.report, force_login=args.relogin, resume=args.resume)
+        results = provisioner.run()
+        return 0 if all(r["status"] == "Success" for r in results) else 1
+
+    startup_timer.mark("模块导入")
     root = tk.Tk()
     # 尝试设置高 DPI 感知 (Windows)
     try:
@@ -845,6 +4573,35 @@ if __name__ == "__main__":
         windll.shcore.SetProcessDpiAwareness(1)
     except:
         pass
-        
+    startup_timer.mark("Tk 初始化")
+
     app = ConnectEXOInstallerApp(root)
+    startup_timer.mark("界面构建")
+
+    if args.startup_timing:
+        def on_first_window(event=None):
+            if event is not None and event.widget is not root:
+                return
+            root.unbind("<Map>")
+            root.update_idletasks()
+            startup_timer.mark("首个窗口")
+            # 窗口出现后再测量延迟导入的库，了解首次使用时的额外开销
+            for module_name in REQUIRED_PACKAGES:
+                startup_timer.measure_import(module_name)
+            report_path = args.startup_timing if isinstance(args.startup_timing, str) else \
+                os.path.join(get_app_data_dir(), "startup_timing.json")
+            report = startup_timer.write(report_path)
+            if sys.stdout is not None:
+                print(json.dumps(report, ensure_ascii=False, indent=2), flush=True)
+            root.destroy()
+
+        root.bind("<Map>", on_first_window)
+    else:
+        root.after(200, lambda: threading.Thread(target=preload_dependencies, daemon=True).start())
+
     root.mainloop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+import json
+import os
+import sys
+import types
+
+import pytest
+
+# 测试直接导入仓库根目录下的单文件脚本，端到端测试复用基准测试的 PowerShell 替身
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, "bench"))
+
+import install_connect_exo as installer  # noqa: E402
+import run_bench  # noqa: E402
+
+
+class FakeRoot:
+    """代替 Tk 根窗口: 记录 after() 安排的回调，由测试手动推进一帧"""
+
+    def __init__(self):
+        self.callback = None
+        self.delays = []
+        self.cancelled = []
+
+    def after(self, ms, func):
+        self.delays.append(ms)
+        self.callback = func
+        return len(self.delays)
+
+    def after_cancel(self, after_id):
+        self.cancelled.append(after_id)
+        self.callback = None
+
+    def tick(self):
+        self.callback()
+
+
+class FakeResponse:
+    """requests.Response 的替身 (只包含安装器用到的属性)"""
+
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self._body = body or {}
+        self.text = json.dumps(self._body)
+        self.content = self.text.encode("utf-8")
+
+    def json(self):
+        return self._body
+
+
+@pytest.fixture(autouse=True)
+def isolated_limiters():
+    # 限速器按云环境和租户在进程内共享，每个测试从未限速的状态开始
+    installer.GraphRateLimiter.reset()
+    yield
+    installer.GraphRateLimiter.reset()
+
+
+@pytest.fixture
+def make_bus():
+    def make(**kwargs):
+        root = FakeRoot()
+        return root, installer.UIEventBus(root, **kwargs)
+    return make
+
+
+@pytest.fixture
+def make_response():
+    return FakeResponse
+
+
+@pytest.fixture
+def make_log_writer(tmp_path):
+    writers = []
+
+    def make(**kwargs):
+        writer = installer.LogWriter(str(tmp_path / "install.log"), json_path=str(tmp_path / "install.jsonl"),
+                                     flush_interval=0.01, **kwargs)
+        writers.append(writer)
+        return writer
+
+    yield make
+    for writer in writers:
+        writer.close()
+
+
+@pytest.fixture
+def make_journal(tmp_path):
+    def make(module_name="Contoso", env="Global"):
+        return installer.InstallJournal(module_name, env, path=str(tmp_path / "journals" / f"{module_name}_{env}.json"))
+    return make
+
+
+@pytest.fixture
+def make_tenant_cache(tmp_path):
+    def make(**kwargs):
+        return installer.TenantCache(path=str(tmp_path / "tenant_cache.json"), **kwargs)
+    return make
+
+
+@pytest.fixture
+def make_registry(tmp_path):
+    def make():
+        return installer.ModuleRegistry(path=str(tmp_path / "modules.json"))
+    return make
+
+
+@pytest.fixture
+def sandbox(tmp_path, monkeypatch):
+    """隔离的用户目录，PATH 中的 pwsh / powershell 为基准测试的替身 (bench/fake_powershell.py)"""
+    if sys.platform == "win32":
+        pytest.skip("PowerShell 替身使用 sh 包装脚本")
+    bin_dir = tmp_path / "bin"
+    home = tmp_path / "home"
+    bin_dir.mkdir()
+    (home / "Documents").mkdir(parents=True)
+    run_bench.make_shims(str(bin_dir))
+    spawn_log = tmp_path / "spawns.log"
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ.get("PATH", ""))
+    monkeypatch.delenv("PSModulePath", raising=False)
+    for name in ("HOME", "USERPROFILE", "CEXO_BENCH_HOME"):
+        monkeypatch.setenv(name, str(home))
+    monkeypatch.setenv("LOCALAPPDATA", str(home / "AppData" / "Local"))
+    monkeypatch.setenv("CEXO_BENCH_SPAWN_LOG", str(spawn_log))
+
+    def spawns(kind=None):
+        if not spawn_log.exists():
+            return 0
+        return sum(1 for line in spawn_log.read_text(encoding="utf-8").splitlines() if kind is None or line.split()[0] == kind)
+
+    return types.SimpleNamespace(bin_dir=bin_dir, home=home, module_dir=home / "Documents" / "PowerShell" / "Modules",
+                                 spawns=spawns)
+
+
+@pytest.fixture
+def fake_tenant(sandbox, monkeypatch):
+    """
+    在沙箱中对本地 Graph 替身 (bench/fake_graph.py) 执行完整流程，登录使用不打开浏览器的替身凭据。
+    make_engine() 创建的引擎共用一个 PowerShell 工作进程；logins 记录每次登录的模块名称。
+    """
+    from fake_graph import FakeGraphServer
+
+    server = FakeGraphServer().start()
+    cloud_config = installer.get_cloud_config
+    monkeypatch.setattr(installer, "get_cloud_config", lambda env: dict(cloud_config(env), graph_endpoint=server.endpoint))
+    logins = []
+
+    def get_credential(engine, ctx):
+        logins.append(ctx["module_name"])
+        return run_bench.StubCredential()
+
+    monkeypatch.setattr(installer.InstallerEngine, "get_credential", get_credential)
+    ps_host = installer.PowerShellHost()
+    path_resolver = installer.PowerShellPathResolver(installer.get_documents_dir)
+    logs = []
+
+    def make_engine(**kwargs):
+        return installer.InstallerEngine(ps_host, path_resolver, on_log=lambda message, level: logs.append((level, message)), **kwargs)
+
+    yield types.SimpleNamespace(state=server.state, logins=logins, logs=logs, ps_host=ps_host, make_engine=make_engine)
+    ps_host.close()
+    server.stop()
@@ -0,0 +1,61 @@
+import base64
+import datetime
+import hashlib
+
+import pytest
+
+import install_connect_exo as installer
+
+x509 = pytest.importorskip("cryptography.x509")
+from cryptography.hazmat.primitives.serialization import Encoding, pkcs12  # noqa: E402
+
+
+def test_generates_a_self_signed_certificate_like_new_selfsignedcertificate():
+    data = installer.CryptographyCertBackend(None).generate("Contoso-Auto", years=2)
+    der = base64.b64decode(data["Base64"])
+    cert = x509.load_der_x509_certificate(der)
+
+    assert data["Thumbprint"] == hashlib.sha1(der).hexdigest().upper()
+    assert cert.subject == cert.issuer
+    assert cert.subject.get_attributes_for_oid(x509.NameOID.COMMON_NAME)[0].value == "Contoso-Auto"
+    assert cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value.get_values_for_type(x509.DNSName) == ["Contoso-Auto"]
+    assert x509.ExtendedKeyUsageOID.CLIENT_AUTH in cert.extensions.get_extension_for_class(x509.ExtendedKeyUsage).value
+    assert cert.public_key().key_size == 2048
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    not_before = getattr(cert, "not_valid_before_utc", None) or cert.not_valid_before.replace(tzinfo=datetime.timezone.utc)
+    not_after = getattr(cert, "not_valid_after_utc", None) or cert.not_valid_after.replace(tzinfo=datetime.timezone.utc)
+    # 生效时间提前 10 分钟以容忍时钟偏差
+    assert datetime.timedelta(minutes=9) < now - not_before < datetime.timedelta(minutes=11)
+    assert 729 <= (not_after - now).days <= 731
+    assert data["NotAfter"] == not_after.strftime("%Y-%m-%dT%H:%M:%S.0000000Z")
+
+
+def test_pfx_holds_the_private_key_for_the_certificate():
+    data = installer.CryptographyCertBackend(None).generate("Contoso-Auto")
+    key, cert, _ = pkcs12.load_key_and_certificates(base64.b64decode(data["Pfx"]), data["PfxPassword"].encode("ascii"))
+    assert cert.public_bytes(Encoding.DER) == base64.b64decode(data["Base64"])
+    assert key.public_key().public_numbers() == cert.public_key().public_numbers()
+    # 每张证书使用不同的 PFX 密码
+    assert installer.CryptographyCertBackend(None).generate("Contoso-Auto")["PfxPassword"] != data["PfxPassword"]
+
+
+def test_import_to_store_adds_the_certificate_through_powershell(sandbox):
+    host = installer.PowerShellHost()
+    try:
+        backend = installer.CryptographyCertBackend(host.run)
+        assert not backend.in_store
+        data = backend.generate("Contoso-Auto")
+        backend.import_to_store(data)
+        assert host.run(f"Test-Path -Path 'Cert:\\CurrentUser\\My\\{data['Thumbprint']}'") == "True"
+    finally:
+        host.close()
+
+
+def test_backend_selection(monkeypatch):
+    assert isinstance(installer.create_cert_backend("auto", None), installer.CryptographyCertBackend)
+    assert isinstance(installer.create_cert_backend("powershell", None), installer.PowerShellCertBackend)
+    monkeypatch.setattr(installer.CryptographyCertBackend, "is_available", staticmethod(lambda: False))
+    assert isinstance(installer.create_cert_backend(None, None), installer.PowerShellCertBackend)
+    with pytest.raises(ValueError, match="未知的证书生成方式"):
+        installer.create_cert_backend("openssl", None)
@@ -0,0 +1,167 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import install_connect_exo as installer
+
+
+class FakeLimiter:
+    def __init__(self):
+        self.throttled = []
+
+    def on_throttled(self, retry_after=None, count=1):
+        self.throttled.append(retry_after)
+        self.throttled_count = count
+
+
+class FakeGraph:
+    """只实现 GraphBatch 用到的 GraphClient 接口；handler(子请求, 已收到的批次数) 返回 (状态码, 响应头)"""
+
+    backoff_max = 30.0
+
+    def __init__(self, handler, make_response, limiter=None):
+        self.handler = handler
+        self.make_response = make_response
+        self.limiter = limiter
+        self.batches = []
+        self.sleeps = []
+        self.counts = {}
+
+    def post(self, path, json=None, **kwargs):
+        assert path == "/v1.0/$batch"
+        self.batches.append(json["requests"])
+        responses = []
+        for item in json["requests"]:
+            status, headers = self.handler(item, len(self.batches))
+            responses.append({"id": item["id"], "status": status, "headers": headers or {}, "body": {"id": item["id"]}})
+        return self.make_response(200, {"responses": responses})
+
+    def _retry_after(self, resp):
+        value = resp.headers.get("Retry-After")
+        return float(value) if value is not None else None
+
+    def _backoff(self, attempt):
+        return 0.5
+
+    def _count(self, key, value=1):
+        self.counts[key] = self.counts.get(key, 0) + value
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+
+@pytest.fixture
+def make_graph(make_response):
+    def make(handler, limiter=None):
+        return FakeGraph(handler, make_response, limiter)
+    return make
+
+
+def test_requests_are_chunked_and_depends_on_only_within_a_chunk(make_graph):
+    graph = make_graph(lambda item, n: (200, None))
+    batch = installer.GraphBatch(graph)
+    for i in range(25):
+        batch.add(i, "GET", f"/applications/{i}", depends_on=[i - 1] if i else None)
+    results = batch.execute()
+
+    assert len(results) == 25 and all(r.status_code == 200 for r in results.values())
+    first, second = graph.batches
+    assert len(first) == installer.GraphBatch.MAX_BATCH_SIZE and len(second) == 5
+    assert first[1]["dependsOn"] == ["0"]
+    # 依赖项在上一批中已完成，不再声明 dependsOn
+    assert "dependsOn" not in second[0]
+    assert second[1]["dependsOn"] == ["20"]
+    assert results["3"].json() == {"id": "3"}
+
+
+def test_body_sets_content_type(make_graph):
+    graph = make_graph(lambda item, n: (201, None))
+    installer.GraphBatch(graph).add("create", "post", "/applications", json={"displayName": "X"}).execute()
+    item = graph.batches[0][0]
+    assert item["method"] == "POST" and item["body"] == {"displayName": "X"}
+    assert item["headers"] == {"Content-Type": "application/json"}
+
+
+def test_throttled_requests_and_their_dependents_are_retried(make_graph):
+    def handler(item, batch_number):
+        if batch_number == 1 and item["id"] == "sp":
+            return 429, {"Retry-After": "2"}
+        if batch_number == 1 and item["id"] == "grant":
+            return 424, None  # 依赖的请求失败
+        return 200, None
+
+    limiter = FakeLimiter()
+    graph = make_graph(handler, limiter=limiter)
+    batch = installer.GraphBatch(graph)
+    batch.add("org", "GET", "/organization")
+    batch.add("sp", "GET", "/servicePrincipals")
+    batch.add("grant", "POST", "/servicePrincipals/x/appRoleAssignments", json={}, depends_on=["sp"])
+    results = batch.execute()
+
+    assert {rid: r.status_code for rid, r in results.items()} == {"org": 200, "sp": 200, "grant": 200}
+    # 第二轮只重发被限流的请求和依赖它的请求，并保留 dependsOn
+    assert [item["id"] for item in graph.batches[1]] == ["sp", "grant"]
+    assert graph.batches[1][1]["dependsOn"] == ["sp"]
+    # 子请求的 429 报告给共享限速器降低速率，重发前等待 Retry-After
+    assert limiter.throttled == [2.0] and graph.sleeps == [2.0]
+    assert graph.counts == {"retries": 2, "throttled": 1}
+
+
+def test_503_without_limiter_backs_off_and_gives_up_after_max_retries(make_graph):
+    graph = make_graph(lambda item, n: (503, None))
+    results = installer.GraphBatch(graph).add("a", "GET", "/organization").execute(max_retries=2)
+    assert results["a"].status_code == 503
+    assert len(graph.batches) == 3
+    assert graph.sleeps == [0.5, 0.5]
+
+
+def test_unrelated_424_is_not_retried(make_graph):
+    graph = make_graph(lambda item, n: (404, None) if item["id"] == "a" else (424, None))
+    batch = installer.GraphBatch(graph)
+    batch.add("a", "GET", "/applications/missing")
+    batch.add("b", "PATCH", "/applications/missing", json={}, depends_on=["a"])
+    results = batch.execute()
+    assert len(graph.batches) == 1
+    assert results["b"].status_code == 424
+
+
+def test_independent_chunks_can_be_sent_in_parallel(make_graph):
+    graph = make_graph(lambda item, n: (204, None))
+    batch = installer.GraphBatch(graph)
+    for i in range(45):
+        batch.add(i, "DELETE", f"/applications/{i}")
+    results = batch.execute(parallel=3)
+    assert len(graph.batches) == 3 and len(results) == 45
+
+
+def test_shared_executor_sends_lanes_concurrently_and_runs_queued_lanes_inline(make_graph):
+    threads = set()
+
+    def handler(item, batch_number):
+        threads.add(threading.current_thread().name)
+        time.sleep(0.005)
+        return 204, None
+
+    graph = make_graph(handler)
+    batch = installer.GraphBatch(graph)
+    for i in range(60):
+        batch.add(i, "DELETE", f"/applications/{i}")
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="Lane") as pool:
+        results = batch.execute(parallel=3, executor=pool)
+        assert len(results) == 60 and len(graph.batches) == 3
+        # 第一组由当前线程发送，其余提交到共享线程池
+        assert threading.current_thread().name in threads and any(t.startswith("Lane") for t in threads)
+
+        # 共享线程池被占满时，还没开始的组由当前线程取回发送，不会等待
+        threads.clear()
+        release = threading.Event()
+        blockers = [pool.submit(release.wait, 5) for _ in range(2)]
+        for i in range(60):
+            batch.add(i, "DELETE", f"/applications/{i}")
+        results = batch.execute(parallel=3, executor=pool)
+        release.set()
+        for blocker in blockers:
+            blocker.result()
+    assert len(results) == 60 and threads == {threading.current_thread().name}
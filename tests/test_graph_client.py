@@ -0,0 +1,123 @@
+import email.utils
+import time
+
+import pytest
+import requests
+
+import install_connect_exo as installer
+
+ENDPOINT = "https://graph.test"
+
+
+class FakeSession:
+    """代替 requests.Session: 按顺序返回预设的响应或抛出预设的异常，并记录每次请求"""
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.calls = []
+
+    def request(self, method, url, headers=None, data=None, timeout=None):
+        self.calls.append({"method": method, "url": url, "headers": headers, "data": data, "timeout": timeout})
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+@pytest.fixture
+def make_client():
+    def make(*results, **kwargs):
+        sleeps = []
+        client = installer.GraphClient(ENDPOINT, "token", sleep=sleeps.append, **kwargs)
+        client.session = FakeSession(results)
+        return client, sleeps
+    return make
+
+
+def test_requests_share_a_pooled_session_per_cloud(make_client, make_response):
+    session = installer.GraphClient(ENDPOINT + "/", "token-a").session
+    assert installer.GraphClient(ENDPOINT, "token-b").session is session
+    assert installer.GraphClient("https://graph.test.cn", "token-a").session is not session
+
+    client, sleeps = make_client(make_response(200), make_response(200))
+    client.get("/v1.0/organization")
+    client.get(f"{ENDPOINT}/v1.0/applications?$skiptoken=x", timeout=5)
+    first, second = client.session.calls
+    assert first["url"] == f"{ENDPOINT}/v1.0/organization" and first["timeout"] == installer.GraphClient.DEFAULT_TIMEOUT
+    assert first["headers"]["Authorization"] == "Bearer token"
+    assert second["url"] == f"{ENDPOINT}/v1.0/applications?$skiptoken=x" and second["timeout"] == 5
+    assert client.stats["requests"] == 2 and sleeps == []
+
+
+def test_throttled_request_waits_retry_after_then_succeeds(make_client, make_response):
+    client, sleeps = make_client(make_response(429, headers={"Retry-After": "3"}),
+                                 make_response(503, headers={"x-ms-retry-after-ms": "1500"}),
+                                 make_response(200, {"id": "1"}))
+    resp = client.get("/v1.0/applications/1")
+    assert resp.status_code == 200 and resp.json() == {"id": "1"}
+    assert sleeps == [3.0, 1.5]
+    assert client.stats["retries"] == 2 and client.stats["throttled"] == 1
+    # 429 报告给租户共享的限速器
+    assert client.limiter.stats["throttled"] == 1 and client.limiter.rate is not None
+
+
+def test_retry_after_accepts_http_dates(make_client, make_response):
+    client, _ = make_client()
+    date = email.utils.formatdate(time.time() + 10, usegmt=True)
+    assert 8 <= client._retry_after(make_response(429, headers={"Retry-After": date})) <= 10
+    assert client._retry_after(make_response(429, headers={"Retry-After": "soon"})) is None
+    assert client._retry_after(make_response(200)) is None
+
+
+def test_retries_are_bounded_and_backoff_is_capped(make_client, make_response):
+    client, sleeps = make_client(*[make_response(502)] * 3, max_retries=2, backoff_base=10, backoff_max=12)
+    assert client.get("/v1.0/organization").status_code == 502
+    assert len(client.session.calls) == 3
+    assert 5 <= sleeps[0] <= 10 and 6 <= sleeps[1] <= 12
+
+
+@pytest.mark.parametrize("status, retried", [(429, True), (503, True), (502, False), (504, False)])
+def test_post_is_only_retried_when_the_request_was_not_processed(make_client, make_response, status, retried):
+    client, _ = make_client(make_response(status, headers={"Retry-After": "0"}), make_response(201))
+    resp = client.post("/v1.0/applications", json={"displayName": "X"})
+    assert resp.status_code == (201 if retried else status)
+    assert len(client.session.calls) == (2 if retried else 1)
+
+
+def test_batch_is_idempotent_only_when_all_sub_requests_are(make_client, make_response):
+    reads = {"requests": [{"id": "1", "method": "GET", "url": "/organization"}]}
+    client, _ = make_client(make_response(502), make_response(200, {"responses": []}), backoff_base=0)
+    assert client.post("/v1.0/$batch", json=reads).status_code == 200
+
+    writes = {"requests": [{"id": "1", "method": "POST", "url": "/applications", "body": {}}]}
+    client, _ = make_client(make_response(502), backoff_base=0)
+    assert client.post("/v1.0/$batch", json=writes).status_code == 502
+    assert len(client.session.calls) == 1
+
+
+def test_connection_errors_retry_reads_and_only_unsent_writes(make_client, make_response):
+    client, _ = make_client(requests.ConnectionError("reset"), make_response(200), backoff_base=0)
+    assert client.get("/v1.0/organization").status_code == 200
+
+    client, _ = make_client(requests.ReadTimeout("read"), backoff_base=0)
+    with pytest.raises(requests.ReadTimeout):
+        client.post("/v1.0/applications", json={})
+
+    # 连接超时说明请求还没有发出，重试不会重复创建对象
+    client, _ = make_client(requests.ConnectTimeout("connect"), make_response(201), backoff_base=0)
+    assert client.post("/v1.0/applications", json={}).status_code == 201
+
+    client, _ = make_client(*[requests.ConnectionError("down")] * 2, max_retries=1, backoff_base=0)
+    with pytest.raises(requests.ConnectionError):
+        client.get("/v1.0/organization")
+
+
+def test_get_all_follows_next_links(make_client, make_response):
+    client, _ = make_client(make_response(200, {"value": [1, 2], "@odata.nextLink": f"{ENDPOINT}/v1.0/applications?page=2"}),
+                            make_response(200, {"value": [3]}))
+    assert list(client.get_all("/v1.0/applications?$top=2")) == [1, 2, 3]
+    assert client.session.calls[1]["url"] == f"{ENDPOINT}/v1.0/applications?page=2"
+
+    client, _ = make_client(make_response(403, {"error": "denied"}))
+    with pytest.raises(Exception, match="查询失败 \\(403\\)"):
+        list(client.get_all("/v1.0/applications"))
@@ -0,0 +1,129 @@
+import time
+
+import pytest
+
+import install_connect_exo as installer
+
+
+class FastLimiter(installer.GraphRateLimiter):
+    WINDOW = 0.2
+    RELAX_AFTER = 0.2
+
+
+def test_unpaced_until_first_429():
+    limiter = installer.GraphRateLimiter(("https://graph", "t"))
+    start = time.monotonic()
+    for _ in range(200):
+        assert limiter.acquire() < 0.01
+    assert time.monotonic() - start < 0.5
+    assert limiter.rate is None
+    assert limiter.stats["acquired"] == 200
+    assert "未限速" in limiter.summary()
+
+
+def test_429_limits_to_admitted_rate_without_pausing():
+    limiter = installer.GraphRateLimiter(("https://graph", "t"))
+    for _ in range(80):
+        limiter.acquire()
+    limiter.on_success(50)
+    # 按最近 1 秒内被接受的 50 个请求 (而不是发出的 80 个) 限速，被限流的请求自己等 Retry-After
+    assert limiter.on_throttled(0.2) == 0.2
+    assert limiter.rate == pytest.approx(50 * limiter.DECREASE)
+    assert limiter.stats["throttled"] == 1
+
+
+def test_window_room_is_used_then_requests_wait_for_the_next_slot():
+    limiter = FastLimiter(("https://graph", "t"))
+    limiter.on_success(10)
+    limiter.on_throttled(1.0)
+    limit = int(limiter.rate * limiter.WINDOW)
+    # 没有暂停整个桶: 窗口内的余量立即发出
+    for _ in range(limit):
+        assert limiter.acquire() < 0.01
+    start = time.monotonic()
+    limiter.acquire()
+    assert FastLimiter.WINDOW * 0.8 <= time.monotonic() - start < 1.0
+    assert limiter.stats["waits"] == 1
+
+
+def test_batch_counts_its_sub_requests():
+    limiter = FastLimiter(("https://graph", "t"))
+    limiter.on_success(10)
+    limiter.on_throttled(1.0)
+    limit = limiter.rate * limiter.WINDOW
+    # 超过上限的 $batch 在窗口为空时发出，之后的请求等它过期
+    assert limiter.acquire(cost=20) < 0.01
+    assert limiter._sent_count == 20 > limit
+    sleeps = []
+    limiter.acquire(sleep=lambda s: (sleeps.append(s), time.sleep(s)))
+    assert sleeps and 0 < sleeps[0] <= FastLimiter.WINDOW
+
+
+def test_sleep_hook_replaces_blocking_wait():
+    limiter = FastLimiter(("https://graph", "t"))
+    limiter.on_throttled()
+    for _ in range(int(limiter.rate * limiter.WINDOW)):
+        limiter.acquire()
+    sleeps = []
+    limiter.acquire(sleep=lambda s: (sleeps.append(s), time.sleep(s)))
+    assert len(sleeps) >= 1 and sum(sleeps) <= FastLimiter.WINDOW + 0.05
+
+
+def test_429s_within_one_round_reduce_rate_once():
+    limiter = installer.GraphRateLimiter(("https://graph", "t"))
+    limiter.on_success(20)
+    for _ in range(5):
+        limiter.on_throttled(0.1)
+    assert limiter.rate == pytest.approx(20 * limiter.DECREASE)
+    assert limiter.stats["throttled"] == 5
+
+
+def test_rate_is_clamped_and_defaults_pause():
+    limiter = installer.GraphRateLimiter(("https://graph", "t"))
+    assert limiter.on_throttled() == limiter.DEFAULT_PAUSE
+    assert limiter.rate == limiter.MIN_RATE
+    assert f"速率 {limiter.MIN_RATE:.1f} 次/秒" in limiter.summary()
+
+
+def test_throttled_requests_leave_the_window():
+    limiter = FastLimiter(("https://graph", "t"))
+    limiter.on_success(10)
+    limiter.acquire(cost=5)
+    limiter.acquire(cost=3)
+    # 被拒绝的 4 个请求没有占用服务器配额
+    limiter.on_throttled(1.0, count=4)
+    assert limiter._sent_count == 4
+    assert [count for _, count in limiter._sent] == [4]
+
+
+def test_success_recovers_rate_until_pacing_is_lifted():
+    limiter = installer.GraphRateLimiter(("https://graph", "t"))
+    limiter.rate = limiter.MAX_RATE - 0.001
+    limiter.on_success()
+    assert limiter.rate is None
+
+    limiter.rate = 10.0
+    limiter.on_success()
+    assert limiter.rate == pytest.approx(10.1)
+
+
+def test_pacing_relaxes_after_quiet_period():
+    limiter = FastLimiter(("https://graph", "t"))
+    limiter.on_throttled(0.05)
+    assert limiter.rate is not None
+    time.sleep(FastLimiter.RELAX_AFTER)
+    limiter.acquire()
+    assert limiter.rate is None
+
+
+def test_limiters_are_shared_per_cloud_and_tenant():
+    a = installer.GraphRateLimiter.get("https://graph/", "Contoso")
+    assert installer.GraphRateLimiter.get("https://graph", "contoso") is a
+    assert installer.GraphRateLimiter.get("https://graph", "fabrikam") is not a
+    assert installer.GraphRateLimiter.get("https://graph.cn", "contoso") is not a
+    assert set(installer.GraphRateLimiter.all()) >= {a}
+
+
+def test_disabled_limiter_returns_none(monkeypatch):
+    monkeypatch.setattr(installer.GraphRateLimiter, "enabled", False)
+    assert installer.GraphRateLimiter.get("https://graph", "t") is None
@@ -0,0 +1,112 @@
+import os
+
+import pytest
+
+import install_connect_exo as installer
+
+
+def test_records_steps_and_outputs_and_restores_them(make_journal):
+    journal = make_journal()
+    assert not journal.exists()
+    journal.start(tenant="contoso.onmicrosoft.com", login_hint="admin@contoso.com")
+    journal.complete("tenant", {"tenant_domain": "contoso.onmicrosoft.com", "graph": object()})
+    journal.complete("app", {"app_id": "app-1", "app_object_id": "obj-1", "access_token": "secret"})
+    assert journal.exists()
+
+    resumed = make_journal()
+    data = resumed.load()
+    assert data["tenant"] == "contoso.onmicrosoft.com"
+    assert resumed.is_completed("tenant") and resumed.is_completed("app")
+    assert not resumed.is_completed("role")
+    ctx = {}
+    resumed.restore(ctx)
+    # 只保存 OUTPUT_KEYS 中的结果，不保存令牌等其他上下文
+    assert ctx == {"tenant_domain": "contoso.onmicrosoft.com", "app_id": "app-1", "app_object_id": "obj-1"}
+
+
+def test_complete_merges_steps_written_by_another_process(make_journal):
+    first = make_journal()
+    first.start()
+    second = make_journal()
+    second.load()
+    second.complete("cert", {"thumbprint": "ABC"})
+    first.complete("tenant", {"tenant_domain": "contoso.onmicrosoft.com"})
+
+    data = make_journal().load()
+    assert set(data["steps"]) == {"cert", "tenant"}
+    assert data["outputs"] == {"thumbprint": "ABC", "tenant_domain": "contoso.onmicrosoft.com"}
+
+
+def test_start_replaces_previous_run(make_journal):
+    journal = make_journal()
+    journal.start()
+    journal.complete("tenant", {"tenant_domain": "old.onmicrosoft.com"})
+    journal.start()
+    data = make_journal().load()
+    assert data["steps"] == {} and data["outputs"] == {}
+
+
+def test_load_rejects_other_module_corrupt_or_missing_files(make_journal):
+    assert make_journal().load() is None
+
+    journal = make_journal()
+    journal.start()
+    other = installer.InstallJournal("Fabrikam", "Global", path=journal.path)
+    assert other.load() is None
+    assert installer.InstallJournal("contoso", "Global", path=journal.path).load() is not None
+
+    with open(journal.path, "w", encoding="utf-8") as f:
+        f.write("{not json")
+    assert make_journal().load() is None
+
+
+def test_discard_removes_the_journal(make_journal):
+    journal = make_journal()
+    journal.start()
+    journal.discard()
+    assert not os.path.exists(journal.path)
+    journal.discard()  # 已删除时不报错
+
+
+def fail_local_module(self, ctx):
+    raise RuntimeError("disk full")
+
+
+def skipped_steps(fake_tenant):
+    return [m.split(": ", 1)[1] for _, m in fake_tenant.logs if "跳过已完成的步骤" in m]
+
+
+def test_resume_skips_finished_steps_and_restores_removed_grants(fake_tenant, monkeypatch):
+    engine = fake_tenant.make_engine()
+    with monkeypatch.context() as m:
+        m.setattr(installer.InstallerEngine, "_setup_local_module", fail_local_module)
+        with pytest.raises(RuntimeError, match="disk full"):
+            engine.install("Global", "Contoso")
+    assert engine.has_unfinished_install("Global", "Contoso")
+    apps = set(fake_tenant.state.applications)
+    # 上次运行之后有人移除了权限和角色成员
+    fake_tenant.state.app_role_assignments.clear()
+    fake_tenant.state.directory_roles["exo-admin-role"]["members"].clear()
+
+    result = engine.install("Global", "Contoso", resume=True)
+    assert set(fake_tenant.state.applications) == apps
+    assert {"本地生成自签名证书", "创建 Azure AD 应用程序", "创建服务主体 (Service Principal)"} <= set(skipped_steps(fake_tenant))
+    assert not {"授予 Exchange.ManageAsApp 权限", "分配 Exchange Administrator 角色"} & set(skipped_steps(fake_tenant))
+    assert fake_tenant.state.app_role_assignments
+    assert fake_tenant.state.directory_roles["exo-admin-role"]["members"]
+    assert engine.get_local_module_info("Contoso")["AppID"] == result["app_id"]
+    assert not engine.has_unfinished_install("Global", "Contoso")
+
+
+def test_resume_recreates_an_app_deleted_since_the_last_run(fake_tenant, monkeypatch):
+    engine = fake_tenant.make_engine()
+    with monkeypatch.context() as m:
+        m.setattr(installer.InstallerEngine, "_setup_local_module", fail_local_module)
+        with pytest.raises(RuntimeError):
+            engine.install("Global", "Contoso")
+    fake_tenant.state.applications.clear()
+
+    result = engine.install("Global", "Contoso", resume=True)
+    assert [a["appId"] for a in fake_tenant.state.applications.values()] == [result["app_id"]]
+    assert any("上次创建的对象已不存在" in m for _, m in fake_tenant.logs)
+    assert "创建 Azure AD 应用程序" not in skipped_steps(fake_tenant)
@@ -0,0 +1,45 @@
+import gzip
+import os
+import time
+
+
+def test_rotates_by_size_and_keeps_backup_count(tmp_path, make_log_writer):
+    writer = make_log_writer(max_bytes=200, backup_count=2)
+    for batch in range(5):
+        for i in range(5):
+            writer.write(f"batch {batch} line {i} " + "x" * 20)
+        assert writer.flush()
+    log = str(tmp_path / "install.log")
+    assert os.path.exists(f"{log}.1.gz") and os.path.exists(f"{log}.2.gz")
+    assert not os.path.exists(f"{log}.3.gz")
+    with gzip.open(f"{log}.1.gz", "rt", encoding="utf-8") as f:
+        assert "batch 3" in f.read()
+    # 当前文件只包含轮转之后写入的一批
+    assert "batch 4" in open(log, encoding="utf-8").read()
+    assert "batch 3" not in open(log, encoding="utf-8").read()
+
+
+def test_rotates_segments_older_than_max_age(tmp_path, make_log_writer):
+    log = tmp_path / "install.log"
+    old = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() - 3 * 86400))
+    log.write_text(f"[{old}] [INFO] old entry\n", encoding="utf-8")
+    writer = make_log_writer(max_age_days=2)
+    writer.write("new entry")
+    assert writer.flush()
+    assert "old entry" not in log.read_text(encoding="utf-8")
+    with gzip.open(f"{log}.1.gz", "rt", encoding="utf-8") as f:
+        assert "old entry" in f.read()
+
+
+def test_read_records_pages_across_rotated_segments(tmp_path, make_log_writer):
+    writer = make_log_writer(max_bytes=300, backup_count=5)
+    for i in range(1, 31):
+        writer.write(f"record {i}")
+        if i % 5 == 0:
+            writer.flush()
+    # 跳过最新的 10 条，取之前的 8 条 (按时间正序)
+    page = writer.read_records(10, 8)
+    assert [r["message"] for r in page] == [f"record {i}" for i in range(13, 21)]
+    assert os.path.exists(str(tmp_path / "install.jsonl") + ".1.gz")
+    # 超出全部记录时返回剩余部分
+    assert [r["message"] for r in writer.read_records(25, 10)] == [f"record {i}" for i in range(1, 6)]
@@ -0,0 +1,56 @@
+import json
+import threading
+
+import install_connect_exo as installer
+
+
+def test_writes_text_and_json_lines(tmp_path, make_log_writer):
+    writer = make_log_writer()
+    writer.write_raw("=== start ===\n")
+    assert writer.write("hello", "SUCCESS", module="M") == 1
+    assert writer.flush()
+    text = (tmp_path / "install.log").read_text(encoding="utf-8")
+    assert text.startswith("=== start ===\n") and "[SUCCESS] hello" in text
+    records = [json.loads(line) for line in (tmp_path / "install.jsonl").read_text(encoding="utf-8").splitlines()]
+    assert [(r["seq"], r["message"], r["module"]) for r in records] == [(1, "hello", "M")]
+
+
+def test_write_only_queues_until_the_interval_or_flush(tmp_path):
+    writer = installer.LogWriter(str(tmp_path / "install.log"), flush_interval=60)
+    try:
+        writer.write("queued")
+        # 热路径不触碰文件，由后台线程批量写入
+        assert not (tmp_path / "install.log").exists()
+        assert writer.flush()
+        assert "queued" in (tmp_path / "install.log").read_text(encoding="utf-8")
+    finally:
+        writer.close()
+
+
+def test_concurrent_writers_get_unique_sequence_numbers(tmp_path, make_log_writer):
+    writer = make_log_writer()
+    seqs = []
+    lock = threading.Lock()
+
+    def worker(n):
+        for i in range(200):
+            seq = writer.write(f"worker {n} line {i}")
+            with lock:
+                seqs.append(seq)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(seqs) == list(range(1, 801)) and writer.record_count == 800
+    assert writer.flush()
+    lines = (tmp_path / "install.jsonl").read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line)["seq"] for line in lines] == list(range(1, 801))
+
+
+def test_close_writes_pending_records(tmp_path):
+    writer = installer.LogWriter(str(tmp_path / "install.log"), flush_interval=60)
+    writer.write("last words")
+    writer.close()
+    assert "last words" in (tmp_path / "install.log").read_text(encoding="utf-8")
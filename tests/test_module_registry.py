@@ -0,0 +1,110 @@
+import threading
+
+import pytest
+
+import install_connect_exo as installer
+
+
+class FakeResolver:
+    """模块路径解析器的替身，记录是否被调用 (调用真实的解析器会启动 PowerShell)"""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.calls = 0
+
+    def resolve(self):
+        self.calls += 1
+        return self.path
+
+
+@pytest.fixture
+def make_engine(tmp_path, make_registry, make_tenant_cache):
+    def make():
+        resolver = FakeResolver(tmp_path / "Modules")
+        engine = installer.InstallerEngine(ps_host=object(), path_resolver=resolver, registry=make_registry(),
+                                           auth_records=installer.AuthRecordStore(str(tmp_path / "auth_records.json")),
+                                           tenant_cache=make_tenant_cache())
+        return engine, resolver
+    return make
+
+
+def write_psm1(tmp_path, module_name, env_param=""):
+    module_dir = tmp_path / "Modules" / module_name
+    module_dir.mkdir(parents=True)
+    psm1 = module_dir / f"{module_name}.psm1"
+    psm1.write_text(f'$AppID = "app-1"\n[string]$Thumbprint = "ABC"\n$Organization = "contoso.onmicrosoft.com"\n'
+                    f'Connect-ExchangeOnline -AppId $AppID {env_param}\n', encoding="utf-8")
+    return psm1
+
+
+def test_upsert_merges_fields_and_keys_are_case_insensitive(make_registry):
+    registry = make_registry()
+    registry.upsert("Contoso", env="Global", app_id="app-1", thumbprint="ABC", unknown="ignored")
+    registry.upsert("contoso", thumbprint="DEF", app_id=None)
+    assert make_registry().get("CONTOSO") == {"module_name": "contoso", "env": "Global", "app_id": "app-1", "thumbprint": "DEF"}
+
+    assert registry.upsert("Contoso", replace=True, env="China") == {"module_name": "Contoso", "env": "China"}
+
+
+def test_list_sorts_and_filters_by_env_and_remove_returns_the_record(make_registry):
+    registry = make_registry()
+    registry.upsert("fabrikam", env="China")
+    registry.upsert("Contoso", env="Global")
+    registry.upsert("adatum", env="Global")
+    assert [r["module_name"] for r in registry.list()] == ["adatum", "Contoso", "fabrikam"]
+    assert [r["module_name"] for r in registry.list("Global")] == ["adatum", "Contoso"]
+
+    assert registry.remove("CONTOSO")["env"] == "Global"
+    assert registry.remove("Contoso") is None
+    assert [r["module_name"] for r in registry.list()] == ["adatum", "fabrikam"]
+
+
+def test_concurrent_upserts_are_not_lost(make_registry):
+    threads = [threading.Thread(target=lambda i=i: make_registry().upsert(f"Module{i}", env="Global")) for i in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(make_registry().list()) == 10
+
+
+def test_malformed_index_reads_as_empty(tmp_path, make_registry):
+    (tmp_path / "modules.json").write_text("{not json", encoding="utf-8")
+    assert make_registry().list() == [] and make_registry().get("Contoso") is None
+
+
+def test_local_module_info_uses_the_index_without_resolving_paths(tmp_path, make_engine):
+    engine, resolver = make_engine()
+    psm1 = write_psm1(tmp_path, "Contoso")
+    engine.registry.upsert("Contoso", env="Global", app_id="app-1", app_object_id="obj-1", thumbprint="ABC", path=str(psm1))
+    info = engine.get_local_module_info("contoso")
+    assert info["Exists"] and info["AppID"] == "app-1" and info["ObjectID"] == "obj-1" and info["Env"] == "Global"
+    assert resolver.calls == 0
+
+    # 模块文件已被删除: 仍返回索引中的记录，以便卸载时清理应用和证书
+    psm1.unlink()
+    info = engine.get_local_module_info("Contoso")
+    assert not info["Exists"] and info["AppID"] == "app-1"
+
+
+def test_modules_installed_before_the_index_are_parsed_and_backfilled(tmp_path, make_engine):
+    engine, resolver = make_engine()
+    psm1 = write_psm1(tmp_path, "Contoso", "-ExchangeEnvironmentName O365China")
+    info = engine.get_local_module_info("Contoso")
+    assert info["Exists"] and info["AppID"] == "app-1" and info["Thumbprint"] == "ABC" and info["Env"] == "China"
+    assert engine.registry.get("Contoso")["path"] == str(psm1)
+    engine.get_local_module_info("Contoso")
+    assert resolver.calls == 1
+
+
+def test_module_recorded_for_another_cloud_is_refused_before_sign_in(tmp_path, make_engine, monkeypatch):
+    engine, _ = make_engine()
+    psm1 = write_psm1(tmp_path, "Contoso")
+    engine.registry.upsert("Contoso", env="Global", app_id="app-1", path=str(psm1))
+    monkeypatch.setattr(installer.InstallerEngine, "get_credential", lambda engine, ctx: pytest.fail("不应登录"))
+    for action in (engine.uninstall, engine.rotate, engine.verify):
+        with pytest.raises(Exception, match="安装在 Global 云环境，与请求的 China 不一致"):
+            action("China", "Contoso")
+
+    installer.InstallerEngine.check_module_env({"Env": "Global"}, "Global", "Contoso")
+    installer.InstallerEngine.check_module_env({"Env": None}, "China", "Contoso")
@@ -0,0 +1,61 @@
+import os
+import threading
+
+import install_connect_exo as installer
+
+
+def make_resolver():
+    return installer.PowerShellPathResolver(installer.get_documents_dir)
+
+
+def test_probes_both_editions_once_then_uses_the_disk_cache(sandbox):
+    resolver = make_resolver()
+    assert resolver.resolve() == str(sandbox.module_dir)
+    assert resolver.probe_count == 1 and sandbox.spawns("probe") == 2
+    assert resolver.resolve() == str(sandbox.module_dir)
+
+    # 新进程 (新的解析器) 命中磁盘缓存，不启动 PowerShell
+    cached = make_resolver()
+    assert cached.resolve() == str(sandbox.module_dir)
+    assert cached.probe_count == 0 and sandbox.spawns("probe") == 2
+
+
+def test_concurrent_callers_share_one_probe(sandbox):
+    resolver = make_resolver()
+    resolver.warm_up()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(resolver.resolve())) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [str(sandbox.module_dir)] * 8
+    assert resolver.probe_count == 1
+
+
+def test_cache_is_invalidated_when_psmodulepath_or_binaries_change(sandbox, monkeypatch):
+    make_resolver().resolve()
+
+    monkeypatch.setenv("PSModulePath", str(sandbox.home / "Modules"))
+    resolver = make_resolver()
+    resolver.resolve()
+    assert resolver.probe_count == 1
+
+    # PowerShell 升级 (程序文件修改时间变化)
+    os.utime(sandbox.bin_dir / "pwsh", (1, 1))
+    resolver.resolve()
+    assert resolver.probe_count == 2
+
+    resolver.invalidate()
+    assert not os.path.exists(resolver.cache_path)
+    resolver.resolve()
+    assert resolver.probe_count == 3
+
+
+def test_falls_back_to_documents_when_powershell_is_missing(sandbox, monkeypatch):
+    monkeypatch.setenv("PATH", str(sandbox.bin_dir))
+    os.remove(sandbox.bin_dir / "pwsh")
+    os.remove(sandbox.bin_dir / "powershell")
+    resolver = make_resolver()
+    assert resolver.resolve() == str(sandbox.home / "Documents" / "WindowsPowerShell" / "Modules")
+    assert sandbox.spawns() == 0
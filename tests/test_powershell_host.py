@@ -0,0 +1,108 @@
+import os
+import sys
+import textwrap
+
+import pytest
+
+import install_connect_exo as installer
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="替身工作进程使用 shebang 脚本")
+
+# 按 PowerShellHost 的行协议应答的替身: 脚本内容为 "echo 文本" / "fail 文本" / "noise 文本" / "sleep 秒" / "exit"
+WORKER = textwrap.dedent("""\
+    import base64, json, os, sys, time
+    with open(os.environ["FAKE_PS_SPAWNS"], "a") as f:
+        f.write("spawn\\n")
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        command, _, arg = base64.b64decode(request["script"]).decode("utf-8").partition(" ")
+        response = {"id": request["id"], "ok": True, "output": "", "error": ""}
+        if command == "exit":
+            print("worker crashed", flush=True)
+            sys.exit(1)
+        if command == "sleep":
+            time.sleep(float(arg))
+        elif command == "fail":
+            response.update(ok=False, error=arg)
+        elif command == "noise":
+            print(arg, flush=True)
+        else:
+            response["output"] = arg + "\\n"
+        print("@@CEXO@@" + json.dumps(response), flush=True)
+""")
+
+
+@pytest.fixture
+def fake_ps(tmp_path, monkeypatch):
+    path = tmp_path / "fake_pwsh"
+    path.write_text(f"#!{sys.executable}\n" + WORKER, encoding="utf-8")
+    os.chmod(path, 0o755)
+    monkeypatch.setenv("FAKE_PS_SPAWNS", str(tmp_path / "spawns.log"))
+    hosts = []
+
+    def make(executables=None):
+        host = installer.PowerShellHost(executables or [str(path)])
+        hosts.append(host)
+        return host
+
+    yield make
+    for host in hosts:
+        host.close()
+
+
+def spawns(tmp_path):
+    return len((tmp_path / "spawns.log").read_text().splitlines())
+
+
+def test_scripts_share_one_worker_process(tmp_path, fake_ps):
+    host = fake_ps()
+    assert [host.run(f"echo line {i}") for i in range(5)] == [f"line {i}" for i in range(5)]
+    assert host.spawn_count == 1 and spawns(tmp_path) == 1
+    # 脚本直接写到 stdout 的内容不影响协议响应
+    assert host.run("noise Write-Host output") == ""
+    assert host.run("echo 中文输出") == "中文输出"
+
+
+def test_script_errors_raise_without_restarting(fake_ps):
+    host = fake_ps()
+    with pytest.raises(installer.PowerShellError, match="Access denied"):
+        host.run("fail Access denied")
+    assert host.run("echo still alive") == "still alive"
+    assert host.spawn_count == 1
+
+
+def test_crashed_worker_is_reported_and_restarted(fake_ps):
+    host = fake_ps()
+    with pytest.raises(installer.PowerShellError, match="意外退出\n.*worker crashed"):
+        host.run("exit")
+    assert host.run("echo restarted") == "restarted"
+    assert host.spawn_count == 2
+
+
+def test_timeout_kills_the_worker(fake_ps):
+    host = fake_ps()
+    with pytest.raises(installer.PowerShellTimeoutError):
+        host.run("sleep 5", timeout=0.3)
+    # 超时的响应不会被当作下一个脚本的结果
+    assert host.run("echo next") == "next"
+    assert host.spawn_count == 2
+
+
+def test_missing_executables_fall_back_then_fail(tmp_path, fake_ps):
+    host = fake_ps([str(tmp_path / "missing"), str(tmp_path / "fake_pwsh")])
+    assert host.run("echo ok") == "ok"
+    assert host.executable == str(tmp_path / "fake_pwsh")
+
+    with pytest.raises(installer.PowerShellError, match="未找到可用的 PowerShell"):
+        fake_ps([str(tmp_path / "missing")]).run("echo ok")
+
+
+def test_close_ends_the_worker(fake_ps):
+    host = fake_ps()
+    host.run("echo ok")
+    process = host._process
+    host.close()
+    assert process.poll() is not None
+    assert host.run("echo again") == "again"
@@ -0,0 +1,64 @@
+import base64
+
+import pytest
+
+
+def app_thumbprints(state, app_id):
+    app = next(a for a in state.applications.values() if a["appId"] == app_id)
+    return [base64.b64decode(k["customKeyIdentifier"]).hex().upper() for k in app.get("keyCredentials", [])]
+
+
+def in_store(fake_tenant, thumbprint):
+    return fake_tenant.ps_host.run(f"Test-Path -Path 'Cert:\\CurrentUser\\My\\{thumbprint}'") == "True"
+
+
+def test_rotate_swaps_the_certificate_on_the_existing_app(fake_tenant):
+    engine = fake_tenant.make_engine()
+    installed = engine.install("Global", "Contoso")
+    apps_before = set(fake_tenant.state.applications)
+
+    result = engine.rotate("Global", "Contoso")
+    assert result["old_thumbprint"] == installed["thumbprint"] != result["thumbprint"]
+    assert result["app_id"] == installed["app_id"]
+    # 应用没有重建，只剩新证书
+    assert set(fake_tenant.state.applications) == apps_before
+    assert app_thumbprints(fake_tenant.state, installed["app_id"]) == [result["thumbprint"]]
+
+    info = engine.get_local_module_info("Contoso")
+    assert info["Thumbprint"] == result["thumbprint"]
+    with open(info["Path"], encoding="utf-8") as f:
+        assert f'"{result["thumbprint"]}"' in f.read()
+    assert in_store(fake_tenant, result["thumbprint"]) and not in_store(fake_tenant, installed["thumbprint"])
+
+
+def test_missing_current_certificate_fails_before_sign_in(fake_tenant):
+    engine = fake_tenant.make_engine()
+    installed = engine.install("Global", "Contoso")
+    fake_tenant.ps_host.run(f"Remove-Item -Path 'Cert:\\CurrentUser\\My\\{installed['thumbprint']}'")
+    logins = len(fake_tenant.logins)
+
+    with pytest.raises(Exception, match="本地证书存储中没有当前证书"):
+        engine.rotate("Global", "Contoso")
+    assert len(fake_tenant.logins) == logins
+    assert app_thumbprints(fake_tenant.state, installed["app_id"]) == [installed["thumbprint"]]
+    assert engine.get_local_module_info("Contoso")["Thumbprint"] == installed["thumbprint"]
+
+
+def test_unknown_keys_on_the_app_abort_and_remove_the_new_certificate(fake_tenant):
+    engine = fake_tenant.make_engine()
+    installed = engine.install("Global", "Contoso")
+    app = next(a for a in fake_tenant.state.applications.values() if a["appId"] == installed["app_id"])
+    # 在其他电脑上添加的证书: 本地没有它的公钥，整体替换 keyCredentials 会删掉它
+    app["keyCredentials"].append({"keyId": "other", "customKeyIdentifier": base64.b64encode(b"\x01" * 20).decode("ascii")})
+
+    with pytest.raises(Exception, match="1 个证书在本地证书存储中找不到"):
+        engine.rotate("Global", "Contoso")
+    assert len(app["keyCredentials"]) == 2
+    assert engine.get_local_module_info("Contoso")["Thumbprint"] == installed["thumbprint"]
+    assert any("已删除未使用的本地证书" in message for _, message in fake_tenant.logs)
+
+
+def test_rotate_requires_an_installed_module(fake_tenant):
+    with pytest.raises(Exception, match="本地未找到模块 Contoso"):
+        fake_tenant.make_engine().rotate("Global", "Contoso")
+    assert fake_tenant.logins == []
@@ -0,0 +1,113 @@
+import threading
+import time
+
+import pytest
+
+import install_connect_exo as installer
+
+
+def test_steps_run_after_their_dependencies():
+    order = []
+    lock = threading.Lock()
+
+    def step(name):
+        def run(ctx):
+            with lock:
+                order.append(name)
+        return run
+
+    scheduler = installer.StepScheduler()
+    scheduler.add("deploy", step("deploy"), depends_on=["build", "login"])
+    scheduler.add("build", step("build"))
+    scheduler.add("login", step("login"))
+    scheduler.run({})
+    assert order[-1] == "deploy"
+    assert set(order) == {"build", "login", "deploy"}
+    assert scheduler.completed[-1] == "deploy" and scheduler.total == 3
+
+
+def test_independent_steps_run_concurrently():
+    barrier = threading.Barrier(3, timeout=2)
+    scheduler = installer.StepScheduler(max_workers=3)
+    for name in ("a", "b", "c"):
+        # 三个步骤必须同时运行，否则 Barrier 超时
+        scheduler.add(name, lambda ctx: barrier.wait())
+    scheduler.run({})
+    assert sorted(scheduler.completed) == ["a", "b", "c"]
+
+
+def test_failure_stops_new_steps_and_waits_for_running_ones():
+    started = []
+    finished = []
+
+    def slow(ctx):
+        time.sleep(0.1)
+        finished.append("slow")
+
+    def fail(ctx):
+        raise RuntimeError("boom")
+
+    scheduler = installer.StepScheduler(on_start=lambda step: started.append(step["name"]),
+                                        on_finish=lambda step, error: finished.append((step["name"], type(error).__name__)))
+    scheduler.add("slow", slow)
+    scheduler.add("fail", fail)
+    scheduler.add("after", lambda ctx: None, depends_on=["fail"])
+    with pytest.raises(RuntimeError, match="boom"):
+        scheduler.run({})
+    assert "after" not in started
+    assert "slow" in finished  # 正在执行的步骤仍然完成
+    assert ("fail", "RuntimeError") in finished
+
+
+def test_ctx_is_shared_between_steps():
+    scheduler = installer.StepScheduler()
+    scheduler.add("produce", lambda ctx: ctx.update(value=1))
+    scheduler.add("consume", lambda ctx: ctx.update(result=ctx["value"] + 1), depends_on=["produce"])
+    ctx = {}
+    scheduler.run(ctx)
+    assert ctx["result"] == 2
+
+
+def test_unknown_and_cyclic_dependencies_are_rejected():
+    scheduler = installer.StepScheduler().add("a", lambda ctx: None, depends_on=["missing"])
+    with pytest.raises(ValueError, match="未知步骤"):
+        scheduler.run({})
+
+    scheduler = installer.StepScheduler()
+    scheduler.add("a", lambda ctx: None, depends_on=["b"])
+    scheduler.add("b", lambda ctx: None, depends_on=["a"])
+    with pytest.raises(ValueError, match="循环依赖"):
+        scheduler.run({})
+
+
+def test_shared_executor_runs_queued_steps_in_the_calling_thread():
+    from concurrent.futures import ThreadPoolExecutor
+
+    order = []
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        scheduler = installer.StepScheduler(executor=pool)
+        scheduler.add("a", lambda ctx: order.append("a"))
+        scheduler.add("b", lambda ctx: order.append("b"))
+        scheduler.add("c", lambda ctx: order.append("c"), depends_on=["a", "b"])
+        # run() 本身占用线程池唯一的线程: 步骤只能由它自己执行，不能死锁
+        pool.submit(scheduler.run, {}).result(timeout=5)
+    assert order[-1] == "c" and sorted(order) == ["a", "b", "c"]
+
+
+def test_shared_executor_runs_steps_concurrently_and_reports_failure():
+    from concurrent.futures import ThreadPoolExecutor
+
+    barrier = threading.Barrier(2, timeout=2)
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        scheduler = installer.StepScheduler(executor=pool)
+        scheduler.add("a", lambda ctx: barrier.wait())
+        scheduler.add("b", lambda ctx: barrier.wait())
+        scheduler.run({})
+        assert sorted(scheduler.completed) == ["a", "b"]
+
+        scheduler = installer.StepScheduler(executor=pool)
+        scheduler.add("fail", lambda ctx: (_ for _ in ()).throw(RuntimeError("boom")))
+        scheduler.add("after", lambda ctx: None, depends_on=["fail"])
+        with pytest.raises(RuntimeError, match="boom"):
+            scheduler.run({})
+        assert scheduler.completed == []
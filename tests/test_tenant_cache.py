@@ -0,0 +1,84 @@
+import json
+
+import install_connect_exo as installer
+
+ENDPOINT = "https://graph.microsoft.com"
+TENANT = "11111111-2222-3333-4444-555555555555"
+
+
+def age_field(cache, field, seconds):
+    with open(cache.path, encoding="utf-8") as f:
+        data = json.load(f)
+    for entry in data["tenants"].values():
+        entry[field]["cached_at"] -= seconds
+    with open(cache.path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+
+
+def test_update_and_get_round_trip(make_tenant_cache):
+    cache = make_tenant_cache()
+    cache.update(ENDPOINT, TENANT, tenant_domain="contoso.onmicrosoft.com", exo_sp_id="sp-1", unknown="ignored",
+                 manage_as_app_role_id=None)
+    assert cache.get(ENDPOINT, TENANT) == {"tenant_domain": "contoso.onmicrosoft.com", "exo_sp_id": "sp-1"}
+    assert cache.get(ENDPOINT, TENANT, "exo_sp_id") == {"exo_sp_id": "sp-1"}
+    # 终结点末尾的斜杠和租户 ID 大小写不影响索引
+    assert make_tenant_cache().get(ENDPOINT + "/", TENANT.upper(), "exo_sp_id") == {"exo_sp_id": "sp-1"}
+
+
+def test_fields_expire_individually_after_ttl(make_tenant_cache):
+    cache = make_tenant_cache(ttl=3600)
+    cache.update(ENDPOINT, TENANT, tenant_domain="contoso.onmicrosoft.com", exo_sp_id="sp-1")
+    age_field(cache, "exo_sp_id", 3601)
+    assert cache.get(ENDPOINT, TENANT) == {"tenant_domain": "contoso.onmicrosoft.com"}
+
+    # 重新写入刷新缓存时间
+    cache.update(ENDPOINT, TENANT, exo_sp_id="sp-2")
+    assert cache.get(ENDPOINT, TENANT, "exo_sp_id") == {"exo_sp_id": "sp-2"}
+
+
+def test_default_ttl_is_seven_days(make_tenant_cache):
+    cache = make_tenant_cache()
+    assert cache.ttl == 7 * 86400
+    cache.update(ENDPOINT, TENANT, tenant_domain="contoso.onmicrosoft.com")
+    age_field(cache, "tenant_domain", 6 * 86400)
+    assert cache.get(ENDPOINT, TENANT)
+    age_field(cache, "tenant_domain", 2 * 86400)
+    assert cache.get(ENDPOINT, TENANT) == {}
+
+
+def test_invalidate_drops_only_that_tenant(make_tenant_cache):
+    cache = make_tenant_cache()
+    cache.update(ENDPOINT, TENANT, exo_sp_id="sp-1")
+    cache.update(ENDPOINT, "other-tenant", exo_sp_id="sp-9")
+    cache.update("https://microsoftgraph.chinacloudapi.cn", TENANT, exo_sp_id="sp-cn")
+    cache.invalidate(ENDPOINT, TENANT)
+    assert cache.get(ENDPOINT, TENANT) == {}
+    assert cache.get(ENDPOINT, "other-tenant") == {"exo_sp_id": "sp-9"}
+    assert cache.get("https://microsoftgraph.chinacloudapi.cn", TENANT) == {"exo_sp_id": "sp-cn"}
+
+
+def test_missing_tenant_or_malformed_file_is_a_miss(tmp_path, make_tenant_cache):
+    cache = make_tenant_cache()
+    assert cache.get(ENDPOINT, None) == {}
+    cache.update(ENDPOINT, None, exo_sp_id="sp-1")
+    assert not (tmp_path / "tenant_cache.json").exists()
+
+    (tmp_path / "tenant_cache.json").write_text('{"version": 2, "tenants": {}}', encoding="utf-8")
+    assert cache.get(ENDPOINT, TENANT) == {}
+    key = installer.TenantCache.make_key(ENDPOINT, TENANT)
+    (tmp_path / "tenant_cache.json").write_text(json.dumps(
+        {"version": 1, "tenants": {key: {"exo_sp_id": {"value": 42, "cached_at": 0}}}}), encoding="utf-8")
+    assert cache.get(ENDPOINT, TENANT) == {}
+
+
+def test_reinstall_reuses_cached_tenant_lookups(fake_tenant):
+    engine = fake_tenant.make_engine()
+    engine.install("Global", "Contoso")
+    engine.uninstall("Global", "Contoso")
+    del fake_tenant.logs[:]
+
+    engine.install("Global", "Contoso")
+    messages = [message for _, message in fake_tenant.logs]
+    assert "√ 租户域名: contoso.com (缓存)" in messages
+    assert "√ 使用缓存的 Exchange Online 服务主体和角色信息" in messages
+    assert engine.verify("Global", "Contoso")["ok"]
@@ -0,0 +1,121 @@
+import threading
+
+import install_connect_exo as installer
+
+
+def test_pump_runs_once_per_frame(make_bus):
+    root, bus = make_bus()
+    assert root.delays == [installer.UIEventBus.FRAME_MS]
+    root.tick()
+    root.tick()
+    assert root.delays == [installer.UIEventBus.FRAME_MS] * 3
+
+    root, bus = make_bus(frame_ms=40)
+    assert root.delays == [40]
+
+
+def test_batch_events_are_coalesced_into_one_call_per_frame(make_bus):
+    root, bus = make_bus()
+    calls = []
+    bus.subscribe("log", calls.append)
+    for i in range(100):
+        bus.post("log", i)
+    assert calls == []  # 投递本身不触碰界面
+    root.tick()
+    assert calls == [list(range(100))]
+    root.tick()
+    assert len(calls) == 1  # 没有新事件时不调用
+
+
+def test_latest_events_keep_only_the_last_value(make_bus):
+    root, bus = make_bus()
+    progress = []
+    bus.subscribe("progress", progress.append, mode="latest")
+    for value in (10, 20, 30):
+        bus.post("progress", value)
+    root.tick()
+    assert progress == [30]
+
+
+def test_calls_run_in_order_after_earlier_events(make_bus):
+    root, bus = make_bus()
+    seen = []
+    bus.subscribe("log", lambda records: seen.append(("log", records)))
+    bus.post("log", "a")
+    bus.call_soon(seen.append, "call")
+    bus.post("log", "b")
+    root.tick()
+    assert seen == [("log", ["a"]), "call", ("log", ["b"])]
+
+
+def test_call_from_worker_thread_returns_main_thread_result(make_bus):
+    root, bus = make_bus()
+    main_thread = threading.get_ident()
+    result = {}
+
+    def dialog(text):
+        result["thread"] = threading.get_ident()
+        return text.upper()
+
+    worker = threading.Thread(target=lambda: result.update(value=bus.call(dialog, "ok")))
+    worker.start()
+    while worker.is_alive():
+        root.tick()
+        worker.join(0.01)
+    assert result == {"thread": main_thread, "value": "OK"}
+
+
+def test_submit_returns_future(make_bus):
+    root, bus = make_bus()
+    future = bus.submit(lambda a, b: a + b, 1, 2)
+    assert not future.done()
+    root.tick()
+    assert future.result(timeout=0) == 3
+
+
+def test_calls_wait_while_a_dialog_is_open(make_bus):
+    root, bus = make_bus()
+    seen = []
+    bus.subscribe("log", lambda records: seen.append(("log", records)))
+
+    def dialog():
+        # 模态对话框的嵌套事件循环中泵继续运行: 日志照常刷新，后面的调用等对话框关闭
+        bus.post("log", "during")
+        bus.call_soon(seen.append, "after dialog")
+        root.tick()
+        seen.append("dialog closed")
+
+    bus.call_soon(dialog)
+    root.tick()
+    root.tick()
+    assert seen == [("log", ["during"]), "dialog closed", "after dialog"]
+
+
+def test_handler_errors_are_reported_and_do_not_stop_the_pump(make_bus):
+    errors = []
+    root, bus = make_bus(on_error=errors.append)
+    bus.subscribe("log", lambda records: 1 / 0)
+    bus.post("log", "x")
+    root.tick()
+    assert len(errors) == 1 and isinstance(errors[0], ZeroDivisionError)
+    assert root.callback is not None
+
+
+def test_take_removes_pending_events(make_bus):
+    root, bus = make_bus()
+    seen = []
+    bus.subscribe("log", seen.append)
+    bus.post("log", 1)
+    bus.post("progress", 50)
+    bus.post("log", 2)
+    assert bus.take("log") == [1, 2]
+    root.tick()
+    assert seen == []
+
+
+def test_close_cancels_pump_and_pending_calls(make_bus):
+    root, bus = make_bus()
+    future = bus.submit(lambda: None)
+    bus.close()
+    assert root.cancelled and root.callback is None
+    assert future.cancelled()
@@ -0,0 +1,52 @@
+import copy
+
+import install_connect_exo as installer
+
+
+def statuses(result):
+    return {c["name"]: c["status"] for c in result["checks"]}
+
+
+def test_verify_passes_after_install_in_one_read_only_round_trip(fake_tenant):
+    engine = fake_tenant.make_engine()
+    engine.install("Global", "Contoso")
+    state = fake_tenant.state
+    before = copy.deepcopy((state.applications, state.service_principals, state.app_role_assignments, state.role_assignments))
+    stats = dict(state.stats)
+
+    result = engine.verify("Global", "Contoso")
+    assert result["ok"]
+    assert set(statuses(result).values()) == {"pass"}
+    assert {"本地模块", "本地证书", "Azure 应用", "应用证书", "服务主体", "Exchange.ManageAsApp 权限",
+            "Exchange Administrator 角色"} <= set(statuses(result))
+    # 服务主体 ID 和 Exchange Online 的 ID 已记录: Graph 检查只需一次 $batch，不修改任何对象
+    assert state.stats["http_requests"] - stats["http_requests"] == 1
+    assert state.stats["batch_requests"] - stats["batch_requests"] == 1
+    assert (state.applications, state.service_principals, state.app_role_assignments, state.role_assignments) == before
+
+
+def test_verify_reports_removed_grants_and_missing_certificates(fake_tenant):
+    engine = fake_tenant.make_engine()
+    installed = engine.install("Global", "Contoso")
+    fake_tenant.state.app_role_assignments.clear()
+    fake_tenant.ps_host.run(f"Remove-Item -Path 'Cert:\\CurrentUser\\My\\{installed['thumbprint']}'")
+
+    result = engine.verify("Global", "Contoso")
+    assert not result["ok"]
+    checks = statuses(result)
+    assert checks["Exchange.ManageAsApp 权限"] == "fail" and checks["本地证书"] == "fail"
+    assert checks["Azure 应用"] == "pass" and checks["Exchange Administrator 角色"] == "pass"
+    # 比较使用的是缓存的 ID，失败时清除缓存，下次检查重新查询
+    endpoint = installer.get_cloud_config("Global")["graph_endpoint"]
+    assert engine.tenant_cache.get(endpoint, "bench-tenant-id", "exo_sp_id") == {}  # 替身令牌中的租户 ID
+    sub_requests = fake_tenant.state.stats["sub_requests"]
+    assert statuses(engine.verify("Global", "Contoso"))["Exchange.ManageAsApp 权限"] == "fail"
+    # 应用、服务主体、权限、角色分配，以及重新查询的 Exchange Online 服务主体
+    assert fake_tenant.state.stats["sub_requests"] - sub_requests == 5
+
+
+def test_verify_without_module_checks_locally_and_does_not_sign_in(fake_tenant):
+    result = fake_tenant.make_engine().verify("Global", "Contoso")
+    assert not result["ok"]
+    assert statuses(result) == {"本地模块": "fail", "本地证书": "fail"}
+    assert fake_tenant.logins == []